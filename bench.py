@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+bench.py
+
+Benchmark every pyio engine and compare against a stored baseline.
+
+An engine call is a single timed run, so warm-up is excluded per cell:
+--warmup runs of each cell are discarded before its samples are taken,
+much like r_loop.py --ramp discards its first intervals.
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+from argparse import ArgumentParser
+from lib import pyio
+
+
+def _src(wdir, size):
+    """
+    Return the path of a preconditioned source file, creating it if needed.
+
+    Args:
+        wdir (str): Working directory
+        size (int): File size in KB
+    Returns:
+        fname (str): File name
+    """
+    fname = os.path.join(wdir, 'src.%d' % size)
+    if not os.path.exists(fname):
+        pyio.w_rand(fname, size, 1024)
+    return fname
+
+
+def _dst(wdir):
+    """
+    Return the path of a scratch destination file.
+
+    Args:
+        wdir (str): Working directory
+    Returns:
+        fname (str): File name
+    """
+    return os.path.join(wdir, 'dst')
+
+
+# Engine name -> (function(wdir, size, bs), function(size, bs)). The first
+# runs the engine, the second returns the bytes it moves. Sizes are in KB.
+_file = lambda s, b: s * 1024
+ENGINES = {
+    'w_zero': (lambda w, s, b: pyio.w_zero(_dst(w), s, b), _file),
+    'w_srand': (lambda w, s, b: pyio.w_srand(_dst(w), s, b), _file),
+    'w_rand': (lambda w, s, b: pyio.w_rand(_dst(w), s, b), _file),
+    'w_rand_ovw': (lambda w, s, b: pyio.w_rand_ovw(_src(w, s), b),
+                   lambda s, b: s // b * b * 1024),
+    'w_stripe': (lambda w, s, b: pyio.w_stripe(_dst(w), s, b, 4), _file),
+    'cp': (lambda w, s, b: pyio.cp(_src(w, s), _dst(w), b), _file),
+    'cp_conv': (lambda w, s, b: pyio.cp_conv(_src(w, s), _dst(w), b), _file),
+    'cp_rand': (lambda w, s, b: pyio.cp_rand(_src(w, s), _dst(w), b), _file),
+    'cp_pipe': (lambda w, s, b: pyio.cp_pipe(_src(w, s), _dst(w), b), _file),
+    'r_seq': (lambda w, s, b: pyio.r_seq(_src(w, s), b), _file),
+    'r_rand': (lambda w, s, b: pyio.r_rand(_src(w, s), b), _file),
+    'r_conv': (lambda w, s, b: pyio.r_conv(_src(w, s), b), _file),
+    'r_rand_blk': (lambda w, s, b: pyio.r_rand_blk(_src(w, s), b),
+                   lambda s, b: b * 1024),
+    'r_stripe': (lambda w, s, b: pyio.r_stripe(_src(w, s), b, 4), _file),
+}
+
+
+def _median(samples):
+    """
+    Median of a list of samples.
+
+    Args:
+        samples (list): Samples
+    Returns:
+        median (float): Median
+    """
+    samples = sorted(samples)
+    mid = len(samples) // 2
+    if len(samples) % 2:
+        return samples[mid]
+    return (samples[mid - 1] + samples[mid]) / 2.0
+
+
+def run(dirs, engines, sizes, blkszs, repeat, cold=False, warmup=0):
+    """
+    Run the benchmark matrix.
+
+    Each cell is run repeat times and summarised by the median throughput
+    and the median absolute deviation (MAD) of the samples. Warm up runs
+    before the samples absorb cold start effects such as block allocation
+    and are discarded.
+
+    Args:
+        dirs (list): List of (label, directory) tuples
+        engines (list): Engine names
+        sizes (list): File sizes in KB
+        blkszs (list): Block sizes in KB
+        repeat (int): Samples per cell
+        cold (bool): Evict the source file before each sample
+        warmup (int): Discarded runs per cell
+    Returns:
+        results (dict): Cell name -> summary
+    """
+    results = {}
+    for label, directory in dirs:
+        wdir = tempfile.mkdtemp(prefix='bench.', dir=directory)
+        try:
+            for size in sizes:
+                for bs in blkszs:
+                    if bs > size:
+                        continue
+                    for engine in engines:
+                        func, nbytes = ENGINES[engine]
+                        nbytes = nbytes(size, bs)
+                        # The same seed gives every run the same offsets
+                        pyio.seed(0)
+                        samples = []
+                        for i in range(warmup + repeat):
+                            if cold:
+                                pyio.evict(_src(wdir, size))
+                            start = time.time()
+                            func(wdir, size, bs)
+                            elapsed = time.time() - start
+                            if i >= warmup:
+                                samples.append(nbytes / elapsed / 1048576)
+                        median = _median(samples)
+                        mad = _median([abs(x - median) for x in samples])
+                        cell = '%s/%s/size=%d/bs=%d' % (label, engine, size,
+                                                        bs)
+                        results[cell] = {'median': median, 'mad': mad,
+                                         'samples': samples}
+                        print '%-48s %10.1f MB/s +/- %.1f' % (cell, median,
+                                                              mad)
+        finally:
+            shutil.rmtree(wdir)
+    return results
+
+
+def compare(base, results, threshold, noise):
+    """
+    Compare results against a baseline.
+
+    A cell regresses when its median drops below the baseline median by
+    more than threshold percent and by more than noise times the combined
+    MAD of both runs, so that noisy cells need a larger drop to fail.
+    Cells with a zero baseline median have no change and never regress.
+
+    Args:
+        base (dict): Baseline results
+        results (dict): Current results
+        threshold (float): Minimum regression in percent
+        noise (float): MAD multiplier
+    Returns:
+        regressions (list): Regressed cell names
+    """
+    regressions = []
+    print '%-48s %10s %10s %8s' % ('cell', 'base', 'current', 'change')
+    for cell in sorted(results):
+        if cell not in base:
+            continue
+        old = base[cell]
+        new = results[cell]
+        if not old['median']:
+            # Nothing to regress from, e.g. a cell that did not run before
+            print '%-48s %10.1f %10.1f %8s' % (cell, old['median'],
+                                               new['median'], 'n/a')
+            continue
+        change = (new['median'] - old['median']) / old['median'] * 100
+        drop = old['median'] - new['median']
+        margin = max(old['median'] * threshold / 100.0,
+                     noise * (old['mad'] + new['mad']))
+        flag = ''
+        if drop > margin:
+            regressions.append(cell)
+            flag = ' REGRESSION'
+        print '%-48s %10.1f %10.1f %+7.1f%%%s' % (cell, old['median'],
+                                                  new['median'], change, flag)
+    return regressions
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Benchmark the pyio engines.')
+    parser.add_argument('--dir', '-d', dest='dirs', type=str,
+                        action='append', required=True,
+                        help='directory to benchmark in, optionally '
+                        'labelled as label=path, e.g. tmpfs=/dev/shm')
+    parser.add_argument('--engine', '-e', dest='engines', type=str,
+                        action='append', choices=sorted(ENGINES),
+                        help='engine to run, default is all')
+    parser.add_argument('--size', dest='sizes', type=int, action='append',
+                        help='file size in KB, default is 1024 and 16384')
+    parser.add_argument('--bs', dest='blkszs', type=int, action='append',
+                        help='block size in KB, default is 4, 64 and 1024')
+    parser.add_argument('--repeat', '-r', dest='repeat', type=int,
+                        default=5, help='samples per cell')
+    parser.add_argument('--warmup', '-w', dest='warmup', type=int,
+                        default=1, help='discarded runs per cell, default '
+                        'is 1')
+    parser.add_argument('--cold', dest='cold', action='store_true',
+                        help='evict the source file before each sample')
+    parser.add_argument('--save', dest='save', type=str, default=None,
+                        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', dest='compare', type=str, default=None,
+                        help='compare the results against a JSON baseline')
+    parser.add_argument('--threshold', dest='threshold', type=float,
+                        default=10.0,
+                        help='minimum regression in percent, default is 10')
+    parser.add_argument('--noise', dest='noise', type=float, default=3.0,
+                        help='regressions must also exceed this many MADs, '
+                        'default is 3')
+    args = parser.parse_args()
+
+    dirs = []
+    for d in args.dirs:
+        label, _, path = d.rpartition('=')
+        dirs.append((label or path, path))
+
+    results = run(dirs, args.engines or sorted(ENGINES),
+                  args.sizes or [1024, 16384], args.blkszs or [4, 64, 1024],
+                  args.repeat, args.cold, args.warmup)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'host': socket.gethostname(),
+                       'platform': platform.platform(),
+                       'python': platform.python_version(),
+                       'time': time.time(),
+                       'results': results}, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)['results']
+        regressions = compare(base, results, args.threshold, args.noise)
+        if regressions:
+            print ''
+            sys.exit('%d of %d cells regressed:\n%s' % (
+                len(regressions), len(results), '\n'.join(regressions)))
+
+if __name__ == '__main__':
+    main()
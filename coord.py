@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""
+coord.py
+
+Drive pyio workloads on several hosts at once and aggregate the results.
+
+Agents listen on a TCP port for a workload spec, start it at a barrier time
+chosen by the controller and stream interval statistics back. The
+controller merges the latency histograms of all agents into one report.
+Agents and controller exchange newline delimited JSON. The barrier is an
+absolute time, the controller measures the clock skew of each agent and
+sends each agent the barrier on its own clock.
+
+    coord.py agent --port 9000
+    coord.py agent --port 9001
+    coord.py run -a localhost:9000 -a localhost:9001 -d /mnt/test -t 4
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from Queue import Queue, Empty
+from math import ceil
+from random import randint
+from argparse import ArgumentParser
+from lib import pyio
+
+# Workload name -> function(fname, bs, stats)
+WORKLOADS = {
+    'r_seq': lambda f, b, s: pyio.r_seq(f, b, stats=s),
+    'r_rand': lambda f, b, s: pyio.r_rand(f, b, stats=s),
+    'r_conv': lambda f, b, s: pyio.r_conv(f, b, stats=s),
+    'r_rand_blk': lambda f, b, s: pyio.r_rand_blk(f, b, stats=s),
+    'w_rand_blk': lambda f, b, s: pyio.w_rand_blk(f, b, stats=s),
+}
+
+
+def _send(sock, msg):
+    """
+    Send a message.
+
+    Args:
+        sock (socket): Connected socket
+        msg (dict): Message
+    """
+    sock.sendall(json.dumps(msg) + '\n')
+
+
+def _recv(f):
+    """
+    Receive a message.
+
+    Args:
+        f (file): Socket file
+    Returns:
+        msg (dict): Message, None at end of stream
+    """
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def _walk(root):
+    """
+    Walk a directory and return the path of every file.
+
+    Args:
+        root (str): Root directory
+    Returns:
+        files (list): File list
+    """
+    files = []
+    for dname, dirs, fnames in os.walk(root):
+        for fname in fnames:
+            files.append(os.path.join(dname, fname))
+    if not files:
+        raise ValueError('%s holds no files' % root)
+    return files
+
+
+def _check_spec(spec):
+    """
+    Validate a workload spec.
+
+    Args:
+        spec (dict): Workload spec
+    Raises:
+        ValueError: The spec is invalid
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('spec is not an object')
+    for key in ('workload', 'dir', 'bs', 'threads', 'duration', 'interval'):
+        if key not in spec:
+            raise ValueError('spec lacks %s' % key)
+    if spec['workload'] not in WORKLOADS:
+        raise ValueError('unknown workload %s' % spec['workload'])
+    if spec['threads'] < 1 or spec['duration'] <= 0 or spec['interval'] <= 0:
+        raise ValueError('threads, duration and interval must be positive')
+
+
+def _worker(idx, files, func, bs, end, stop, intervals, errors, used):
+    """
+    Apply a workload to random files until the end of the run.
+
+    Args:
+        idx (int): Thread index
+        files (list): File list
+        func (function): Workload function
+        bs (int|list): Block size in KB or a block size mix
+        end (float): End time
+        stop (Event): Stop early when set
+        intervals (Intervals): Interval statistics
+        errors (list): Receives the error that stopped the thread
+        used (list): Receives the resource usage of the thread, see
+                     pyio.usage
+    """
+    last = len(files) - 1
+    stats = intervals.stats(idx)
+    before = pyio.usage()
+    try:
+        while time.time() < end and not stop.is_set():
+            func(files[randint(0, last)], bs, stats)
+            stats = intervals.tick(idx)
+    except (OSError, IOError, ValueError) as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        acct = pyio.Stats()
+        acct.account(before)
+        used.append(acct.usage)
+        intervals.finish(idx)
+
+
+def run_spec(spec, files, sock):
+    """
+    Run a workload spec and stream its interval statistics.
+
+    Interval k is sent once every thread has moved past it, intervals with
+    no completed files are sent empty so the controller sees every index.
+    The final message carries the totals of the agent with the resource
+    usage of its threads, for the cost report.
+
+    Args:
+        spec (dict): Workload spec with a start time
+        files (list): File list
+        sock (socket): Controller connection
+    Raises:
+        The first error of any thread, once all threads have stopped
+    """
+    func = WORKLOADS[spec['workload']]
+    thr_ct = spec['threads']
+    end = spec['start'] + spec['duration']
+    # Files completing after the end belong to the last interval
+    intervals = pyio.Intervals(thr_ct, spec['interval'], spec['start'],
+                               int(ceil(spec['duration'] /
+                                        spec['interval'])) - 1)
+    stop = threading.Event()
+    errors = []
+    used = []
+    thrs = []
+    for i in range(thr_ct):
+        t = threading.Thread(target=_worker, args=(i, files, func,
+                                                   spec['bs'], end, stop,
+                                                   intervals, errors, used))
+        t.daemon = True
+        thrs.append(t)
+
+    # Sleep until the barrier
+    delay = spec['start'] - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    for t in thrs:
+        t.start()
+
+    total = pyio.Stats()
+    while True:
+        item = intervals.get()
+        if item is None:
+            break
+        k, done, stats = item
+        total.merge(stats)
+        _send(sock, {'type': 'interval', 'index': k, 'files': done,
+                     'stats': stats.to_dict()})
+    for t in thrs:
+        t.join()
+    if errors:
+        raise errors[0]
+    total.usage = dict((counter, sum(u[counter] for u in used))
+                       for counter in used[0])
+    _send(sock, {'type': 'done', 'stats': total.to_dict()})
+
+
+def agent(port, host='', once=False, srv=None):
+    """
+    Serve workload specs, one controller at a time.
+
+    A connection sends a spec, the agent replies ready with its clock and
+    then waits for the start time. Connections that close early or send
+    an invalid spec are answered with an error, if possible, and the agent
+    keeps serving.
+
+    Args:
+        port (int): TCP port
+        host (str): Address to listen on, default all
+        once (bool): Exit after the first valid spec
+        srv (socket): Listening socket to serve on instead of binding port,
+                      e.g. one bound to port 0
+    """
+    if srv is None:
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind((host, port))
+        srv.listen(1)
+    print "Agent listening on port %d." % srv.getsockname()[1]
+    sys.stdout.flush()
+    while True:
+        sock, addr = srv.accept()
+        f = sock.makefile('r')
+        valid = False
+        try:
+            try:
+                spec = _recv(f)
+                if spec is None:
+                    raise ValueError('no spec')
+                _check_spec(spec)
+                valid = True
+                print "Running %s for %s." % (spec['workload'], addr[0])
+                files = _walk(spec['dir'])
+                _send(sock, {'type': 'ready', 'time': time.time()})
+                msg = _recv(f)
+                if not isinstance(msg, dict) or msg.get('type') != 'start':
+                    raise ValueError('no start time')
+                spec['start'] = float(msg['start'])
+                run_spec(spec, files, sock)
+            except (ValueError, KeyError, TypeError, OSError, IOError) as e:
+                _send(sock, {'type': 'error', 'msg': str(e)})
+        except socket.error as e:
+            print "Controller %s lost: %s" % (addr[0], e)
+        finally:
+            f.close()
+            sock.close()
+        if once and valid:
+            break
+    srv.close()
+
+
+def _reader(name, f, out):
+    """
+    Forward the messages of one agent.
+
+    Args:
+        name (str): Agent name
+        f (file): Socket file
+        out (Queue): Receives (agent name, message) tuples
+    """
+    try:
+        while True:
+            msg = _recv(f)
+            if msg is None:
+                msg = {'type': 'error', 'msg': 'connection closed'}
+            out.put((name, msg))
+            if msg['type'] in ('done', 'error'):
+                break
+    except (socket.error, ValueError) as e:
+        out.put((name, {'type': 'error', 'msg': str(e)}))
+
+
+def controller(agents, spec, delay=2.0):
+    """
+    Run a workload spec on every agent and merge the results.
+
+    The clock skew of each agent is estimated from its ready reply and
+    each agent is sent the barrier on its own clock.
+
+    Args:
+        agents (list): List of (host, port) tuples
+        spec (dict): Workload spec without a start time
+        delay (float): Seconds between the last agent being ready and the
+                       barrier
+    Returns:
+        stats (Stats): Merged statistics of all agents, each agent is a
+                       worker with the resource usage of its threads
+    """
+    conns = []
+    skews = []
+    out = Queue()
+    for host, port in agents:
+        name = '%s:%d' % (host, port)
+        sock = socket.create_connection((host, port))
+        f = sock.makefile('r')
+        sent = time.time()
+        _send(sock, spec)
+        msg = _recv(f)
+        if msg is None or msg['type'] != 'ready':
+            raise RuntimeError('agent %s failed: %s' %
+                               (name, msg and msg.get('msg')))
+        skew = msg['time'] - (sent + time.time()) / 2
+        print "Agent %s ready, clock skew %+.3f s." % (name, skew)
+        conns.append((sock, f))
+        skews.append(skew)
+
+    start = time.time() + delay
+    for (sock, f), skew, (host, port) in zip(conns, skews, agents):
+        _send(sock, {'type': 'start', 'start': start + skew})
+        t = threading.Thread(target=_reader, args=('%s:%d' % (host, port),
+                                                   f, out))
+        t.daemon = True
+        t.start()
+
+    # interval -> [agents reported, files, Stats]
+    intervals = {}
+    merged = pyio.Stats()
+    running = len(conns)
+    nxt = 0
+    errors = []
+    while running:
+        try:
+            name, msg = out.get(timeout=1)
+        except Empty:
+            continue
+        if msg['type'] == 'interval':
+            stats = pyio.Stats.from_dict(msg['stats'])
+            merged.merge(stats)
+            rec = intervals.setdefault(msg['index'], [0, 0, pyio.Stats()])
+            rec[0] += 1
+            rec[1] += msg['files']
+            rec[2].merge(stats)
+        else:
+            running -= 1
+            if msg.get('stats') is not None:
+                # The operations already came with the intervals, only
+                # keep the agent as a worker of the cost report
+                merged.workers.append(pyio.Stats.from_dict(msg['stats']))
+            if msg['type'] == 'error':
+                errors.append('%s: %s' % (name, msg['msg']))
+        # Print intervals once every agent has reported them
+        while nxt in intervals and (intervals[nxt][0] == len(conns) or
+                                    not running):
+            reported, done, stats = intervals.pop(nxt)
+            nbytes = sum(stats.nbytes(op) for op in stats.ops)
+            print "%4d %10.1f files/s %10.1f MB/s" % (
+                nxt, done / spec['interval'],
+                nbytes / spec['interval'] / 1048576)
+            nxt += 1
+
+    for sock, f in conns:
+        f.close()
+        sock.close()
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+    return merged
+
+
+def _agent_addr(s):
+    """
+    Parse an agent address.
+
+    Args:
+        s (str): host:port
+    Returns:
+        addr (tuple): (host, port)
+    """
+    host, _, port = s.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Multi-host pyio coordinator.')
+    sub = parser.add_subparsers(dest='mode')
+    p = sub.add_parser('agent', help='serve workloads')
+    p.add_argument('--port', '-p', dest='port', type=int, default=9000,
+                   help='TCP port, default is 9000')
+    p.add_argument('--bind', dest='bind', type=str, default='',
+                   help='address to listen on, default is all')
+    p.add_argument('--once', dest='once', action='store_true',
+                   help='exit after the first run')
+    p = sub.add_parser('run', help='run a workload on agents')
+    p.add_argument('--agent', '-a', dest='agents', type=_agent_addr,
+                   action='append', required=True,
+                   help='agent as host:port, repeat for each agent')
+    p.add_argument('--dir', '-d', dest='dir', type=str, required=True,
+                   help='root directory on the agents')
+    p.add_argument('--workload', '-w', dest='workload', type=str,
+                   default='r_seq', choices=sorted(WORKLOADS),
+                   help='workload, default is r_seq')
+    p.add_argument('--bs', dest='bs', type=int, default=32,
+                   help='IO block size in KB')
+    p.add_argument('--bssplit', dest='bssplit', type=pyio.parse_bssplit,
+                   default=None, help='IO block size mix in KB, e.g. '
+                   '4:70,64:20,1024:10')
+    p.add_argument('--threads', '-t', dest='thr_ct', type=int, default=1,
+                   help='threads per agent')
+    p.add_argument('--duration', dest='duration', type=float, default=30,
+                   help='run time in seconds, default is 30')
+    p.add_argument('--interval', dest='interval', type=float, default=1,
+                   help='reporting interval in seconds, default is 1')
+    p.add_argument('--delay', dest='delay', type=float, default=2,
+                   help='seconds from the last agent being ready until the '
+                   'start barrier, default is 2')
+    args = parser.parse_args()
+
+    if args.mode == 'agent':
+        agent(args.port, args.bind, args.once)
+        return
+
+    spec = {'workload': args.workload, 'dir': args.dir,
+            'bs': args.bssplit or args.bs, 'threads': args.thr_ct,
+            'duration': args.duration, 'interval': args.interval}
+    try:
+        stats = controller(args.agents, spec, args.delay)
+    except (RuntimeError, socket.error) as e:
+        sys.exit('Run failed: %s' % e)
+    print "\n".join(stats.report())
+    print "\n".join(stats.cost())
+
+if __name__ == '__main__':
+    main()
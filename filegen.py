@@ -24,9 +24,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import time
-from random import randint
+import random
+from math import log
+from bisect import bisect
 from argparse import ArgumentParser
 from lib.pyio import w_srand, w_rand, w_zero
+from lib.tree import tree
+
+DISTS = ('uniform', 'lognormal', 'pareto', 'hist')
 
 
 def mkdir(dir):
@@ -42,7 +47,105 @@ def mkdir(dir):
         os.mkdir(dir)
 
 
-def filegen(min_sz, max_sz, qty, ftype, bs=1024, dst=None, split=None):
+def read_hist(fname):
+    """
+    Read a file size histogram. Each line holds a size range in KB and its
+    weight, "LOW HIGH WEIGHT", or a single size and its weight, "SIZE
+    WEIGHT". Empty lines and lines starting with # are skipped.
+
+    Inputs:
+        fname (str): Histogram file
+    Outputs:
+        buckets (list): List of (low, high, weight) tuples
+    """
+    buckets = []
+    with open(fname) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) == 2:
+                fields.insert(0, fields[0])
+            if len(fields) != 3:
+                raise ValueError('bad histogram line: %s' % line.strip())
+            low, high, weight = int(fields[0]), int(fields[1]), \
+                float(fields[2])
+            if low > high or weight < 0:
+                raise ValueError('bad histogram line: %s' % line.strip())
+            buckets.append((low, high, weight))
+    if not sum(b[2] for b in buckets):
+        raise ValueError('%s holds no weights' % fname)
+    return buckets
+
+
+def size_dist(dist, min_sz, max_sz, rng):
+    """
+    Build a file size generator. Sizes outside of min_sz and max_sz, when
+    given, are clamped to them.
+
+    Inputs:
+        dist  (str): Size distribution:
+                       uniform                between min_sz and max_sz
+                       lognormal:MEDIAN,SIGMA lognormal around a median in
+                                              KB, mostly small files with a
+                                              tail, sigma defaults to 1.5
+                       pareto:ALPHA           pareto with shape ALPHA and
+                                              scale min_sz, or 1 KB, a long
+                                              heavy tail
+                       hist:FILE              weighted ranges, see read_hist
+        min_sz (int): Minimum file size in KB
+        max_sz (int): Maximum file size in KB
+        rng (Random): Random number generator
+    Outputs:
+        draw (function): Returns a file size in KB
+    """
+    name, _, params = dist.partition(':')
+    params = params.split(',') if params else []
+    if name == 'uniform':
+        if min_sz is None or max_sz is None:
+            raise ValueError('uniform sizes require a minimum and maximum')
+        return lambda: rng.randint(min_sz, max_sz)
+    elif name == 'lognormal':
+        if not params:
+            raise ValueError('lognormal sizes require a median')
+        mu = log(float(params[0]))
+        sigma = float(params[1]) if len(params) > 1 else 1.5
+        draw = lambda: rng.lognormvariate(mu, sigma)
+    elif name == 'pareto':
+        if not params:
+            raise ValueError('pareto sizes require a shape')
+        alpha = float(params[0])
+        scale = min_sz or 1
+        draw = lambda: scale * rng.paretovariate(alpha)
+    elif name == 'hist':
+        if not params:
+            raise ValueError('histogram sizes require a file')
+        buckets = read_hist(params[0])
+        cum = []
+        total = 0.0
+        for low, high, weight in buckets:
+            total += weight
+            cum.append(total)
+
+        def draw():
+            low, high, weight = buckets[bisect(cum, rng.random() * total)]
+            return rng.randint(low, high)
+    else:
+        raise ValueError('unknown size distribution %s' % name)
+
+    low = min_sz or 0
+    high = max_sz
+
+    def clamped():
+        size = max(int(round(draw())), low)
+        if high is not None:
+            size = min(size, high)
+        return size
+    return clamped
+
+
+def filegen(min_sz, max_sz, qty, ftype, bs=1024, dst=None, split=None,
+            dist='uniform', shape=None, rand_seed=None):
     """
     Generate files.
 
@@ -53,9 +156,19 @@ def filegen(min_sz, max_sz, qty, ftype, bs=1024, dst=None, split=None):
         ftype  (int): File type
         dst    (str): Destination directory
         split  (int): File per directory
+        dist   (str): File size distribution, see size_dist
+        shape (list): Spread the files at random over the leaves of a
+                      directory tree with one width per level, see
+                      tree.tree, instead of splitting
+        rand_seed (int): Seed of the sizes and the placement
     Outputs:
         NULL
     """
+    # A private generator keeps the file set reproducible whatever else
+    # draws from the random module
+    rng = random.Random(rand_seed)
+    draw = size_dist(dist, min_sz, max_sz, rng)
+
     # Define file type
     if ftype == 0:
         print 'Using the zero file generator.'
@@ -76,7 +189,14 @@ def filegen(min_sz, max_sz, qty, ftype, bs=1024, dst=None, split=None):
     if not dst:
         dst = os.getcwd()
 
-    if split:
+    leaves = None
+    if shape:
+        leaves = tree(shape, len(shape), dst)
+        print 'Spreading files over %d directories.' % len(leaves)
+        current_dir = dst
+        pwd = dst
+        split = qty if qty > 0 else float('inf')
+    elif split:
         current_dir = 0
         pwd = os.path.join(dst, str(current_dir))
         mkdir(pwd)
@@ -92,7 +212,9 @@ def filegen(min_sz, max_sz, qty, ftype, bs=1024, dst=None, split=None):
         stime = time.time()
         while dir_ct < split:
             # Write file.
-            size = randint(min_sz, max_sz)
+            size = draw()
+            if leaves:
+                pwd = rng.choice(leaves)
             f = os.path.join(pwd, ".".join([ftype_str, str(dir_ct)]))
             gen(f, size, bs)
 
@@ -126,10 +248,16 @@ def filegen(min_sz, max_sz, qty, ftype, bs=1024, dst=None, split=None):
 if __name__ == '__main__':
     # Define CLI arguments.
     parser = ArgumentParser(description='File generation utility.')
-    parser.add_argument('--min', dest='min', type=int, required=True,
-                        help='minimum file size in KB')
-    parser.add_argument('--max', dest='max', type=int, required=True,
-                        help='max file size in KB')
+    parser.add_argument('--min', dest='min', type=int, required=False,
+                        default=None, help='minimum file size in KB')
+    parser.add_argument('--max', dest='max', type=int, required=False,
+                        default=None, help='max file size in KB')
+    parser.add_argument('--dist', dest='dist', type=str, required=False,
+                        default='uniform', help='file size distribution: '
+                        'uniform (between --min and --max), '
+                        'lognormal:MEDIAN[,SIGMA], pareto:ALPHA or '
+                        'hist:FILE with lines of "LOW HIGH WEIGHT" in KB, '
+                        'default is uniform')
     parser.add_argument('--qty', dest='qty', type=int, required=False,
                         default=-1, help='file count, default is infinite')
     parser.add_argument('--ftype', '-f', dest='ftype', type=int, required=True,
@@ -139,13 +267,31 @@ if __name__ == '__main__':
                         default=None, help='destination directory')
     parser.add_argument('--split', dest='split', type=int, required=False,
                         default=None, help='files per directory')
+    parser.add_argument('--tree', dest='shape', type=str, required=False,
+                        default=None, help='spread the files at random over '
+                        'a directory tree with these widths per level, e.g. '
+                        '4,64')
+    parser.add_argument('--seed', dest='seed', type=int, required=False,
+                        default=None, help='seed of the sizes and placement, '
+                        'for a reproducible file set')
     parser.add_argument('--bs', dest='bs', type=int, required=False,
                         default=1024, help='IO record size')
     args = parser.parse_args()
+    if args.dist.partition(':')[0] not in DISTS:
+        parser.error('--dist must be one of %s' % ', '.join(DISTS))
+    if args.dist == 'uniform' and (args.min is None or args.max is None):
+        parser.error('uniform sizes require --min and --max')
+    if args.shape and args.split:
+        parser.error('--tree excludes --split')
+    shape = None
+    if args.shape:
+        shape = [int(w) for w in args.shape.split(',')]
 
     try:
         filegen(args.min, args.max, args.qty, args.ftype, args.bs, args.dst,
-                args.split)
+                args.split, args.dist, shape, args.seed)
+    except ValueError as e:
+        sys.exit(str(e))
     except KeyboardInterrupt:
         print ""
         sys.exit("Killed by user.")
@@ -21,9 +21,11 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import time
 import argparse
 import threading
 from random import randint
+from pyio import instrument, load_hook, flush, FdPool
 
 
 alive = True
@@ -48,37 +50,55 @@ def walk(root):
     return f
 
 
-def fstat(files):
+def fstat(files, pool=None, done=None):
     """
     Fstat a random file.
 
     Inputs:
-        files (list): File list
+        files  (list): File list
+        pool (FdPool): Keep files open in this pool
+        done   (list): Single element list counting the fstat calls
     Outputs:
         None
     """
     # thr_id = threading.current_thread()
     count = len(files) - 1
+    done = done or [0]
+    open_ = instrument(os.open, 'open')
+    fstat_ = instrument(os.fstat, 'fstat')
+    close = instrument(os.close, 'close')
 
     while alive:
         f = files[randint(0, count)]
         # print "%s %s" % (thr_id, f)
-        try:
-            fh = os.open(f, os.O_RDONLY)
-            os.fstat(fh)
-        except:
-            raise
-        finally:
-            os.close(fh)
-
-
-def main(root, thr_ct):
+        if pool is not None:
+            fh = pool.acquire(f)
+            try:
+                fstat_(fh)
+            except:
+                raise
+            finally:
+                pool.release(f, fh)
+        else:
+            fh = open_(f, os.O_RDONLY)
+            try:
+                fstat_(fh)
+            except:
+                raise
+            finally:
+                close(fh)
+        done[0] += 1
+
+
+def main(root, thr_ct, keep_open=None):
     """
     Infinite fstat loop.
 
     Inputs:
-        root   (str): Root directory
-        thr_ct (int): Thread count
+        root      (str): Root directory
+        thr_ct    (int): Thread count
+        keep_open (int): Keep up to this many files open, 0 for the
+                         RLIMIT_NOFILE limit, None to open per fstat
     Outputs:
         NA
     """
@@ -86,13 +106,21 @@ def main(root, thr_ct):
     # Walk directory
     files = walk(root)
 
+    pool = None
+    if keep_open is not None:
+        pool = FdPool(keep_open or None)
+        print "Keeping up to %d files open." % pool.size
+
     print "Starting %d fstat threads." % thr_ct
     print "Use CTRL-C to exit."
 
     # Start threads
     thrs = []
+    counts = []
+    start = time.time()
     for i in range(thr_ct):
-        t = threading.Thread(target=fstat, args=([files]))
+        counts.append([0])
+        t = threading.Thread(target=fstat, args=(files, pool, counts[-1]))
         t.start()
         thrs.append(t)
 
@@ -106,6 +134,17 @@ def main(root, thr_ct):
     # Wait for threads to finish
     for t in thrs:
         t.join()
+    elapsed = time.time() - start
+    flush()
+
+    total = sum(c[0] for c in counts)
+    print "Issued %d fstats in %.1f s, %.1f fstats/s." % (total, elapsed,
+                                                         total / elapsed)
+    if pool is not None:
+        print "Pool hits %d misses %d evictions %d." % (pool.hits,
+                                                        pool.misses,
+                                                        pool.evictions)
+        pool.close()
 
 
 if __name__ == "__main__":
@@ -114,5 +153,14 @@ if __name__ == "__main__":
                         help='Root directory')
     parser.add_argument('--threads', '-t', dest='thr_ct', type=int,
                         required=False, default=1, help='Thread count')
+    parser.add_argument('--hook', dest='hook', type=str, required=False,
+                        default=None, help='Instrumentation hook as '
+                        'module:function')
+    parser.add_argument('--keep-open', dest='keep_open', type=int, nargs='?',
+                        const=0, default=None, help='Keep up to N files '
+                        'open rather than opening one per fstat, default N '
+                        'is derived from RLIMIT_NOFILE')
     args = parser.parse_args()
-    main(args.dir, args.thr_ct)
+    if args.hook:
+        load_hook(args.hook)
+    main(args.dir, args.thr_ct, args.keep_open)
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+
+"""
+iotrace.py
+
+IO trace recording, conversion and replay.
+
+A trace is a list of fixed size records of operation, file id, offset, size
+and time, packed into a single byte array, plus the path of each file id.
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import time
+import struct
+import threading
+from bisect import bisect
+import pyio
+
+# Operations, the index is the op code of a record
+OPS = ('open', 'close', 'read', 'write', 'fsync', 'fdatasync', 'fstat',
+       'stat', 'lstat', 'unlink')
+_OPCODES = dict((op, code) for code, op in enumerate(OPS))
+
+# op code, file id, offset, size, time in seconds since the first record
+RECORD = struct.Struct('<BxxxIqqd')
+_MAGIC = 'PYIOTRC1'
+_HEADER = struct.Struct('<II')
+_PATHLEN = struct.Struct('<H')
+
+
+class Trace(object):
+    """
+    An IO trace.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self._fids = {}
+        self.records = bytearray()
+
+    def fid(self, path):
+        """
+        The file id of a path, assigned on first use.
+
+        Args:
+            path (str): File path
+        Returns:
+            fid (int): File id
+        """
+        try:
+            return self._fids[path]
+        except KeyError:
+            fid = self._fids[path] = len(self.paths)
+            self.paths.append(path)
+            return fid
+
+    def add(self, op, path, offset, nbytes, ts):
+        """
+        Append a record.
+
+        Args:
+            op (str): Operation, see OPS
+            path (str): File path
+            offset (int): Offset in bytes
+            nbytes (int): Size in bytes
+            ts (float): Time in seconds since the start of the trace
+        """
+        self.records.extend(RECORD.pack(_OPCODES[op], self.fid(path), offset,
+                                        nbytes, ts))
+
+    def __len__(self):
+        return len(self.records) // RECORD.size
+
+    def __iter__(self):
+        """
+        Iterate over the records as (op, fid, offset, size, time) tuples.
+        """
+        unpack = RECORD.unpack_from
+        records = self.records
+        for pos in xrange(0, len(records), RECORD.size):
+            code, fid, offset, nbytes, ts = unpack(records, pos)
+            yield OPS[code], fid, offset, nbytes, ts
+
+    def save(self, fname):
+        """
+        Write the trace to a file.
+
+        Args:
+            fname (str): File name
+        """
+        with open(fname, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(_HEADER.pack(len(self.paths), len(self)))
+            for path in self.paths:
+                f.write(_PATHLEN.pack(len(path)))
+                f.write(path)
+            f.write(self.records)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Read a trace from a file.
+
+        Args:
+            fname (str): File name
+        Returns:
+            trace (Trace): Trace
+        """
+        trace = cls()
+        with open(fname, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not a trace' % fname)
+            path_ct, record_ct = _HEADER.unpack(f.read(_HEADER.size))
+            for i in xrange(path_ct):
+                n, = _PATHLEN.unpack(f.read(_PATHLEN.size))
+                trace.fid(f.read(n))
+            trace.records = bytearray(f.read(record_ct * RECORD.size))
+        if len(trace) != record_ct:
+            raise ValueError('%s is truncated' % fname)
+        return trace
+
+
+class Recorder(object):
+    """
+    A pyio hook that records the operations of the engines, e.g.
+
+        recorder = Recorder()
+        pyio.hook(recorder)
+        pyio.r_seq(fname, 64)
+        pyio.unhook(recorder)
+        recorder.trace().save('r_seq.trc')
+
+    Each delivered batch is resolved and packed into trace records as it
+    arrives, so a long recording holds one fixed size record per operation
+    rather than the events themselves.
+
+    Args:
+        root (str): Record paths relative to this directory
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        self._trace = Trace()
+        # fd -> ([open times], [[path, position], ...]) of every open of
+        # the descriptor, sorted by time
+        self._fds = {}
+        self._lock = threading.Lock()
+
+    def _path(self, path):
+        if self.root is None:
+            return path
+        return os.path.relpath(path, self.root)
+
+    def _file(self, fd, ts):
+        """
+        The [path, position] of the open of a descriptor in effect at a
+        time. The batches of different threads arrive in any order but
+        those of a thread in order, so the open of a descriptor a thread
+        uses has always been seen, even after another thread reused it.
+        """
+        opens = self._fds.get(fd)
+        if opens is None:
+            return None
+        i = bisect(opens[0], ts)
+        return opens[1][i - 1] if i else None
+
+    def __call__(self, events):
+        with self._lock:
+            trace = self._trace
+            for op, fd, offset, nbytes, err, ts, end, path in events:
+                # Failed operations are not replayed
+                if err:
+                    continue
+                # Block size mixes name their operations e.g. read:4K
+                op = op.partition(':')[0]
+                if op == 'copy':
+                    # A kernel copy is accounted to its destination
+                    op = 'write'
+                if op == 'open':
+                    ent = [self._path(path), 0]
+                    times, opens = self._fds.setdefault(fd, ([], []))
+                    i = bisect(times, ts)
+                    times.insert(i, ts)
+                    opens.insert(i, ent)
+                    trace.add(op, ent[0], 0, 0, ts)
+                    continue
+                if op in ('stat', 'lstat', 'unlink') and path is not None:
+                    trace.add(op, self._path(path), 0, 0, ts)
+                    continue
+                if op not in _OPCODES and op != 'seek':
+                    continue
+                ent = self._file(fd, ts)
+                if ent is None:
+                    continue
+                if op == 'seek':
+                    ent[1] = offset
+                elif op in ('read', 'write'):
+                    if offset < 0:
+                        offset = ent[1]
+                        ent[1] += nbytes
+                    trace.add(op, ent[0], offset, nbytes, ts)
+                else:
+                    trace.add(op, ent[0], 0, 0, ts)
+
+    def trace(self):
+        """
+        Build the trace of the recorded events, ordered by start time and
+        timed from the first operation.
+
+        Returns:
+            trace (Trace): Trace
+        """
+        with self._lock:
+            src = self._trace
+            unpack = RECORD.unpack_from
+            order = sorted(xrange(0, len(src.records), RECORD.size),
+                           key=lambda pos: unpack(src.records, pos)[4])
+            trace = Trace()
+            trace.paths = list(src.paths)
+            trace._fids = dict(src._fids)
+            start = unpack(src.records, order[0])[4] if order else 0.0
+            for pos in order:
+                code, fid, offset, nbytes, ts = unpack(src.records, pos)
+                trace.records.extend(RECORD.pack(code, fid, offset, nbytes,
+                                                 ts - start))
+        return trace
+
+
+def _split_args(args):
+    """
+    Split strace call arguments at the top level commas.
+
+    Args:
+        args (str): Arguments
+    Returns:
+        args (list): Arguments
+    """
+    out = []
+    depth = 0
+    quoted = False
+    escaped = False
+    start = 0
+    for i, c in enumerate(args):
+        if quoted:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                quoted = False
+        elif c == '"':
+            quoted = True
+        elif c in '{[(':
+            depth += 1
+        elif c in '}])':
+            depth -= 1
+        elif c == ',' and not depth:
+            out.append(args[start:i].strip())
+            start = i + 1
+    out.append(args[start:].strip())
+    return out
+
+
+def _unquote(arg):
+    """
+    Decode an strace string argument.
+
+    Args:
+        arg (str): Quoted string
+    Returns:
+        s (str): String
+    """
+    return arg.strip('.')[1:-1].decode('string_escape')
+
+
+def _strace_time(ts):
+    """
+    Parse an strace -tt or -ttt timestamp.
+
+    Args:
+        ts (str): Timestamp or None
+    Returns:
+        ts (float): Seconds
+    """
+    if not ts:
+        return 0.0
+    if ':' in ts:
+        h, m, s = ts.split(':')
+        return int(h) * 3600 + int(m) * 60 + float(s)
+    return float(ts)
+
+
+_STRACE = re.compile(r'^(?:\[pid\s+(?P<pid>\d+)\]\s+|(?P<pid2>\d+)\s+)?'
+                     r'(?P<ts>\d+:\d+:\d+\.\d+|\d+\.\d+)?\s*(?P<rest>.*)$')
+_CALL = re.compile(r'^(?P<call>\w+)\((?P<args>.*)\)\s+=\s+(?P<ret>-?\d+)')
+_RESUMED = re.compile(r'^<\.\.\. (?P<call>\w+) resumed>(?P<rest>.*)$')
+
+_READS = ('read', 'readv')
+_PREADS = ('pread64', 'pread', 'preadv', 'preadv2')
+_WRITES = ('write', 'writev')
+_PWRITES = ('pwrite64', 'pwrite', 'pwritev', 'pwritev2')
+_STATS = ('stat', 'stat64', 'lstat', 'lstat64', 'newfstatat', 'fstatat64',
+          'statx')
+
+
+def from_strace(lines, root=None):
+    """
+    Convert the text output of strace into a trace, e.g. of
+
+        strace -f -tt -e trace=file,desc -o app.strace app
+
+    Calls split by -f into unfinished and resumed lines are joined. File
+    positions are tracked through reads, writes and lseek. Relative
+    timestamps (-r) are not supported, without timestamps every record is
+    at time 0 and the trace can only be replayed as fast as possible.
+
+    Args:
+        lines (iterable): strace output lines
+        root (str): Record paths relative to this directory
+    Returns:
+        trace (Trace): Trace
+    """
+    trace = Trace()
+    start = None
+    # pid -> (time, call text) of unfinished calls
+    unfinished = {}
+    # fd -> [path, position]
+    fds = {}
+
+    def rel(path):
+        return path if root is None else os.path.relpath(path, root)
+
+    for line in lines:
+        m = _STRACE.match(line.rstrip('\n'))
+        pid = m.group('pid') or m.group('pid2')
+        ts = _strace_time(m.group('ts'))
+        rest = m.group('rest')
+        if rest.endswith('<unfinished ...>'):
+            unfinished[pid] = (ts, rest[:-len('<unfinished ...>')])
+            continue
+        resumed = _RESUMED.match(rest)
+        if resumed:
+            if pid not in unfinished:
+                continue
+            ts, head = unfinished.pop(pid)
+            rest = head + resumed.group('rest')
+        m = _CALL.match(rest)
+        if m is None:
+            continue
+        call = m.group('call')
+        ret = int(m.group('ret'))
+        if ret < 0:
+            continue
+        args = _split_args(m.group('args'))
+        if start is None:
+            start = ts
+        ts -= start
+
+        if call in ('open', 'creat'):
+            fds[ret] = [rel(_unquote(args[0])), 0]
+            trace.add('open', fds[ret][0], 0, 0, ts)
+        elif call in ('openat', 'openat2'):
+            fds[ret] = [rel(_unquote(args[1])), 0]
+            trace.add('open', fds[ret][0], 0, 0, ts)
+        elif call in _STATS:
+            path = _unquote(args[1] if 'at' in call or call == 'statx'
+                            else args[0])
+            if not path:
+                # fstat as glibc issues it, newfstatat(fd, "", ...,
+                # AT_EMPTY_PATH)
+                if 'AT_EMPTY_PATH' in rest:
+                    try:
+                        ent = fds[int(args[0])]
+                    except (ValueError, KeyError):
+                        continue
+                    trace.add('fstat', ent[0], 0, 0, ts)
+                continue
+            nofollow = call.startswith('lstat') or 'NOFOLLOW' in rest
+            trace.add('lstat' if nofollow else 'stat', rel(path), 0, 0, ts)
+        elif call in ('unlink', 'unlinkat'):
+            trace.add('unlink', rel(_unquote(args[-2] if call == 'unlinkat'
+                                             else args[0])), 0, 0, ts)
+        else:
+            try:
+                ent = fds[int(args[0])]
+            except (ValueError, KeyError):
+                continue
+            if call in _READS or call in _WRITES:
+                op = 'read' if call in _READS else 'write'
+                trace.add(op, ent[0], ent[1], ret, ts)
+                ent[1] += ret
+            elif call in _PREADS or call in _PWRITES:
+                op = 'read' if call in _PREADS else 'write'
+                trace.add(op, ent[0], int(args[3]), ret, ts)
+            elif call in ('lseek', '_llseek'):
+                ent[1] = ret
+            elif call == 'close':
+                trace.add('close', ent[0], 0, 0, ts)
+                del fds[int(args[0])]
+            elif call in ('fsync', 'fdatasync', 'fstat', 'fstat64'):
+                trace.add({'fstat64': 'fstat'}.get(call, call), ent[0], 0,
+                          0, ts)
+    return trace
+
+
+def replay(trace, root=None, speed=1.0, thr_ct=1, stats=None):
+    """
+    Replay a trace.
+
+    Files are dealt to the threads by file id so the operations on a file
+    keep their order. A read or write on a file that is not open opens it,
+    so traces may start mid-stream. Files the trace writes to are opened
+    read-write and created if needed, with their directories, others are
+    opened read-only. Written data is zeros.
+
+    Args:
+        trace (Trace): Trace
+        root (str): Resolve the trace paths relative to this directory
+        speed (float): Replay speed relative to the original timing, 0 to
+                       replay as fast as possible
+        thr_ct (int): Thread count
+        stats (Stats): Statistics
+    Returns:
+        ops (int): Operations replayed
+        elapsed (float): Wall clock time in seconds
+        lag (float): Largest delay behind the schedule in seconds
+    """
+    if root is not None:
+        paths = [os.path.join(root, p.lstrip('/')) for p in trace.paths]
+    else:
+        paths = list(trace.paths)
+    work = [[] for i in range(thr_ct)]
+    written = set()
+    for rec in trace:
+        work[rec[1] % thr_ct].append(rec)
+        if rec[0] == 'write':
+            written.add(rec[1])
+    for fid in written:
+        pyio.mkdirs(os.path.dirname(paths[fid]) or '.')
+    lags = [0.0] * thr_ct
+    start = [0.0]
+
+    def replayer(idx, thr_stats):
+        open_ = pyio.instrument(os.open, 'open', thr_stats)
+        close = pyio.instrument(os.close, 'close', thr_stats)
+        pread = pyio.instrument(pyio.pread, 'read', thr_stats, 2)
+        pwrite = pyio.instrument(pyio.pwrite, 'write', thr_stats, 2)
+        calls = {
+            'fsync': pyio.instrument(os.fsync, 'fsync', thr_stats),
+            'fdatasync': pyio.instrument(os.fdatasync, 'fdatasync',
+                                         thr_stats),
+            'fstat': pyio.instrument(os.fstat, 'fstat', thr_stats),
+            'stat': pyio.instrument(os.stat, 'stat', thr_stats),
+            'lstat': pyio.instrument(os.lstat, 'lstat', thr_stats),
+            'unlink': pyio.instrument(os.unlink, 'unlink', thr_stats),
+        }
+        bufs = {}
+        fds = {}
+        try:
+            for op, fid, offset, nbytes, ts in work[idx]:
+                if speed:
+                    delay = start[0] + ts / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif -delay > lags[idx]:
+                        lags[idx] = -delay
+                if op in ('stat', 'lstat', 'unlink'):
+                    try:
+                        calls[op](paths[fid])
+                    except OSError:
+                        pass
+                    continue
+                fd = fds.get(fid)
+                if fd is None:
+                    if fid in written:
+                        flags = os.O_RDWR | os.O_CREAT
+                    else:
+                        flags = os.O_RDONLY
+                    fd = fds[fid] = open_(paths[fid], flags)
+                if op == 'open':
+                    continue
+                if op == 'close':
+                    close(fds.pop(fid))
+                elif op == 'read':
+                    pread(fd, nbytes, offset)
+                elif op == 'write':
+                    buf = bufs.get(nbytes)
+                    if buf is None:
+                        buf = bufs[nbytes] = '\0' * nbytes
+                    pwrite(fd, buf, offset)
+                else:
+                    calls[op](fd)
+        finally:
+            for fd in fds.itervalues():
+                os.close(fd)
+
+    start[0] = time.time()
+    elapsed = pyio._run_thrs(replayer, thr_ct, stats)
+    return len(trace), elapsed, max(lags)
@@ -21,10 +21,57 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import sys
+import mmap
+import stat
+import time
 import errno
+import resource
+import threading
 import random
+import zlib
+import hashlib
+from Queue import Queue
+from array import array
+from bisect import bisect
 from itertools import cycle
 from math import ceil
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (ImportError, OSError):
+    _libc = None
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+try:
+    import xxhash as _xxhash
+except ImportError:
+    _xxhash = None
+from stats import Stats, Intervals, SteadyState, SharedStats, usage
+
+# posix_fadvise(2) advice
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+POSIX_FADV_NOREUSE = 5
+
+# sync_file_range(2) flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# lseek(2) whence values of the hole interface, Linux values where the os
+# module lacks them
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# open(2) flag, Linux value where the os module lacks it
+O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0200000)
 
 
 def seed(x):
@@ -37,6 +84,1577 @@ def seed(x):
     random.seed(x)
 
 
+def _libc_func(name, restype, *argtypes):
+    """
+    Look up a C library function.
+
+    Args:
+        name (str): Function name
+        restype (ctypes type): Return type
+        argtypes (ctypes types): Argument types
+    Returns:
+        func (ctypes function): Function or None if it is not available
+    """
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+
+def _check(ret):
+    """
+    Raise OSError if a C library call failed.
+
+    Args:
+        ret (int): C library call return value
+    Returns:
+        ret (int): C library call return value
+    """
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+if _libc is not None:
+    class _iovec(ctypes.Structure):
+        """
+        struct iovec
+        """
+        _fields_ = [('iov_base', ctypes.c_void_p),
+                    ('iov_len', ctypes.c_size_t)]
+
+    _c_preadv = _libc_func('preadv', ctypes.c_ssize_t, ctypes.c_int,
+                           ctypes.POINTER(_iovec), ctypes.c_int,
+                           ctypes.c_int64)
+    _c_pwritev = _libc_func('pwritev', ctypes.c_ssize_t, ctypes.c_int,
+                            ctypes.POINTER(_iovec), ctypes.c_int,
+                            ctypes.c_int64)
+    _c_sync_file_range = _libc_func('sync_file_range', ctypes.c_int,
+                                    ctypes.c_int, ctypes.c_int64,
+                                    ctypes.c_int64, ctypes.c_uint)
+    _c_pread = _libc_func('pread', ctypes.c_ssize_t, ctypes.c_int,
+                          ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64)
+    _c_pwrite = _libc_func('pwrite', ctypes.c_ssize_t, ctypes.c_int,
+                           ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64)
+    _c_posix_fadvise = _libc_func('posix_fadvise', ctypes.c_int,
+                                  ctypes.c_int, ctypes.c_int64,
+                                  ctypes.c_int64, ctypes.c_int)
+    _c_readahead = _libc_func('readahead', ctypes.c_ssize_t, ctypes.c_int,
+                              ctypes.c_int64, ctypes.c_size_t)
+    _c_mmap = _libc_func('mmap', ctypes.c_void_p, ctypes.c_void_p,
+                         ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                         ctypes.c_int, ctypes.c_int64)
+    _c_munmap = _libc_func('munmap', ctypes.c_int, ctypes.c_void_p,
+                           ctypes.c_size_t)
+    _c_mincore = _libc_func('mincore', ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t, ctypes.c_void_p)
+    _c_copy_file_range = _libc_func('copy_file_range', ctypes.c_ssize_t,
+                                    ctypes.c_int,
+                                    ctypes.POINTER(ctypes.c_int64),
+                                    ctypes.c_int,
+                                    ctypes.POINTER(ctypes.c_int64),
+                                    ctypes.c_size_t, ctypes.c_uint)
+    _c_sendfile = _libc_func('sendfile', ctypes.c_ssize_t, ctypes.c_int,
+                             ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                             ctypes.c_size_t)
+    _c_openat = _libc_func('openat', ctypes.c_int, ctypes.c_int,
+                           ctypes.c_char_p, ctypes.c_int, ctypes.c_uint)
+else:
+    _c_sync_file_range = _c_pread = _c_pwrite = None
+    _c_posix_fadvise = _c_readahead = None
+    _c_mmap = _c_munmap = _c_mincore = None
+    _c_preadv = _c_pwritev = None
+    _c_copy_file_range = _c_sendfile = None
+    _c_openat = None
+
+# Errors of a kernel copy that mean it is not supported between two files
+_NO_OFFLOAD = frozenset([errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                         errno.EOPNOTSUPP, errno.EBADF])
+
+
+def fadvise(fd, offset, nbytes, advice):
+    """
+    Announce an access pattern for file data.
+
+    Args:
+        fd (int): File descriptor
+        offset (int): Range offset in bytes
+        nbytes (int): Range length in bytes, 0 for through end of file
+        advice (int): POSIX_FADV_* advice
+    """
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise(fd, offset, nbytes, advice)
+    if _c_posix_fadvise is None:
+        raise OSError(errno.ENOSYS, 'posix_fadvise is not supported')
+    # posix_fadvise returns the error number rather than setting errno
+    err = _c_posix_fadvise(fd, offset, nbytes, advice)
+    if err:
+        raise OSError(err, os.strerror(err))
+
+
+def readahead(fd, offset, nbytes):
+    """
+    Populate the page cache with file data (Linux only).
+
+    Args:
+        fd (int): File descriptor
+        offset (int): Range offset in bytes
+        nbytes (int): Range length in bytes
+    """
+    if _c_readahead is None:
+        raise OSError(errno.ENOSYS, 'readahead is not supported')
+    _check(_c_readahead(fd, offset, nbytes))
+
+
+def sync_file_range(fd, offset, nbytes, flags):
+    """
+    Initiate and/or wait for write out of a file range (Linux only).
+
+    Args:
+        fd (int): File descriptor
+        offset (int): Range offset in bytes
+        nbytes (int): Range length in bytes, 0 for through end of file
+        flags (int): SYNC_FILE_RANGE_* flags
+    """
+    if _c_sync_file_range is None:
+        raise OSError(errno.ENOSYS, 'sync_file_range is not supported')
+    _check(_c_sync_file_range(fd, offset, nbytes, flags))
+
+
+def pread(fd, n, offset):
+    """
+    Read from a file descriptor at an offset without moving the file
+    position.
+
+    Args:
+        fd (int): File descriptor
+        n (int): Bytes to read
+        offset (int): Offset in bytes
+    Returns:
+        buf (str): Buffer
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(fd, n, offset)
+    if _c_pread is None:
+        os.lseek(fd, offset, 0)
+        return os.read(fd, n)
+    buf = ctypes.create_string_buffer(n)
+    return buf.raw[:_check(_c_pread(fd, buf, n, offset))]
+
+
+def pwrite(fd, buf, offset):
+    """
+    Write to a file descriptor at an offset without moving the file
+    position.
+
+    Args:
+        fd (int): File descriptor
+        buf (str): Buffer
+        offset (int): Offset in bytes
+    Returns:
+        n (int): Bytes written
+    """
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, buf, offset)
+    if _c_pwrite is None:
+        os.lseek(fd, offset, 0)
+        return os.write(fd, buf)
+    return _check(_c_pwrite(fd, buf, len(buf), offset))
+
+
+def copy_file_range(fdsrc, fddst, offset, nbytes):
+    """
+    Copy a range between two files in the kernel, without moving either
+    file position (Linux only).
+
+    Args:
+        fdsrc (int): Source file descriptor
+        fddst (int): Destination file descriptor
+        offset (int): Offset in bytes, the same in both files
+        nbytes (int): Bytes to copy
+    Returns:
+        n (int): Bytes copied, 0 at end of the source file
+    """
+    if _c_copy_file_range is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range is not supported')
+    off_in = ctypes.c_int64(offset)
+    off_out = ctypes.c_int64(offset)
+    return _check(_c_copy_file_range(fdsrc, ctypes.byref(off_in), fddst,
+                                     ctypes.byref(off_out), nbytes, 0))
+
+
+def sendfile(fddst, fdsrc, offset, nbytes):
+    """
+    Copy from a file at an offset to the current position of another file
+    in the kernel.
+
+    Args:
+        fddst (int): Destination file descriptor
+        fdsrc (int): Source file descriptor
+        offset (int): Source offset in bytes
+        nbytes (int): Bytes to copy
+    Returns:
+        n (int): Bytes copied, 0 at end of the source file
+    """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(fddst, fdsrc, offset, nbytes)
+    if _c_sendfile is None:
+        raise OSError(errno.ENOSYS, 'sendfile is not supported')
+    off = ctypes.c_int64(offset)
+    return _check(_c_sendfile(fddst, fdsrc, ctypes.byref(off), nbytes))
+
+
+def openat(dirfd, name, flags, mode=0777):
+    """
+    Open a file relative to an open directory, so that only the last path
+    component is resolved.
+
+    Args:
+        dirfd (int): Directory file descriptor
+        name (str): File name within the directory
+        flags (int): Open flags
+        mode (int): Mode of a created file
+    Returns:
+        fd (int): File descriptor
+    """
+    if os.open in getattr(os, 'supports_dir_fd', ()):
+        return os.open(name, flags, mode, dir_fd=dirfd)
+    if _c_openat is None:
+        raise OSError(errno.ENOSYS, 'openat is not supported')
+    return _check(_c_openat(dirfd, name, flags, mode))
+
+
+def _copy_range(fddst, fdsrc, offset, nbytes):
+    """
+    copy_file_range with the argument order of sendfile.
+
+    Args:
+        fddst (int): Destination file descriptor
+        fdsrc (int): Source file descriptor
+        offset (int): Source offset
+        nbytes (int): Number of bytes to copy
+    Returns:
+        n (int): Number of bytes copied
+    """
+    return copy_file_range(fdsrc, fddst, offset, nbytes)
+
+
+def evict(fname):
+    """
+    Evict the cached pages of a file.
+
+    Dirty pages are written out first since POSIX_FADV_DONTNEED does not
+    drop them. Unlike dropping the global page cache this only affects the
+    given file and does not require root.
+
+    Args:
+        fname (str): File name
+    """
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+        fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    except:
+        raise
+    finally:
+        os.close(fd)
+
+
+def extents(fd, size):
+    """
+    Find the data extents of a file with SEEK_DATA and SEEK_HOLE, so that
+    holes can be skipped. Where the file system does not support them the
+    whole file is a single extent. The file position is left undefined.
+
+    Args:
+        fd (int): File descriptor
+        size (int): File size in bytes
+    Returns:
+        extents (list): List of (offset, length) tuples
+    """
+    found = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, err:
+            # ENXIO, no data beyond offset
+            if err.errno == errno.ENXIO:
+                break
+            if err.errno == errno.EINVAL and not offset:
+                return [(0, size)]
+            raise
+        if start >= size:
+            break
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        found.append((start, end - start))
+        offset = end
+    return found
+
+
+def resident(fname):
+    """
+    Count the pages of a file resident in the page cache.
+
+    Args:
+        fname (str): File name
+    Returns:
+        resident (int): Resident page count
+        pages (int): File page count
+    """
+    if _c_mincore is None or _c_mmap is None:
+        raise OSError(errno.ENOSYS, 'mincore is not supported')
+    page = mmap.PAGESIZE
+    size = os.stat(fname).st_size
+    pages = (size + page - 1) // page
+    if not size:
+        return 0, 0
+
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        addr = _c_mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            _check(-1)
+        try:
+            vec = (ctypes.c_ubyte * pages)()
+            _check(_c_mincore(addr, size, vec))
+        except:
+            raise
+        finally:
+            _c_munmap(addr, size)
+    except:
+        raise
+    finally:
+        os.close(fd)
+    return sum(b & 1 for b in vec), pages
+
+
+def evict_files(fnames):
+    """
+    Evict several files and count their resident pages before and after.
+
+    Args:
+        fnames (iterable): File names
+    Returns:
+        before (int): Resident page count before eviction
+        after (int): Resident page count after eviction
+        pages (int): File page count
+    """
+    before = after = pages = 0
+    for fname in fnames:
+        count, total = resident(fname)
+        evict(fname)
+        before += count
+        after += resident(fname)[0]
+        pages += total
+    return before, after, pages
+
+
+# Zeros digested in place of the holes skipped by a sparse copy
+_ZEROS = '\0' * 65536
+
+
+class Digest(object):
+    """
+    A digest of file data computed while the data is in memory.
+
+    The data must be fed in file order. Offsets skipped between updates,
+    e.g. the holes of a sparse copy, are digested as zeros so that the
+    digest is the same as that of the whole file.
+
+    Args:
+        name (str): 'crc32', 'crc32c' (requires the crc32c module), 'xxhash'
+                    (requires the xxhash module) or 'sha256'
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pos = 0
+        self._crc = None
+        self._hash = None
+        self._value = 0
+        if name == 'crc32':
+            self._crc = zlib.crc32
+        elif name == 'crc32c':
+            if _crc32c is None:
+                raise ValueError('crc32c requires the crc32c module')
+            self._crc = _crc32c.crc32c
+        elif name == 'xxhash':
+            if _xxhash is None:
+                raise ValueError('xxhash requires the xxhash module')
+            self._hash = _xxhash.xxh64()
+        elif name == 'sha256':
+            self._hash = hashlib.sha256()
+        else:
+            raise ValueError('unknown digest %s' % name)
+
+    def _update(self, buf):
+        """
+        Digest data at the current position.
+        """
+        if self._crc is not None:
+            self._value = self._crc(buf, self._value)
+        else:
+            self._hash.update(buf)
+        self.pos += len(buf)
+
+    def _skip(self, offset):
+        """
+        Digest zeros up to an offset.
+        """
+        while self.pos < offset:
+            self._update(_ZEROS[:offset - self.pos])
+
+    def update(self, buf, offset=None):
+        """
+        Add data.
+
+        Args:
+            buf (str|buffer): Data
+            offset (int): File offset of the data, default is where the
+                          previous update ended
+        """
+        if offset is not None:
+            self._skip(offset)
+        self._update(buf)
+
+    def hexdigest(self, size=0):
+        """
+        The digest.
+
+        Args:
+            size (int): File size, a trailing hole up to it is digested as
+                        zeros
+        Returns:
+            digest (str): Hexadecimal digest
+        """
+        self._skip(size)
+        if self._crc is not None:
+            return '%08x' % (self._value & 0xffffffff)
+        return self._hash.hexdigest()
+
+
+def checksum(fname, blksz, digest='crc32', stats=None):
+    """
+    Read a file sequentially and compute its digest.
+
+    Args:
+        fname (str): File name
+        blksz (int): Block size in KB
+        digest (str): Digest algorithm, see Digest
+        stats (Stats): Statistics
+    Returns:
+        digest (str): Hexadecimal digest
+    """
+    blksz *= 1024
+    h = Digest(digest)
+    io = _io(stats)
+    fd = io.open(fname, os.O_RDONLY)
+    try:
+        while True:
+            buf = io.read(fd, blksz)
+            if not buf:
+                break
+            h.update(buf)
+    except:
+        raise
+    finally:
+        io.close(fd)
+    return h.hexdigest()
+
+
+def write_manifest(fname, digest, entries):
+    """
+    Write a manifest of file digests.
+
+    The first line names the digest algorithm, each following line holds
+    the digest, size and path of a file relative to the tree root.
+
+    Args:
+        fname (str): Manifest file name
+        digest (str): Digest algorithm
+        entries (list): List of (path, digest, size) tuples
+    """
+    with open(fname, 'w') as f:
+        f.write('# pyio manifest %s\n' % digest)
+        for path, hexdigest, size in sorted(entries):
+            f.write('%s %d %s\n' % (hexdigest, size, path))
+
+
+def read_manifest(fname):
+    """
+    Read a manifest written by write_manifest.
+
+    Args:
+        fname (str): Manifest file name
+    Returns:
+        digest (str): Digest algorithm
+        entries (list): List of (path, digest, size) tuples
+    """
+    with open(fname) as f:
+        header = f.readline().split()
+        if header[:3] != ['#', 'pyio', 'manifest'] or len(header) != 4:
+            raise ValueError('%s is not a manifest' % fname)
+        entries = []
+        for line in f:
+            hexdigest, size, path = line.rstrip('\n').split(' ', 2)
+            entries.append((path, hexdigest, int(size)))
+    return header[3], entries
+
+
+def verify(root, manifest, blksz, thr_ct=1, stats=None):
+    """
+    Verify a tree against a manifest with several threads, e.g. a copy
+    made by cp_tree, without rereading the source.
+
+    Args:
+        root (str): Tree root
+        manifest (str): Manifest file name
+        blksz (int): Block size in KB
+        thr_ct (int): Thread count
+        stats (Stats): Statistics
+    Returns:
+        bad (list): List of (path, reason) tuples, reason is 'missing',
+                    'size' or 'digest'
+    """
+    digest, entries = read_manifest(manifest)
+    entries = iter(entries)
+    lock = threading.Lock()
+    bad = []
+
+    def verifier(idx, thr_stats):
+        while True:
+            with lock:
+                entry = next(entries, None)
+            if entry is None:
+                break
+            path, hexdigest, size = entry
+            fname = os.path.join(root, path)
+            try:
+                if os.stat(fname).st_size != size:
+                    bad.append((path, 'size'))
+                    continue
+                if checksum(fname, blksz, digest, thr_stats) != hexdigest:
+                    bad.append((path, 'digest'))
+            except (OSError, IOError), err:
+                if err.errno != errno.ENOENT:
+                    raise
+                bad.append((path, 'missing'))
+
+    _run_thrs(verifier, thr_ct, stats)
+    return sorted(bad)
+
+
+def write_index(fname, digest, run, entries):
+    """
+    Write a scrub index atomically.
+
+    The first line names the digest algorithm and the scrub run count,
+    each following line holds the digest, size, mtime, inode and path of a
+    file relative to the tree root.
+
+    Args:
+        fname (str): Index file name
+        digest (str): Digest algorithm
+        run (int): Scrub run count
+        entries (dict): path -> (digest, size, mtime, inode), mtime is the
+                        repr of st_mtime
+    """
+    tmp = '%s.tmp' % fname
+    with open(tmp, 'w') as f:
+        f.write('# pyio index %s %d\n' % (digest, run))
+        for path in sorted(entries):
+            hexdigest, size, mtime, ino = entries[path]
+            f.write('%s %d %s %d %s\n' % (hexdigest, size, mtime, ino, path))
+    os.rename(tmp, fname)
+
+
+def read_index(fname):
+    """
+    Read a scrub index written by write_index.
+
+    Args:
+        fname (str): Index file name
+    Returns:
+        digest (str): Digest algorithm
+        run (int): Scrub run count
+        entries (dict): path -> (digest, size, mtime, inode)
+    """
+    with open(fname) as f:
+        header = f.readline().split()
+        if header[:3] != ['#', 'pyio', 'index'] or len(header) != 5:
+            raise ValueError('%s is not a scrub index' % fname)
+        entries = {}
+        for line in f:
+            hexdigest, size, mtime, ino, path = \
+                line.rstrip('\n').split(' ', 4)
+            entries[path] = (hexdigest, int(size), mtime, int(ino))
+    return header[3], int(header[4]), entries
+
+
+def _rolled(path, run, fraction):
+    """
+    Determine whether an unchanged file is due for a reread. Each path
+    hashes to a fixed point in [0, 1) and every run rereads the files in
+    the next window of fraction, so every file is reread once within
+    ceil(1 / fraction) runs.
+    """
+    if fraction >= 1:
+        return True
+    pos = (zlib.crc32(path) & 0xffffffff) / 4294967296.0
+    return (pos - run * fraction) % 1.0 < fraction
+
+
+def scrub(root, index, blksz, thr_ct=1, fraction=0.0, digest='crc32',
+          stats=None):
+    """
+    Incrementally scrub a tree with several threads.
+
+    Files that are new or whose size, mtime or inode differ from the index
+    are read and their digest is recorded. Of the unchanged files a
+    rolling fraction is reread and checked against the index, a digest
+    that differs although the file is unchanged is a mismatch, e.g. media
+    corruption. A file that cannot be read, e.g. with EIO, is reported too
+    and the pass goes on. Mismatched and unreadable files keep their
+    indexed entry so that they are reported or read again. The index is
+    created on the first run.
+
+    Args:
+        root (str): Tree root
+        index (str): Index file name
+        blksz (int): Block size in KB
+        thr_ct (int): Thread count
+        fraction (float): Fraction of unchanged files reread per run
+        digest (str): Digest algorithm of a new index, see Digest
+        stats (Stats): Statistics
+    Returns:
+        files (int): Files in the tree
+        changed (int): New or changed files read
+        rolled (int): Unchanged files reread
+        nbytes (int): Bytes read
+        elapsed (float): Read time in seconds
+        bad (list): List of (path, reason) tuples, reason is 'digest' or
+                    'error'
+    """
+    if not os.path.isdir(root):
+        raise ValueError('%s is not a directory' % root)
+    run = 0
+    old = {}
+    if os.path.exists(index):
+        digest, run, old = read_index(index)
+    # Fail early on an unavailable digest
+    Digest(digest)
+    skip = os.path.abspath(index)
+
+    entries = {}
+    work = []
+    changed = rolled = 0
+    for dname, dirs, fnames in os.walk(root):
+        for name in fnames:
+            fname = os.path.join(dname, name)
+            if os.path.abspath(fname) in (skip, skip + '.tmp'):
+                continue
+            st = os.lstat(fname)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            path = os.path.relpath(fname, root)
+            key = (st.st_size, repr(st.st_mtime), st.st_ino)
+            ent = old.get(path)
+            if ent is None or ent[1:] != key:
+                work.append((path, key, None))
+                changed += 1
+            elif _rolled(path, run, fraction):
+                work.append((path, key, ent[0]))
+                rolled += 1
+            else:
+                entries[path] = ent
+
+    work = iter(work)
+    lock = threading.Lock()
+    nbytes = [0] * thr_ct
+    bad = []
+
+    def scrubber(idx, thr_stats):
+        while True:
+            with lock:
+                item = next(work, None)
+            if item is None:
+                break
+            path, key, expect = item
+            try:
+                hexdigest = checksum(os.path.join(root, path), blksz, digest,
+                                     thr_stats)
+            except (OSError, IOError), err:
+                # Removed since the walk
+                if err.errno == errno.ENOENT:
+                    continue
+                bad.append((path, 'error'))
+                if path in old:
+                    entries[path] = old[path]
+                continue
+            nbytes[idx] += key[0]
+            if expect is not None and hexdigest != expect:
+                bad.append((path, 'digest'))
+                hexdigest = expect
+            entries[path] = (hexdigest,) + key
+
+    elapsed = _run_thrs(scrubber, thr_ct, stats)
+    write_index(index, digest, run + 1, entries)
+    return (len(entries), changed, rolled, sum(nbytes), elapsed,
+            sorted(bad))
+
+
+# Instrumentation hooks, see hook()
+_hooks = []
+_ring_size = [1024]
+_hooks_lock = threading.Lock()
+# (thread, _EventRing) tuples
+_rings = []
+_local = threading.local()
+_opcodes = {}
+_opnames = []
+
+# Operations whose integer return value is not a byte count
+_NOSIZE = frozenset(['open', 'seek'])
+
+# Event record fields
+_EVENT_FIELDS = 7
+
+
+class _EventRing(object):
+    """
+    Per thread ring buffer of instrumentation events.
+
+    Events are packed into a flat array of doubles and delivered to the
+    hooks in batches, so that hooks are not called once per operation.
+    The hooks run without the ring lock held, the delivery lock only keeps
+    the batches of the ring in order.
+
+    Args:
+        size (int): Event count
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.events = array('d', [0.0]) * (size * _EVENT_FIELDS)
+        self.paths = {}
+        self.n = 0
+        self.lock = threading.Lock()
+        self.deliver_lock = threading.RLock()
+
+    def add(self, op, fd, offset, nbytes, err, start, end, path):
+        """
+        Record an event, delivering the batch if the ring is full.
+        """
+        with self.lock:
+            ev = self.events
+            i = self.n * _EVENT_FIELDS
+            ev[i] = op
+            ev[i + 1] = fd
+            ev[i + 2] = offset
+            ev[i + 3] = nbytes
+            ev[i + 4] = err
+            ev[i + 5] = start
+            ev[i + 6] = end
+            if path is not None:
+                self.paths[self.n] = path
+            self.n += 1
+            full = self.n == self.size
+        if full:
+            self.flush()
+
+    def flush(self, blocking=True):
+        """
+        Deliver the pending events.
+
+        Args:
+            blocking (bool): Wait for a delivery in progress, otherwise
+                             leave the events to it
+        """
+        if not self.deliver_lock.acquire(blocking):
+            return
+        try:
+            with self.lock:
+                batch = self._take()
+            if batch:
+                _deliver(batch)
+        finally:
+            self.deliver_lock.release()
+
+    def _take(self):
+        """
+        Unpack and clear the pending events, the lock must be held.
+        """
+        if not self.n:
+            return None
+        ev = self.events
+        paths = self.paths
+        batch = []
+        for n in xrange(self.n):
+            i = n * _EVENT_FIELDS
+            batch.append((_opnames[int(ev[i])], int(ev[i + 1]),
+                          int(ev[i + 2]), int(ev[i + 3]), int(ev[i + 4]),
+                          ev[i + 5], ev[i + 6], paths.get(n)))
+        self.n = 0
+        self.paths = {}
+        return batch
+
+
+def _deliver(batch):
+    """
+    Call the hooks with a batch of events, without holding any lock so that
+    hooks may instrument, flush or start engines of their own.
+    """
+    with _hooks_lock:
+        hooks = list(_hooks)
+    _local.delivering = getattr(_local, 'delivering', 0) + 1
+    try:
+        for func in hooks:
+            func(batch)
+    finally:
+        _local.delivering -= 1
+
+
+def hook(func, size=1024):
+    """
+    Register an instrumentation hook.
+
+    The hook is called with a list of events, each a tuple of (op, fd,
+    offset, nbytes, errno, start, end, path). Offsets are -1 when the
+    operation does not take one, path is only set for path based
+    operations such as open. Events are buffered per thread and delivered
+    once size of them are pending or on flush(). Hooks may be called from
+    any thread and concurrently for different threads, but the batches of
+    a thread are delivered in order. Hooks are called without locks held
+    and may instrument, flush or run engines themselves.
+
+    Engines select their IO functions when they start, so a hook only
+    sees engines started after it was registered. Without hooks or
+    statistics the engines call the os module directly.
+
+    Args:
+        func (function): Hook, called as func(events)
+        size (int): Events buffered per thread
+    """
+    with _hooks_lock:
+        _hooks.append(func)
+        _ring_size[0] = size
+
+
+def unhook(func):
+    """
+    Unregister an instrumentation hook, delivering pending events first.
+
+    Args:
+        func (function): Hook
+    """
+    flush()
+    with _hooks_lock:
+        _hooks.remove(func)
+
+
+def flush():
+    """
+    Deliver the pending events of every thread to the hooks and drop the
+    rings of threads that have exited.
+    """
+    with _hooks_lock:
+        rings = list(_rings)
+    # Called from a hook, rings being delivered by other threads are left
+    # to them rather than waited for, which could deadlock
+    blocking = not getattr(_local, 'delivering', 0)
+    for thr, ring in rings:
+        ring.flush(blocking or thr is threading.current_thread())
+        if not thr.is_alive():
+            _drop_ring(thr, ring)
+
+
+def load_hook(spec):
+    """
+    Register a hook given as module:function, e.g. from a command line.
+
+    Args:
+        spec (str): Hook specification
+    Returns:
+        func (function): Hook
+    """
+    module, _, name = spec.partition(':')
+    func = getattr(__import__(module, fromlist=[name]), name)
+    hook(func)
+    return func
+
+
+def _ring():
+    """
+    Return the event ring of the current thread.
+
+    Returns:
+        ring (_EventRing): Event ring
+    """
+    try:
+        return _local.ring
+    except AttributeError:
+        ring = _local.ring = _EventRing(_ring_size[0])
+        with _hooks_lock:
+            _rings.append((threading.current_thread(), ring))
+        return ring
+
+
+def _drop_ring(thr, ring):
+    """
+    Forget the event ring of a thread.
+    """
+    with _hooks_lock:
+        try:
+            _rings.remove((thr, ring))
+        except ValueError:
+            pass
+
+
+def _release_ring():
+    """
+    Deliver the pending events of the current thread and drop its event
+    ring, called by worker threads once they are done.
+    """
+    ring = getattr(_local, 'ring', None)
+    if ring is None:
+        return
+    del _local.ring
+    ring.flush()
+    _drop_ring(threading.current_thread(), ring)
+
+
+def instrument(func, op, stats=None, offset=None, blksz=0):
+    """
+    Wrap an IO function so that each call is accounted in stats and
+    reported to the registered hooks.
+
+    The function is returned as is when there are no statistics and no
+    hooks so that the fast path carries no per operation overhead.
+
+    Args:
+        func (function): IO function, called with a file descriptor or path
+                         as its first argument
+        op (str): Operation name
+        stats (Stats): Statistics or None
+        offset (int): Index of the offset argument, if any
+        blksz (int): Block size in bytes of a vectored IO function, each
+                     block is accounted in stats as a separate operation
+    Returns:
+        func (function): IO function
+    """
+    if stats is None and not _hooks:
+        return func
+    with _hooks_lock:
+        if op not in _opcodes:
+            _opcodes[op] = len(_opnames)
+            _opnames.append(op)
+        code = _opcodes[op]
+    nosize = op in _NOSIZE
+    hooked = bool(_hooks)
+
+    def instrumented(*args):
+        start = time.time()
+        try:
+            ret = func(*args)
+        except (OSError, IOError), err:
+            if hooked:
+                fd = args[0] if type(args[0]) is int else -1
+                path = args[0] if type(args[0]) is str else None
+                _ring().add(code, fd, args[offset] if offset else -1, 0,
+                            err.errno or 0, start, time.time(), path)
+            raise
+        end = time.time()
+        if nosize or ret is None:
+            nbytes = 0
+        elif type(ret) is int:
+            nbytes = ret
+        elif type(ret) is str:
+            nbytes = len(ret)
+        else:
+            nbytes = 0
+        if stats is not None:
+            if blksz:
+                stats.add(op, nbytes, end - start,
+                          max((nbytes + blksz - 1) // blksz, 1))
+            else:
+                stats.add(op, nbytes, end - start)
+        if hooked:
+            if type(args[0]) is int:
+                fd = args[0]
+                path = None
+            else:
+                fd = ret if op == 'open' else -1
+                path = args[0]
+            _ring().add(code, fd, args[offset] if offset else -1, nbytes, 0,
+                        start, end, path)
+        return ret
+    return instrumented
+
+
+class _IO(object):
+    """
+    The IO functions of an engine, instrumented if required.
+
+    Args:
+        stats (Stats): Statistics or None
+    """
+
+    def __init__(self, stats=None):
+        self.open = instrument(os.open, 'open', stats)
+        self.close = instrument(os.close, 'close', stats)
+        self.read = instrument(os.read, 'read', stats)
+        self.write = instrument(os.write, 'write', stats)
+        self.lseek = instrument(os.lseek, 'seek', stats, 1)
+        self.fstat = instrument(os.fstat, 'fstat', stats)
+        self.pread = instrument(pread, 'read', stats, 2)
+        self.pwrite = instrument(pwrite, 'write', stats, 2)
+
+
+# Uninstrumented IO functions
+_RAW_IO = _IO()
+
+
+def _io(stats):
+    """
+    Select the IO functions of an engine.
+
+    Args:
+        stats (Stats): Statistics or None
+    Returns:
+        io (_IO): IO functions
+    """
+    if stats is None and not _hooks:
+        return _RAW_IO
+    return _IO(stats)
+
+
+class _Ring(object):
+    """
+    A ring of preallocated block buffers transferred with a single preadv
+    or pwritev call.
+
+    Args:
+        count (int): Buffer count
+        blksz (int): Block size in bytes
+    """
+
+    def __init__(self, count, blksz):
+        if _c_preadv is None or _c_pwritev is None:
+            raise OSError(errno.ENOSYS, 'preadv is not supported')
+        self.count = count
+        self.blksz = blksz
+        self.size = count * blksz
+        self.bufs = [ctypes.create_string_buffer(blksz) for i in range(count)]
+        self.iov = (_iovec * count)()
+        for iov, buf in zip(self.iov, self.bufs):
+            iov.iov_base = ctypes.addressof(buf)
+            iov.iov_len = blksz
+
+    def fill(self, data):
+        """
+        Copy data into the buffers, one block per buffer.
+
+        Args:
+            data (str): Data, at most count blocks
+        """
+        for i in range(0, len(data), self.blksz):
+            ctypes.memmove(self.bufs[i // self.blksz], data[i:], min(
+                self.blksz, len(data) - i))
+
+    def data(self, n):
+        """
+        The first n bytes of the buffers, without copying them.
+
+        Args:
+            n (int): Byte count
+        Returns:
+            bufs (list): List of buffer objects
+        """
+        return [buffer(buf, 0, min(self.blksz, n - i)) for i, buf in
+                zip(range(0, n, self.blksz), self.bufs)]
+
+    def _iovcnt(self, n):
+        """
+        Trim the iovec array to n bytes.
+
+        Args:
+            n (int): Byte count
+        Returns:
+            iovcnt (int): iovec count
+        """
+        iovcnt, rest = divmod(n, self.blksz)
+        for iov in self.iov[:iovcnt]:
+            iov.iov_len = self.blksz
+        if rest:
+            self.iov[iovcnt].iov_len = rest
+            iovcnt += 1
+        return iovcnt
+
+    def readv(self, fd, offset, n=None):
+        """
+        Fill the buffers from a file.
+
+        Args:
+            fd (int): File descriptor
+            offset (int): Offset in bytes
+            n (int): Bytes to read, default is the ring size
+        Returns:
+            n (int): Bytes read
+        """
+        return _check(_c_preadv(fd, self.iov, self._iovcnt(n or self.size),
+                                offset))
+
+    def writev(self, fd, n, offset):
+        """
+        Write the first n bytes of the buffers to a file.
+
+        Args:
+            fd (int): File descriptor
+            n (int): Bytes to write
+            offset (int): Offset in bytes
+        Returns:
+            n (int): Bytes written
+        """
+        done = _check(_c_pwritev(fd, self.iov, self._iovcnt(n), offset))
+        if done < n:
+            # Short write, finish the remainder a buffer at a time
+            data = ''.join(buf.raw for buf in self.bufs)[done:n]
+            while data:
+                ret = pwrite(fd, data, offset + done)
+                data = data[ret:]
+                done += ret
+        return done
+
+
+def _nop():
+    """
+    Do nothing.
+    """
+    pass
+
+
+class Durability(object):
+    """
+    Durability policy for the write and copy engines.
+
+    The engines accept a policy wherever they accept fsync. fsync=True is
+    the same as Durability(), a single fsync once IO is complete.
+
+    Args:
+        method (str): Sync call, 'fsync' or 'fdatasync'
+        blocks (int): Sync every N blocks written, 0 to disable
+        size (int): Sync every N KB written, 0 to disable
+        oflag (str): Open with 'dsync' (O_DSYNC) or 'sync' (O_SYNC)
+        behind (int): sync_file_range write-behind window in KB, 0 to
+                      disable
+        final (bool): Sync once after IO is complete
+    """
+
+    def __init__(self, method='fsync', blocks=0, size=0, oflag=None,
+                 behind=0, final=True):
+        if method not in ('fsync', 'fdatasync'):
+            raise ValueError('invalid sync method %s' % method)
+        if not hasattr(os, method):
+            raise ValueError('%s is not supported' % method)
+        if oflag not in (None, 'dsync', 'sync'):
+            raise ValueError('invalid open flag %s' % oflag)
+        if oflag and not hasattr(os, 'O_%s' % oflag.upper()):
+            raise ValueError('O_%s is not supported' % oflag.upper())
+        if behind and _c_sync_file_range is None:
+            raise ValueError('sync_file_range is not supported')
+        self.method = method
+        self.blocks = blocks
+        self.size = size * 1024
+        self.oflag = oflag
+        self.behind = behind * 1024
+        self.final = final
+
+    def flags(self):
+        """
+        Additional open flags.
+
+        Returns:
+            flags (int): Open flags
+        """
+        if self.oflag:
+            return getattr(os, 'O_%s' % self.oflag.upper())
+        return 0
+
+    def periodic(self):
+        """
+        Determine if the policy acts on individual writes.
+
+        Returns:
+            periodic (bool): Periodic policy boolean
+        """
+        return bool(self.blocks or self.size or self.behind)
+
+
+def _durability(fsync):
+    """
+    Normalise an fsync argument into a durability policy.
+
+    Args:
+        fsync (bool|Durability): Fsync argument
+    Returns:
+        policy (Durability): Policy or None
+    """
+    if not fsync:
+        return None
+    if isinstance(fsync, Durability):
+        return fsync
+    return Durability()
+
+
+def _oflags(policy):
+    """
+    Additional open flags required by a durability policy.
+
+    Args:
+        policy (Durability): Policy or None
+    Returns:
+        flags (int): Open flags
+    """
+    return policy.flags() if policy else 0
+
+
+class _Syncer(object):
+    """
+    Per file descriptor state of a periodic durability policy.
+
+    Args:
+        fd (int): File descriptor
+        policy (Durability): Policy
+        stats (Stats): Statistics or None
+        blksz (int): Block size in bytes of a vectored write function
+    """
+
+    def __init__(self, fd, policy, stats, blksz=0):
+        self.fd = fd
+        self.policy = policy
+        self._sync = instrument(getattr(os, policy.method), policy.method,
+                                stats)
+        self._range = instrument(sync_file_range, 'sync_file_range', stats,
+                                 1)
+        self.blksz = blksz
+        self.blocks = 0
+        self.nbytes = 0
+        self.behind = 0
+
+    def wrap(self, write):
+        """
+        Wrap a write function so that the policy is applied after each
+        write. Several write functions may share the policy state.
+
+        Args:
+            write (function): Write function
+        Returns:
+            write (function): Write function
+        """
+        def synced(fd, buf, *args):
+            n = write(fd, buf, *args)
+            self.written(n)
+            return n
+        return synced
+
+    def written(self, n):
+        """
+        Apply the policy after a write.
+
+        Args:
+            n (int): Bytes written
+        """
+        policy = self.policy
+        if self.blksz:
+            self.blocks += (n + self.blksz - 1) // self.blksz
+        else:
+            self.blocks += 1
+        self.nbytes += n
+        self.behind += n
+        if ((policy.blocks and self.blocks >= policy.blocks) or
+                (policy.size and self.nbytes >= policy.size)):
+            self._sync(self.fd)
+            self.blocks = 0
+            self.nbytes = 0
+            self.behind = 0
+        elif policy.behind and self.behind >= policy.behind:
+            # Wait for the previous window to reach disk and start write
+            # out of the current one so dirty data stays bounded.
+            self._range(self.fd, 0, 0, SYNC_FILE_RANGE_WAIT_BEFORE)
+            self._range(self.fd, 0, 0, SYNC_FILE_RANGE_WRITE)
+            self.behind = 0
+
+    def finish(self):
+        """
+        Apply the policy once IO is complete.
+        """
+        if self.policy.final:
+            self._sync(self.fd)
+
+
+def _writer(fd, policy, stats, func=os.write, blksz=0, mix=None,
+            op='write'):
+    """
+    Build the write and finish functions for a file descriptor.
+
+    Args:
+        fd (int): File descriptor
+        policy (Durability): Policy or None
+        stats (Stats): Statistics or None
+        func (function): Write function, os.write, pwrite, _Ring.writev or
+                         a kernel copy called as sendfile is
+        blksz (int): Block size in bytes of a vectored write function
+        mix (_BsMix): Block size mix, writes are accounted per size class
+        op (str): Operation name
+    Returns:
+        write (function): Write function, called as func is, or with a mix
+                          a dictionary of write functions by block size
+        finish (function): Called once IO is complete
+    """
+    # pwrite and _Ring.writev take the offset as their third argument
+    offset = None if func is os.write else 2
+    if mix is not None:
+        write = mix.instrument(func, op, stats, offset)
+    else:
+        write = instrument(func, op, stats, offset, blksz)
+    if policy is None:
+        return write, _nop
+    if policy.periodic():
+        syncer = _Syncer(fd, policy, stats, blksz)
+        if mix is not None:
+            return dict((bs, syncer.wrap(w)) for bs, w in
+                        write.iteritems()), syncer.finish
+        return syncer.wrap(write), syncer.finish
+    if not policy.final:
+        return write, _nop
+    sync = instrument(getattr(os, policy.method), policy.method, stats)
+    return write, lambda: sync(fd)
+
+
+def parse_bssplit(spec):
+    """
+    Parse a block size mix, e.g. '4:70,64:20,1024:10' for 70% 4K, 20% 64K
+    and 10% 1M blocks.
+
+    Args:
+        spec (str): Comma separated list of size:weight pairs, sizes in KB
+    Returns:
+        mix (list): List of (block size in KB, weight) tuples
+    """
+    mix = []
+    for item in spec.split(','):
+        size, _, weight = item.partition(':')
+        mix.append((int(size), float(weight or 1)))
+    return mix
+
+
+class _BsMix(object):
+    """
+    A weighted block size mix, see parse_bssplit.
+
+    Sizes are drawn with the random module so that seed() makes the
+    sequence reproducible.
+
+    Args:
+        mix (list): List of (block size in KB, weight) tuples
+    """
+
+    def __init__(self, mix):
+        if not mix or any(size <= 0 or weight < 0 for size, weight in mix):
+            raise ValueError('invalid block size mix %r' % (mix,))
+        self.sizes = [size * 1024 for size, weight in mix]
+        self.cum = []
+        total = 0.0
+        for size, weight in mix:
+            total += weight
+            self.cum.append(total)
+        if not total:
+            raise ValueError('invalid block size mix %r' % (mix,))
+        self.max = max(self.sizes)
+        self.mean = sum(size * 1024 * weight for size, weight in mix) / total
+
+    def draw(self):
+        """
+        Draw a block size.
+
+        Returns:
+            bs (int): Block size in bytes
+        """
+        return self.sizes[bisect(self.cum, random.random() * self.cum[-1])]
+
+    def blocks(self, size):
+        """
+        A generator splitting a file into blocks of drawn sizes. Every byte
+        is covered exactly once, the last block is cut short at the end of
+        the file.
+
+        Args:
+            size (int): File size in bytes
+        """
+        offset = 0
+        while offset < size:
+            bs = self.draw()
+            n = min(bs, size - offset)
+            yield offset, n, bs
+            offset += n
+
+    def instrument(self, func, op, stats, offset=None):
+        """
+        Instrument an IO function once per size class, e.g. as read:4K.
+
+        Args:
+            func (function): IO function
+            op (str): Operation name
+            stats (Stats): Statistics or None
+            offset (int): Index of the offset argument, if any
+        Returns:
+            funcs (dict): Block size -> IO function
+        """
+        return dict((bs, instrument(func, '%s:%s' % (op, _bs_label(bs)),
+                                    stats, offset)) for bs in self.sizes)
+
+
+def _bs_label(bs):
+    """
+    Format a block size class.
+
+    Args:
+        bs (int): Block size in bytes
+    Returns:
+        label (str): Label, e.g. 4K or 1M
+    """
+    if not bs % 1048576:
+        return '%dM' % (bs // 1048576)
+    return '%dK' % (bs // 1024)
+
+
+def _bs_mix(blksz):
+    """
+    Build the block size mix of a block size argument.
+
+    Args:
+        blksz (int|list): Block size in KB or a list of (block size in KB,
+                          weight) tuples
+    Returns:
+        mix (_BsMix): Mix or None for a fixed block size
+    """
+    if isinstance(blksz, (int, long)):
+        return None
+    return _BsMix(blksz)
+
+
+class FdPool(object):
+    """
+    A bounded cache of open file descriptors evicted in LRU order.
+
+    Keeping files open separates the cost of open from the cost of the
+    data and attribute operations done on them. When the pool is full the
+    least recently used eighth of the idle descriptors is closed at once,
+    which keeps hits down to a dictionary lookup. Descriptors in use are
+    never evicted, if every cached descriptor is in use a file is opened
+    outside of the cache and closed on release.
+
+    A pool may be shared between threads.
+
+    Args:
+        size (int): Maximum cached descriptors, default and upper bound is
+                    the RLIMIT_NOFILE soft limit less reserve
+        flags (int): Open flags
+        reserve (int): Descriptors left for use outside of the pool
+    """
+
+    def __init__(self, size=None, flags=os.O_RDONLY, reserve=64):
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft != resource.RLIM_INFINITY:
+            limit = max(soft - reserve, 1)
+            size = min(size or limit, limit)
+        elif not size:
+            raise ValueError('pool size is required without RLIMIT_NOFILE')
+        self.size = size
+        self.flags = flags
+        # fname -> [fd, references, last use]
+        self.fds = {}
+        self.lock = threading.Lock()
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._open = instrument(os.open, 'open')
+        self._close = instrument(os.close, 'close')
+
+    def acquire(self, fname):
+        """
+        Return an open file descriptor for a file.
+
+        Args:
+            fname (str): File name
+        Returns:
+            fd (int): File descriptor
+        """
+        with self.lock:
+            self.tick += 1
+            ent = self.fds.get(fname)
+            if ent is not None:
+                ent[1] += 1
+                ent[2] = self.tick
+                self.hits += 1
+                return ent[0]
+            self.misses += 1
+
+        fd = self._open(fname, self.flags)
+        idle = []
+        with self.lock:
+            ent = self.fds.get(fname)
+            if ent is not None:
+                # Another thread opened the file meanwhile
+                ent[1] += 1
+                idle.append(fd)
+                fd = ent[0]
+            else:
+                if len(self.fds) >= self.size:
+                    lru = sorted((e[2], name) for name, e in
+                                 self.fds.iteritems() if not e[1])
+                    for tick, name in lru[:max(self.size // 8, 1)]:
+                        idle.append(self.fds.pop(name)[0])
+                        self.evictions += 1
+                if len(self.fds) < self.size:
+                    self.fds[fname] = [fd, 1, self.tick]
+        for cached in idle:
+            self._close(cached)
+        return fd
+
+    def release(self, fname, fd):
+        """
+        Return a file descriptor obtained with acquire.
+
+        Args:
+            fname (str): File name
+            fd (int): File descriptor
+        """
+        with self.lock:
+            ent = self.fds.get(fname)
+            if ent is not None and ent[0] == fd:
+                ent[1] -= 1
+                return
+        self._close(fd)
+
+    def close(self):
+        """
+        Close every cached file descriptor.
+        """
+        with self.lock:
+            fds = [ent[0] for ent in self.fds.itervalues()]
+            self.fds.clear()
+        for fd in fds:
+            self._close(fd)
+
+
 def _samefile(src, dst):
     """
     Determine if src and dst are the same file.
@@ -80,6 +1698,52 @@ def _blk_map(fname, blksz):
     return blk_map
 
 
+def _sparse(fdsrc, fddst, sparse):
+    """
+    Prepare a copy for hole detection.
+
+    The destination is extended to the source size up front so that holes
+    which are skipped, including a trailing one, read back as zeros.
+
+    Args:
+        fdsrc (int): Source file descriptor
+        fddst (int): Destination file descriptor
+        sparse (bool): Skip holes
+    Returns:
+        runs (list): List of (start, end) byte ranges to copy, end is None
+                     for through end of file
+    """
+    if not sparse:
+        return [(0, None)]
+    size = os.fstat(fdsrc).st_size
+    os.ftruncate(fddst, size)
+    return [(offset, offset + length) for offset, length in
+            extents(fdsrc, size)]
+
+
+def _sparse_blk_map(fdsrc, fddst, blksz):
+    """
+    Build a block map index of the data in a file, with blocks split at
+    the boundaries of holes.
+
+    Args:
+        fdsrc (int): Source file descriptor
+        fddst (int): Destination file descriptor, extended to the source
+                     size
+        blksz (int): Block size in bytes
+    Returns:
+        blk_map (list): List of (offset, length) tuples
+    """
+    blk_map = []
+    for offset, end in _sparse(fdsrc, fddst, True):
+        while offset < end:
+            # Keep the blocks aligned as in _blk_map
+            nxt = min((offset // blksz + 1) * blksz, end)
+            blk_map.append((offset, nxt - offset))
+            offset = nxt
+    return blk_map
+
+
 def mkdirs(dname, mode=0777):
     """
     Create directory and intermediate directories if required.
@@ -96,130 +1760,291 @@ def mkdirs(dname, mode=0777):
             raise
 
 
-def w_zero(fname, size, blksz, fsync=False):
+def _w_batch(fd, ring, size, policy, stats, rand=False):
+    """
+    Write to a new file with pwritev in batches of ring blocks.
+
+    Args:
+        fd (int): File descriptor
+        ring (_Ring): Buffer ring, filled with the data to write
+        size (int): File size in bytes
+        policy (Durability): Policy or None
+        stats (Stats): Statistics or None
+        rand (bool): Refill the ring with random data before each batch
+    """
+    write, finish = _writer(fd, policy, stats, ring.writev, ring.blksz)
+    offset = 0
+    while offset < size:
+        n = min(ring.size, size - offset)
+        if rand:
+            ring.fill(os.urandom(n))
+        offset += write(fd, n, offset)
+    # Force write of fd to disk
+    finish()
+
+
+def _w_mix(fd, mix, size, policy, stats, bufs=None):
+    """
+    Write to a new file with block sizes drawn from a mix.
+
+    Args:
+        fd (int): File descriptor
+        mix (_BsMix): Block size mix
+        size (int): File size in bytes
+        policy (Durability): Policy or None
+        stats (Stats): Statistics or None
+        bufs (dict): Block size -> buffer, random data is written if None
+    """
+    writes, finish = _writer(fd, policy, stats, mix=mix)
+    for offset, n, bs in mix.blocks(size):
+        if bufs is None:
+            buf = os.urandom(n)
+        elif n == bs:
+            buf = bufs[bs]
+        else:
+            buf = bufs[bs][:n]
+        writes[bs](fd, buf)
+    # Force write of fd to disk
+    finish()
+
+
+def _no_batch(mix, batch):
+    """
+    Reject batch mode with a block size mix.
+
+    Args:
+        mix (_BsMix): Block size mix or None
+        batch (int): Batch size
+    """
+    if mix is not None and batch > 1:
+        raise ValueError('batch mode requires a fixed block size')
+
+
+def w_zero(fname, size, blksz, fsync=False, batch=1, stats=None):
     """
     Create a new file and fill it with zeros.
 
     Args:
         fname (str): File name
         size (int): File size in KB
-        blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        batch (int): Blocks written per pwritev call
+        stats (Stats): Statistics
     """
     buf = '\0' * 1024
+    mix = _bs_mix(blksz)
+    _no_batch(mix, batch)
+    policy = _durability(fsync)
+    io = _io(stats)
 
-    fd = os.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+    fd = io.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                 _oflags(policy))
     try:
+        if mix is not None:
+            _w_mix(fd, mix, size * 1024, policy, stats,
+                   dict((bs, '\0' * bs) for bs in mix.sizes))
+            return
+        if batch > 1:
+            _w_batch(fd, _Ring(batch, blksz * 1024), size * 1024, policy,
+                     stats)
+            return
+        write, finish = _writer(fd, policy, stats)
         while True:
             if size < blksz:
-                os.write(fd, buf * size)
+                write(fd, buf * size)
                 break
-            os.write(fd, buf * blksz)
+            write(fd, buf * blksz)
             size -= blksz
         # Force write of fd to disk
-        if fsync:
-            os.fsync(fd)
+        finish()
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
 
 
-def w_srand(fname, size, blksz, fsync=False):
+def w_srand(fname, size, blksz, fsync=False, batch=1, stats=None):
     """
     Create a new file and fill it with pseudo random data.
 
     Args:
         fname (str): File name
         size (int): File size in KB
-        blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        batch (int): Blocks written per pwritev call
+        stats (Stats): Statistics
     """
     buf = os.urandom(1024)
+    mix = _bs_mix(blksz)
+    _no_batch(mix, batch)
+    policy = _durability(fsync)
+    io = _io(stats)
 
-    fd = os.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+    fd = io.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                 _oflags(policy))
     try:
+        if mix is not None:
+            _w_mix(fd, mix, size * 1024, policy, stats,
+                   dict((bs, buf * (bs // 1024)) for bs in mix.sizes))
+            return
+        if batch > 1:
+            ring = _Ring(batch, blksz * 1024)
+            ring.fill(buf * blksz * batch)
+            _w_batch(fd, ring, size * 1024, policy, stats)
+            return
+        write, finish = _writer(fd, policy, stats)
         while True:
             if size < blksz:
-                os.write(fd, buf * size)
+                write(fd, buf * size)
                 break
-            os.write(fd, buf * blksz)
+            write(fd, buf * blksz)
             size -= blksz
         # Force write of fd to disk
-        if fsync:
-            os.fsync(fd)
+        finish()
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
 
 
-def w_rand(fname, size, blksz, fsync=False):
+def w_rand(fname, size, blksz, fsync=False, batch=1, stats=None):
     """
     Create a new file and fill it with random data.
 
     Args:
         fname (str): File name
         size (int): File size in KB
-        blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        batch (int): Blocks written per pwritev call
+        stats (Stats): Statistics
     """
-    blksz *= 1024
+    mix = _bs_mix(blksz)
+    _no_batch(mix, batch)
+    if mix is None:
+        blksz *= 1024
     size *= 1024
+    policy = _durability(fsync)
+    io = _io(stats)
 
-    fd = os.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+    fd = io.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                 _oflags(policy))
     try:
+        if mix is not None:
+            _w_mix(fd, mix, size, policy, stats)
+            return
+        if batch > 1:
+            _w_batch(fd, _Ring(batch, blksz), size, policy, stats, rand=True)
+            return
+        write, finish = _writer(fd, policy, stats)
         while True:
             if size < blksz:
                 buf = os.urandom(size)
-                os.write(fd, buf)
+                write(fd, buf)
                 break
             buf = os.urandom(blksz)
-            os.write(fd, buf)
+            write(fd, buf)
             size -= blksz
         # Force write of fd to disk
-        if fsync:
-            os.fsync(fd)
+        finish()
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
 
 
-def w_rand_blk(fname, blksz, fsync=False):
+def w_rand_ovw(fname, blksz, count=None, runtime=None, aligned=True,
+               fsync=False, stats=None):
     """
-    Seek to a random offset and write random data of specified block size.
+    Overwrite random blocks of an existing file in place.
+
+    The file is opened without truncation and written with pwrite so its
+    size and the data outside of the written blocks are preserved. The file
+    should be preconditioned, e.g. with w_rand, before measuring random
+    write IOPS.
 
-    Note that there is no way to modify the middle of a file without first
-    reading the entire file, modifying the contents, and re-writing the file.
-    Because we simply want to write to a random location the file will be
-    truncated based on the loaction of the random seek and update.
+    Without count or runtime one file worth of blocks is written.
 
     Args:
         fname (str): File name
-        blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit
+        count (int): Number of writes
+        runtime (float): Run time in seconds
+        aligned (bool): Block aligned offsets
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        stats (Stats): Statistics
+    Returns:
+        count (int): Number of writes issued
     """
     size = os.stat(fname).st_size
-    buf = os.urandom(1024) * blksz
-    blksz *= 1024
-    if size < blksz:
+    pattern = os.urandom(1024)
+    mix = _bs_mix(blksz)
+    if mix is None:
+        blksz *= 1024
+        sizes = [blksz]
+        draw = lambda: blksz
+        mean = blksz
+    else:
+        sizes = mix.sizes
+        draw = mix.draw
+        mean = mix.mean
+    if size < max(sizes):
         raise ValueError('block size is greater than file size')
-
-    fd = os.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+    if count is None and runtime is None:
+        count = max(int(size // mean), 1)
+    bufs = dict((bs, pattern * (bs // 1024)) for bs in sizes)
+    if aligned:
+        offset = lambda bs: random.randrange(size // bs) * bs
+    else:
+        offset = lambda bs: random.randint(0, size - bs)
+    policy = _durability(fsync)
+    io = _io(stats)
+
+    fd = io.open(fname, os.O_WRONLY | _oflags(policy))
     try:
-        os.lseek(fd, random.randint(0, size - blksz), 0)
-        os.write(fd, buf)
+        writes, finish = _writer(fd, policy, stats, pwrite, mix=mix)
+        if mix is None:
+            writes = {blksz: writes}
+        done = 0
+        while runtime is None and done < count:
+            bs = draw()
+            writes[bs](fd, bufs[bs], offset(bs))
+            done += 1
+        if runtime is not None:
+            stop = time.time() + runtime
+            while time.time() < stop and (count is None or done < count):
+                bs = draw()
+                writes[bs](fd, bufs[bs], offset(bs))
+                done += 1
         # Force write of fd to disk
-        if fsync:
-            os.fsync(fd)
+        finish()
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
+    return done
+
+
+def w_rand_blk(fname, blksz, fsync=False, stats=None):
+    """
+    Write random data of specified block size at a random offset.
+
+    The file is modified in place, see w_rand_ovw.
+
+    Args:
+        fname (str): File name
+        blksz (int): Block size in KB
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        stats (Stats): Statistics
+    """
+    w_rand_ovw(fname, blksz, count=1, aligned=False, fsync=fsync,
+               stats=stats)
 
 
-def cp(src, dst, blksz, fsync=False):
+def cp(src, dst, blksz, fsync=False, batch=1, sparse=False, digest=None,
+       stats=None):
     """
     Copy a file from source to destination.
 
@@ -229,41 +2054,81 @@ def cp(src, dst, blksz, fsync=False):
         src (str): Source file
         dst (str): Destination file or directory
         blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        batch (int): Blocks copied per preadv/pwritev call
+        sparse (bool): Copy only the data extents and keep the holes
+        digest (str): Compute a digest of the data as it is copied, see
+                      Digest
+        stats (Stats): Statistics
+    Returns:
+        digest (str): Hexadecimal digest or None
     """
     if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
     if _samefile(src, dst):
         raise Exception("`%s` and `%s` are the same file" % (src, dst))
     blksz *= 1024
+    policy = _durability(fsync)
+    io = _io(stats)
 
     # Handles the scenario where fdsrc opens but fddst fails.
     # The fdsrc file is successfully closed if fddst fails to open
-    fdsrc = os.open(src, os.O_RDONLY)
+    fdsrc = io.open(src, os.O_RDONLY)
     try:
-        fddst = os.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+        fddst = io.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                        _oflags(policy))
     except:
-        os.close(fdsrc)
+        io.close(fdsrc)
         raise
 
     # Perform the copy
     try:
-        while True:
-            buf = os.read(fdsrc, blksz)
-            if not buf:
-                break
-            os.write(fddst, buf)
+        h = Digest(digest) if digest else None
+        runs = _sparse(fdsrc, fddst, sparse)
+        if batch > 1:
+            ring = _Ring(batch, blksz)
+            readv = instrument(ring.readv, 'read', stats, 1, blksz)
+            write, finish = _writer(fddst, policy, stats, ring.writev, blksz)
+            for offset, end in runs:
+                while end is None or offset < end:
+                    n = ring.size if end is None else min(ring.size,
+                                                          end - offset)
+                    n = readv(fdsrc, offset, n)
+                    if not n:
+                        break
+                    if h is not None:
+                        # Digest any hole skipped before offset as zeros
+                        h.update('', offset)
+                        for buf in ring.data(n):
+                            h.update(buf)
+                    offset += write(fddst, n, offset)
+        else:
+            write, finish = _writer(fddst, policy, stats)
+            for offset, end in runs:
+                if end is not None:
+                    io.lseek(fdsrc, offset, 0)
+                    io.lseek(fddst, offset, 0)
+                while end is None or offset < end:
+                    n = blksz if end is None else min(blksz, end - offset)
+                    buf = io.read(fdsrc, n)
+                    if not buf:
+                        break
+                    if h is not None:
+                        h.update(buf, offset)
+                    write(fddst, buf)
+                    offset += len(buf)
         # Force write of fddst to disk
-        if fsync:
-            os.fsync(fddst)
+        finish()
+        if h is not None:
+            return h.hexdigest(os.fstat(fdsrc).st_size if sparse else 0)
     except:
         raise
     finally:
-        os.close(fdsrc)
-        os.close(fddst)
+        io.close(fdsrc)
+        io.close(fddst)
 
 
-def cp_conv(src, dst, blksz, fsync=False):
+def cp_conv(src, dst, blksz, fsync=False, sparse=False, stats=None):
     """
     Converge file copy. Given a file of size 's' a converged copy
     will copy the blocks at offset 0, s - blksz, blksz, s - 2*blksz, and so
@@ -276,44 +2141,53 @@ def cp_conv(src, dst, blksz, fsync=False):
         src (str): Source file
         dst (str): Destination file or directory
         blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        sparse (bool): Copy only the data extents and keep the holes
+        stats (Stats): Statistics
     """
     if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
     if _samefile(src, dst):
         raise Exception("`%s` and `%s` are the same file" % (src, dst))
-    blk_map = _blk_map(src, blksz)
+    blk_map = None if sparse else _blk_map(src, blksz)
     blksz *= 1024
     idx = cycle([0, -1]).next
+    policy = _durability(fsync)
+    io = _io(stats)
 
     # Handles the scenario where fdsrc opens but fddst fails.
     # The fdsrc file is successfully closed if fddst fails to open
-    fdsrc = os.open(src, os.O_RDONLY)
+    fdsrc = io.open(src, os.O_RDONLY)
     try:
-        fddst = os.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+        fddst = io.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                        _oflags(policy))
     except:
-        os.close(fdsrc)
+        io.close(fdsrc)
         raise
 
     # Perform the copy
     try:
+        if sparse:
+            blk_map = _sparse_blk_map(fdsrc, fddst, blksz)
+        else:
+            blk_map = [(offset, blksz) for offset in blk_map]
+        write, finish = _writer(fddst, policy, stats)
         while blk_map:
-            offset = blk_map.pop(idx())
-            os.lseek(fdsrc, offset, 0)
-            os.lseek(fddst, offset, 0)
-            buf = os.read(fdsrc, blksz)
-            os.write(fddst, buf)
+            offset, n = blk_map.pop(idx())
+            io.lseek(fdsrc, offset, 0)
+            io.lseek(fddst, offset, 0)
+            buf = io.read(fdsrc, n)
+            write(fddst, buf)
         # Force write of fddst to disk
-        if fsync:
-            os.fsync(fddst)
+        finish()
     except:
         raise
     finally:
-        os.close(fdsrc)
-        os.close(fddst)
+        io.close(fdsrc)
+        io.close(fddst)
 
 
-def cp_rand(src, dst, blksz, fsync=False):
+def cp_rand(src, dst, blksz, fsync=False, sparse=False, stats=None):
     """
     Copy a file from source to destination using random IO. A file
     block map is built and random offsets are selected and copied
@@ -325,91 +2199,550 @@ def cp_rand(src, dst, blksz, fsync=False):
         src (str): Source file
         dst (str): Destination file or directory
         blksz (int): Block size in KB
-        fsync (bool): Fsync after IO is complete
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        sparse (bool): Copy only the data extents and keep the holes
+        stats (Stats): Statistics
     """
     if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
     if _samefile(src, dst):
         raise Exception("`%s` and `%s` are the same file" % (src, dst))
 
-    blk_map = _blk_map(src, blksz)
+    blk_map = None if sparse else _blk_map(src, blksz)
     blksz *= 1024
-    random.shuffle(blk_map)
+    policy = _durability(fsync)
+    io = _io(stats)
 
     # Handles the scenario where fdsrc opens but fddst fails.
     # The fdsrc file is successfully closed if fddst fails to open
-    fdsrc = os.open(src, os.O_RDONLY)
+    fdsrc = io.open(src, os.O_RDONLY)
     try:
-        fddst = os.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+        fddst = io.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                        _oflags(policy))
     except:
-        os.close(fdsrc)
+        io.close(fdsrc)
         raise
 
     # Perform the copy
     try:
+        if sparse:
+            blk_map = _sparse_blk_map(fdsrc, fddst, blksz)
+        else:
+            blk_map = [(offset, blksz) for offset in blk_map]
+        random.shuffle(blk_map)
+        write, finish = _writer(fddst, policy, stats)
         while blk_map:
-            offset = blk_map.pop()
-            os.lseek(fdsrc, offset, 0)
-            os.lseek(fddst, offset, 0)
-            buf = os.read(fdsrc, blksz)
-            os.write(fddst, buf)
+            offset, n = blk_map.pop()
+            io.lseek(fdsrc, offset, 0)
+            io.lseek(fddst, offset, 0)
+            buf = io.read(fdsrc, n)
+            write(fddst, buf)
         # Force write of fddst to disk
-        if fsync:
-            os.fsync(fddst)
+        finish()
     except:
         raise
     finally:
-        os.close(fdsrc)
-        os.close(fddst)
+        io.close(fdsrc)
+        io.close(fddst)
 
 
-def r_seq(fname, blksz):
+def _ring_readv(fd, offset, ring):
     """
-    Sequential file read.
+    _Ring.readv of a given ring, so one instrumented function serves all.
+    """
+    return ring.readv(fd, offset)
+
+
+def _ring_writev(fd, n, offset, ring):
+    """
+    _Ring.writev of a given ring, so one instrumented function serves all.
+    """
+    return ring.writev(fd, n, offset)
+
+
+def cp_pipe(src, dst, blksz, depth=4, batch=1, fsync=False, stats=None):
+    """
+    Pipelined file copy. A reader thread fills a ring of depth reusable
+    buffers with preadv while a writer thread drains it with pwritev, so
+    the source and destination are busy at the same time rather than in
+    turn. A cross device copy then approaches the bandwidth of the slower
+    device.
+
+    The destination may be a directory.
 
     Args:
-        fname (str): File name
+        src (str): Source file
+        dst (str): Destination file or directory
         blksz (int): Block size in KB
+        depth (int): Buffers in flight between the reader and the writer
+        batch (int): Blocks per buffer, transferred in one call
+        fsync (bool|Durability): Fsync after IO is complete or a policy
+        stats (Stats): Statistics
     """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if _samefile(src, dst):
+        raise Exception("`%s` and `%s` are the same file" % (src, dst))
+    if depth < 1:
+        raise ValueError('depth must be at least 1')
     blksz *= 1024
+    policy = _durability(fsync)
+    io = _io(stats)
+    free = Queue()
+    for i in range(depth):
+        free.put(_Ring(batch, blksz))
+    full = Queue()
+    abort = threading.Event()
+
+    # Handles the scenario where fdsrc opens but fddst fails.
+    # The fdsrc file is successfully closed if fddst fails to open
+    fdsrc = io.open(src, os.O_RDONLY)
+    try:
+        fddst = io.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                        _oflags(policy))
+    except:
+        io.close(fdsrc)
+        raise
+
+    def reader(thr_stats):
+        readv = instrument(_ring_readv, 'read', thr_stats, 1, blksz)
+        offset = 0
+        try:
+            while not abort.is_set():
+                ring = free.get()
+                n = readv(fdsrc, offset, ring)
+                if not n:
+                    break
+                full.put((ring, n, offset))
+                offset += n
+        finally:
+            # End of file or error, either way the writer is done
+            full.put(None)
+
+    def writer(thr_stats):
+        write, finish = _writer(fddst, policy, thr_stats, _ring_writev,
+                                blksz)
+        item = None
+        try:
+            while True:
+                item = full.get()
+                if item is None:
+                    break
+                ring, n, offset = item
+                try:
+                    write(fddst, n, offset, ring)
+                finally:
+                    free.put(ring)
+            # Force write of fddst to disk
+            finish()
+        except:
+            # Stop the reader and hand back the buffers it is waiting on
+            abort.set()
+            while item is not None:
+                item = full.get()
+                if item is not None:
+                    free.put(item[0])
+            raise
+
+    # Perform the copy
+    try:
+        _run_thrs(lambda idx, thr_stats: (reader, writer)[idx](thr_stats), 2,
+                  stats)
+    except:
+        raise
+    finally:
+        io.close(fdsrc)
+        io.close(fddst)
+
+
+def _cp_offload(fdsrc, fddst, size, blksz, policy, stats, io):
+    """
+    Copy a file in the kernel with copy_file_range, or sendfile where
+    copy_file_range is not supported between the two files, falling back
+    to read and write.
+
+    Args:
+        fdsrc (int): Source file descriptor
+        fddst (int): Destination file descriptor
+        size (int): Source file size in bytes
+        blksz (int): Bytes copied per call
+        policy (Durability): Policy or None
+        stats (Stats): Statistics or None
+        io (_IO): IO functions
+    """
+    for func in (_copy_range, sendfile):
+        write, finish = _writer(fddst, policy, stats, func, op='copy')
+        offset = 0
+        try:
+            while offset < size:
+                n = write(fddst, fdsrc, offset, min(blksz, size - offset))
+                if not n:
+                    break
+                offset += n
+        except OSError, err:
+            # Only an unsupported first call falls through to the next
+            # method, nothing has been written yet
+            if offset or err.errno not in _NO_OFFLOAD:
+                raise
+            continue
+        # Force write of fddst to disk
+        finish()
+        return
+
+    write, finish = _writer(fddst, policy, stats)
+    while True:
+        buf = io.read(fdsrc, blksz)
+        if not buf:
+            break
+        write(fddst, buf)
+    # Force write of fddst to disk
+    finish()
+
+
+def _cp_file(src, dst, size, blksz, small, policy, digest, stats, io):
+    """
+    Copy a single file of a tree.
+
+    Args:
+        src (str): Source file
+        dst (str): Destination file
+        size (int): Source file size in bytes
+        blksz (int): Block size in bytes
+        small (int): Largest file in bytes copied with a single read
+        policy (Durability): Policy or None
+        digest (str): Digest algorithm or None
+        stats (Stats): Statistics or None
+        io (_IO): IO functions
+    Returns:
+        digest (str): Hexadecimal digest or None
+    """
+    fdsrc = io.open(src, os.O_RDONLY)
+    try:
+        fddst = io.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY |
+                        _oflags(policy))
+    except:
+        io.close(fdsrc)
+        raise
 
-    fd = os.open(fname, os.O_RDONLY)
     try:
+        h = Digest(digest) if digest else None
+        if size <= small:
+            write, finish = _writer(fddst, policy, stats)
+            if size:
+                buf = io.read(fdsrc, size)
+                if h is not None:
+                    h.update(buf)
+                write(fddst, buf)
+            # Force write of fddst to disk
+            finish()
+        elif h is not None:
+            # The data has to pass through user space to be digested
+            write, finish = _writer(fddst, policy, stats)
+            while True:
+                buf = io.read(fdsrc, blksz)
+                if not buf:
+                    break
+                h.update(buf)
+                write(fddst, buf)
+            # Force write of fddst to disk
+            finish()
+        else:
+            _cp_offload(fdsrc, fddst, size, blksz, policy, stats, io)
+        return h and h.hexdigest()
+    except:
+        raise
+    finally:
+        io.close(fdsrc)
+        io.close(fddst)
+
+
+def cp_tree(src, dst, blksz, thr_ct, small=64, fsync=False, manifest=None,
+            digest='crc32', stats=None):
+    """
+    Copy a directory tree with several threads.
+
+    The threads share a queue of directories and files. A thread lists a
+    directory, recreates it in the destination and queues its entries, so
+    the walk is parallel too. Files up to small KB are copied with a
+    single read and write, larger ones in the kernel with copy_file_range
+    or sendfile. Symbolic links are recreated, other special files are
+    skipped. Copying into an existing tree replaces its files and links,
+    a destination inside the source is refused.
+
+    With a manifest each file is digested while it is in memory, which
+    rules out the kernel copy, and the digests are written to the manifest
+    for a later verify.
+
+    Args:
+        src (str): Source directory
+        dst (str): Destination directory
+        blksz (int): Block size in KB
+        thr_ct (int): Thread count
+        small (int): Largest file in KB copied with a single read
+        fsync (bool|Durability): Fsync each file after IO is complete or a
+                                 policy
+        manifest (str): Write a manifest of the file digests to this file
+        digest (str): Digest algorithm of the manifest, see Digest
+        stats (Stats): Statistics
+    Returns:
+        files (float): Files copied per second
+        bw (float): Bandwidth in bytes per second
+    """
+    if not os.path.isdir(src):
+        raise ValueError('%s is not a directory' % src)
+    real = os.path.realpath(src)
+    if (os.path.realpath(dst) + os.sep).startswith(real + os.sep):
+        raise ValueError('%s lies inside %s' % (dst, src))
+    blksz *= 1024
+    small *= 1024
+    policy = _durability(fsync)
+    if manifest is None:
+        digest = None
+    else:
+        # Fail early on an unavailable digest
+        Digest(digest)
+    work = Queue()
+    work.put((src, dst, None))
+    # Queued or in progress items, the thread that finishes the last one
+    # stops all threads
+    pending = [1]
+    lock = threading.Lock()
+    files = [0] * thr_ct
+    nbytes = [0] * thr_ct
+    entries = [[] for i in range(thr_ct)]
+
+    def copier(idx, thr_stats):
+        io = _io(thr_stats)
         while True:
-            buf = os.read(fd, blksz)
-            if not buf:
+            item = work.get()
+            if item is None:
                 break
+            s, d, size = item
+            try:
+                if size is not None:
+                    hexdigest = _cp_file(s, d, size, blksz, small, policy,
+                                         digest, thr_stats, io)
+                    if digest:
+                        entries[idx].append((os.path.relpath(s, src),
+                                             hexdigest, size))
+                    files[idx] += 1
+                    nbytes[idx] += size
+                    continue
+                mkdirs(d)
+                for name in os.listdir(s):
+                    path = os.path.join(s, name)
+                    st = os.lstat(path)
+                    if stat.S_ISDIR(st.st_mode):
+                        item = (path, os.path.join(d, name), None)
+                    elif stat.S_ISREG(st.st_mode):
+                        item = (path, os.path.join(d, name), st.st_size)
+                    elif stat.S_ISLNK(st.st_mode):
+                        link = os.path.join(d, name)
+                        try:
+                            os.unlink(link)
+                        except OSError, err:
+                            if err.errno != errno.ENOENT:
+                                raise
+                        os.symlink(os.readlink(path), link)
+                        continue
+                    else:
+                        continue
+                    with lock:
+                        pending[0] += 1
+                    work.put(item)
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    last = not pending[0]
+                if last:
+                    for i in range(thr_ct):
+                        work.put(None)
+
+    elapsed = _run_thrs(copier, thr_ct, stats)
+    if manifest is not None:
+        write_manifest(manifest, digest,
+                       [entry for thr in entries for entry in thr])
+    if not elapsed:
+        return 0.0, 0.0
+    return sum(files) / elapsed, sum(nbytes) / elapsed
+
+
+def r_seq(fname, blksz, cold=False, batch=1, pool=None, stats=None):
+    """
+    Sequential file read.
+
+    Args:
+        fname (str): File name
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit
+        cold (bool): Evict the file from the page cache before reading
+        batch (int): Blocks read per preadv call
+        pool (FdPool): Take the file descriptor from a pool rather than
+                       opening and closing the file
+        stats (Stats): Statistics
+    """
+    mix = _bs_mix(blksz)
+    _no_batch(mix, batch)
+    if mix is None:
+        blksz *= 1024
+    if cold:
+        evict(fname)
+    io = _io(stats)
+
+    if pool is None:
+        fd = io.open(fname, os.O_RDONLY)
+    else:
+        fd = pool.acquire(fname)
+    try:
+        if batch > 1:
+            ring = _Ring(batch, blksz)
+            readv = instrument(ring.readv, 'read', stats, 1, blksz)
+            offset = 0
+            while True:
+                n = readv(fd, offset)
+                if not n:
+                    break
+                offset += n
+        elif mix is not None:
+            reads = mix.instrument(pread, 'read', stats, 2)
+            offset = 0
+            while True:
+                bs = mix.draw()
+                buf = reads[bs](fd, bs, offset)
+                if not buf:
+                    break
+                offset += len(buf)
+        elif pool is not None:
+            # A pooled descriptor is shared, read it without seeking
+            offset = 0
+            while True:
+                buf = io.pread(fd, blksz, offset)
+                if not buf:
+                    break
+                offset += len(buf)
+        else:
+            while True:
+                buf = io.read(fd, blksz)
+                if not buf:
+                    break
     except:
         raise
     finally:
-        os.close(fd)
+        if pool is None:
+            io.close(fd)
+        else:
+            pool.release(fname, fd)
 
 
-def r_rand(fname, blksz):
+def _open_rel(fname, flags, dirs):
     """
-    Read a file using random IO.
+    Open a file relative to its directory, taking the directory file
+    descriptor from a pool.
+    """
+    dname, name = os.path.split(fname)
+    dname = dname or '.'
+    dirfd = dirs.acquire(dname)
+    try:
+        return openat(dirfd, name, flags)
+    finally:
+        dirs.release(dname, dirfd)
+
+
+def dir_pool(size=None):
+    """
+    Create a pool of open directories for r_small.
+
+    Args:
+        size (int): Maximum cached directories, see FdPool
+    Returns:
+        pool (FdPool): Directory pool
+    """
+    return FdPool(size, os.O_RDONLY | O_DIRECTORY)
+
+
+def r_small(fname, blksz, cold=False, dirs=None, stats=None):
+    """
+    Read a file with as few calls as possible, for small files. The size
+    is taken from fstat and exactly that many bytes are read, in a single
+    read if the file fits in a block, without the read at end of file that
+    r_seq needs. A file that shrinks meanwhile is read up to its new end,
+    one that grows only up to its old size.
 
     Args:
         fname (str): File name
         blksz (int): Block size in KB
+        cold (bool): Evict the file from the page cache before reading
+        dirs (FdPool): Open the file relative to a directory taken from
+                       this pool, see dir_pool, so that the open resolves
+                       a single path component
+        stats (Stats): Statistics
+    Returns:
+        nbytes (int): Bytes read
     """
-    blk_map = _blk_map(fname, blksz)
     blksz *= 1024
+    if cold:
+        evict(fname)
+    io = _io(stats)
+
+    if dirs is None:
+        fd = io.open(fname, os.O_RDONLY)
+    else:
+        fd = instrument(_open_rel, 'open', stats)(fname, os.O_RDONLY, dirs)
+    try:
+        size = io.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            buf = io.read(fd, min(blksz, size - offset))
+            if not buf:
+                break
+            offset += len(buf)
+    except:
+        raise
+    finally:
+        io.close(fd)
+    return offset
+
+
+def r_rand(fname, blksz, cold=False, stats=None):
+    """
+    Read a file using random IO.
+
+    Args:
+        fname (str): File name
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit
+        cold (bool): Evict the file from the page cache before reading
+        stats (Stats): Statistics
+    """
+    mix = _bs_mix(blksz)
+    if mix is None:
+        blk_map = _blk_map(fname, blksz)
+        blksz *= 1024
+    else:
+        blk_map = list(mix.blocks(os.stat(fname).st_size))
     random.shuffle(blk_map)
+    if cold:
+        evict(fname)
+    io = _io(stats)
 
-    fd = os.open(fname, os.O_RDONLY)
+    fd = io.open(fname, os.O_RDONLY)
     try:
-        while blk_map:
-            offset = blk_map.pop()
-            os.lseek(fd, offset, 0)
-            os.read(fd, blksz)
+        if mix is not None:
+            reads = mix.instrument(os.read, 'read', stats)
+            while blk_map:
+                offset, n, bs = blk_map.pop()
+                io.lseek(fd, offset, 0)
+                reads[bs](fd, n)
+        else:
+            while blk_map:
+                offset = blk_map.pop()
+                io.lseek(fd, offset, 0)
+                io.read(fd, blksz)
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
 
 
-def r_conv(fname, blksz):
+def r_conv(fname, blksz, cold=False, stats=None):
     """
     Converge file read. Given a file of size sz, a converged read
     will read the blocks at offset 0, size - blksz, blksz, size - 2*blksz,
@@ -419,41 +2752,252 @@ def r_conv(fname, blksz):
     Args:
         fname (str): File name
         blksz (int): Block size in KB
+        cold (bool): Evict the file from the page cache before reading
+        stats (Stats): Statistics
     """
     blk_map = _blk_map(fname, blksz)
     blksz *= 1024
     idx = cycle([0, -1]).next
+    if cold:
+        evict(fname)
+    io = _io(stats)
 
-    fd = os.open(fname, os.O_RDONLY)
+    fd = io.open(fname, os.O_RDONLY)
     try:
         while blk_map:
             offset = blk_map.pop(idx())
-            os.lseek(fd, offset, 0)
-            os.read(fd, blksz)
+            io.lseek(fd, offset, 0)
+            io.read(fd, blksz)
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
 
 
-def r_rand_blk(fname, blksz):
+def r_rand_blk(fname, blksz, cold=False, stats=None):
     """
     Read a random block of specified block size.
 
     Args:
         fname (str): File name
-        blksz (int): Block size in KB
+        blksz (int|list): Block size in KB or a mix, see parse_bssplit, in
+                          which case the block size is drawn from the mix
+        cold (bool): Evict the file from the page cache before reading
+        stats (Stats): Statistics
     """
-    blksz *= 1024
     size = os.stat(fname).st_size
-    if size < blksz:
+    mix = _bs_mix(blksz)
+    if mix is None:
+        blksz *= 1024
+        if size < blksz:
+            raise ValueError('block size is greater than file size')
+    elif size < mix.max:
         raise ValueError('block size is greater than file size')
+    if cold:
+        evict(fname)
+    io = _io(stats)
+    if mix is None:
+        read = io.read
+    else:
+        blksz = mix.draw()
+        read = instrument(os.read, 'read:%s' % _bs_label(blksz), stats)
+
+    fd = io.open(fname, os.O_RDONLY)
+    try:
+        io.lseek(fd, random.randint(0, size - blksz), 0)
+        read(fd, blksz)
+    except:
+        raise
+    finally:
+        io.close(fd)
 
-    fd = os.open(fname, os.O_RDONLY)
+
+def _stripes(size, blksz, thr_ct, stripe):
+    """
+    Compute the stripe unit used to split a file between threads.
+
+    Thread i owns the units at offsets i*unit, (i+thr_ct)*unit, and so on.
+    Without a stripe size each thread owns one contiguous region.
+
+    Args:
+        size (int): File size in bytes
+        blksz (int): Block size in bytes
+        thr_ct (int): Thread count
+        stripe (int): Stripe size in KB or None
+    Returns:
+        unit (int): Stripe unit in bytes
+    """
+    if stripe:
+        return stripe * 1024
+    blks = int(ceil(float(size) / blksz / thr_ct))
+    return max(blks, 1) * blksz
+
+
+def _units(size, unit, idx, thr_ct):
+    """
+    A generator returning the stripe units owned by a thread.
+
+    Args:
+        size (int): File size in bytes
+        unit (int): Stripe unit in bytes
+        idx (int): Thread index
+        thr_ct (int): Thread count
+    """
+    offset = idx * unit
+    while offset < size:
+        yield offset, min(unit, size - offset)
+        offset += thr_ct * unit
+
+
+def _run_thrs(target, thr_ct, stats):
+    """
+    Run a worker in several threads and merge their statistics, including
+    the resource usage of each thread.
+
+    Args:
+        target (function): Worker, called as target(idx, stats)
+        thr_ct (int): Thread count
+        stats (Stats): Statistics or None
+    Returns:
+        elapsed (float): Wall clock time in seconds
+    """
+    thr_stats = [Stats() if stats is not None else None
+                 for i in range(thr_ct)]
+    errors = []
+
+    def worker(idx):
+        before = usage() if stats is not None else None
+        try:
+            target(idx, thr_stats[idx])
+        except:
+            errors.append(sys.exc_info())
+        finally:
+            _release_ring()
+        if before is not None:
+            thr_stats[idx].account(before)
+
+    thrs = [threading.Thread(target=worker, args=(i,)) for i in range(thr_ct)]
+    start = time.time()
+    for t in thrs:
+        t.start()
+    for t in thrs:
+        t.join()
+    elapsed = time.time() - start
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    if stats is not None:
+        for thr_stat in thr_stats:
+            stats.merge(thr_stat)
+    return elapsed
+
+
+def r_stripe(fname, blksz, thr_ct, stripe=None, sequential=False,
+             prefetch=False, cold=False, stats=None):
+    """
+    Read a single file with several threads.
+
+    The file is split into one contiguous region per thread or, if a stripe
+    size is given, into stripes dealt round-robin to the threads. Each
+    thread opens the file and reads its part sequentially with pread.
+
+    Args:
+        fname (str): File name
+        blksz (int): Block size in KB
+        thr_ct (int): Thread count
+        stripe (int): Stripe size in KB
+        sequential (bool): Advise POSIX_FADV_SEQUENTIAL on each region
+        prefetch (bool): Issue readahead for each stripe unit
+        cold (bool): Evict the file from the page cache before reading
+        stats (Stats): Statistics
+    Returns:
+        bw (float): Aggregate bandwidth in bytes per second
+    """
+    size = os.stat(fname).st_size
+    blksz *= 1024
+    unit = _stripes(size, blksz, thr_ct, stripe)
+    total = [0] * thr_ct
+    if cold:
+        evict(fname)
+
+    def reader(idx, thr_stats):
+        io = _io(thr_stats)
+        fd = io.open(fname, os.O_RDONLY)
+        try:
+            for offset, length in _units(size, unit, idx, thr_ct):
+                if sequential:
+                    fadvise(fd, offset, length, POSIX_FADV_SEQUENTIAL)
+                if prefetch:
+                    readahead(fd, offset, length)
+                end = offset + length
+                while offset < end:
+                    buf = io.pread(fd, min(blksz, end - offset), offset)
+                    if not buf:
+                        break
+                    offset += len(buf)
+                    total[idx] += len(buf)
+        except:
+            raise
+        finally:
+            io.close(fd)
+
+    elapsed = _run_thrs(reader, thr_ct, stats)
+    return sum(total) / elapsed if elapsed else 0.0
+
+
+def w_stripe(fname, size, blksz, thr_ct, stripe=None, fsync=False,
+             stats=None):
+    """
+    Create a new file and fill it with pseudo random data using several
+    threads.
+
+    The file is split between the threads as in r_stripe and each thread
+    writes its part sequentially with pwrite.
+
+    Args:
+        fname (str): File name
+        size (int): File size in KB
+        blksz (int): Block size in KB
+        thr_ct (int): Thread count
+        stripe (int): Stripe size in KB
+        fsync (bool|Durability): Fsync after IO is complete or a policy,
+                                 applied per thread
+        stats (Stats): Statistics
+    Returns:
+        bw (float): Aggregate bandwidth in bytes per second
+    """
+    size *= 1024
+    buf = os.urandom(1024) * blksz
+    blksz *= 1024
+    unit = _stripes(size, blksz, thr_ct, stripe)
+    policy = _durability(fsync)
+    io = _io(stats)
+
+    fd = io.open(fname, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
     try:
-        os.lseek(fd, random.randint(0, size - blksz), 0)
-        os.read(fd, blksz)
+        os.ftruncate(fd, size)
     except:
         raise
     finally:
-        os.close(fd)
+        io.close(fd)
+
+    def writer(idx, thr_stats):
+        io = _io(thr_stats)
+        fd = io.open(fname, os.O_WRONLY | _oflags(policy))
+        try:
+            write, finish = _writer(fd, policy, thr_stats, pwrite)
+            for offset, length in _units(size, unit, idx, thr_ct):
+                end = offset + length
+                while offset < end:
+                    n = min(blksz, end - offset)
+                    write(fd, buf if n == blksz else buf[:n], offset)
+                    offset += n
+            # Force write of fd to disk
+            finish()
+        except:
+            raise
+        finally:
+            io.close(fd)
+
+    elapsed = _run_thrs(writer, thr_ct, stats)
+    return size / elapsed if elapsed else 0.0
@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+
+"""
+stats.py
+
+IO statistics.
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import mmap
+import time
+import struct
+import resource
+from Queue import Queue
+from collections import deque
+
+# Latency histogram bucket count. Bucket b holds latencies in the range
+# [2^(b-1), 2^b) microseconds, the last bucket holds everything above.
+BUCKETS = 32
+
+# The resource module only names RUSAGE_THREAD from Python 3.2 on
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# Resource usage counters, see usage
+USAGE = ('utime', 'stime', 'nvcsw', 'nivcsw', 'rchar', 'wchar', 'read_bytes',
+         'write_bytes')
+
+
+def _bucket(lat):
+    """
+    Map a latency to its histogram bucket.
+
+    Args:
+        lat (float): Latency in seconds
+    Returns:
+        bucket (int): Histogram bucket
+    """
+    bucket = int(lat * 1000000).bit_length()
+    if bucket < BUCKETS:
+        return bucket
+    return BUCKETS - 1
+
+
+def usage(thread=True):
+    """
+    Sample the resource usage of the calling thread or of the process: user
+    and system CPU time, voluntary and involuntary context switches and the
+    /proc io counters, i.e. bytes passed to read and write calls (rchar,
+    wchar) and bytes fetched from or sent to storage (read_bytes,
+    write_bytes). The io counters are zero where /proc is unavailable.
+
+    Args:
+        thread (bool): Sample the calling thread rather than the process
+    Returns:
+        sample (dict): Counter -> value, see USAGE
+    """
+    ru = resource.getrusage(RUSAGE_THREAD if thread else
+                            resource.RUSAGE_SELF)
+    sample = dict.fromkeys(USAGE, 0)
+    sample.update(utime=ru.ru_utime, stime=ru.ru_stime, nvcsw=ru.ru_nvcsw,
+                  nivcsw=ru.ru_nivcsw)
+    try:
+        with open('/proc/thread-self/io' if thread else '/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in sample:
+                    sample[name] = int(value)
+    except IOError:
+        pass
+    return sample
+
+
+class Stats(object):
+    """
+    Per operation counters and latency histograms.
+
+    A Stats object is not thread safe, each thread should own one.
+
+    Resource usage accounted with account is kept apart from the operation
+    counters: merged Stats remember each accounted Stats they received as
+    a worker, so the cost of every worker and of the whole run can be
+    reported.
+    """
+
+    def __init__(self):
+        # op -> [count, bytes, latency sum, latency max, histogram]
+        self.ops = {}
+        # Counter -> value, see usage, None until accounted
+        self.usage = None
+        # Accounted Stats merged into this one
+        self.workers = []
+
+    def add(self, op, nbytes, lat, count=1):
+        """
+        Account an operation.
+
+        Several operations completed by a single call, e.g. the blocks of a
+        vectored read, are accounted individually with the call latency
+        spread evenly between them.
+
+        Args:
+            op (str): Operation name
+            nbytes (int): Bytes transferred
+            lat (float): Latency in seconds
+            count (int): Operation count
+        """
+        try:
+            rec = self.ops[op]
+        except KeyError:
+            rec = self.ops[op] = [0, 0, 0.0, 0.0, [0] * BUCKETS]
+        rec[0] += count
+        rec[1] += nbytes
+        rec[2] += lat
+        if count != 1:
+            lat /= count
+        if lat > rec[3]:
+            rec[3] = lat
+        rec[4][_bucket(lat)] += count
+
+    def merge(self, other):
+        """
+        Add the statistics of another Stats object.
+
+        Args:
+            other (Stats): Statistics
+        """
+        for op, (count, nbytes, lat_sum, lat_max, hist) in \
+                other.ops.iteritems():
+            try:
+                rec = self.ops[op]
+            except KeyError:
+                rec = self.ops[op] = [0, 0, 0.0, 0.0, [0] * BUCKETS]
+            rec[0] += count
+            rec[1] += nbytes
+            rec[2] += lat_sum
+            rec[3] = max(rec[3], lat_max)
+            rec[4] = [a + b for a, b in zip(rec[4], hist)]
+        if other.usage is not None:
+            self.workers.append(other)
+        else:
+            self.workers.extend(other.workers)
+
+    def delta(self, earlier):
+        """
+        The statistics accounted since an earlier copy of the same
+        counters, e.g. two reads of a SharedStats slot. The maximum
+        latency is that of the later copy.
+
+        Args:
+            earlier (Stats): Earlier statistics
+        Returns:
+            stats (Stats): Difference, None if a counter went backwards,
+                           e.g. because the counters were reset
+        """
+        stats = Stats()
+        for op in earlier.ops:
+            if op not in self.ops:
+                return None
+        for op, (count, nbytes, lat_sum, lat_max, hist) in \
+                self.ops.iteritems():
+            old = earlier.ops.get(op)
+            if old is None:
+                stats.ops[op] = [count, nbytes, lat_sum, lat_max, list(hist)]
+                continue
+            if count < old[0] or nbytes < old[1]:
+                return None
+            if count > old[0]:
+                stats.ops[op] = [count - old[0], nbytes - old[1],
+                                 lat_sum - old[2], lat_max,
+                                 [a - b for a, b in zip(hist, old[4])]]
+        return stats
+
+    def account(self, before, after=None):
+        """
+        Account the resource usage between two samples, e.g. of a worker
+        thread from its start to its end.
+
+        Args:
+            before (dict): Earlier sample, see usage
+            after (dict): Later sample, default is a sample of the calling
+                          thread now
+        """
+        if after is None:
+            after = usage()
+        if self.usage is None:
+            self.usage = dict.fromkeys(USAGE, 0)
+        for name in USAGE:
+            self.usage[name] += after[name] - before[name]
+
+    def to_dict(self):
+        """
+        Export the statistics as plain data, e.g. for JSON, including the
+        resource usage and the accounted workers.
+
+        Returns:
+            data (dict): 'ops' -> {op -> [count, bytes, latency sum, latency
+                         max, histogram]}, 'usage' -> usage or None,
+                         'workers' -> list of worker to_dict data
+        """
+        return {'ops': self.ops, 'usage': self.usage,
+                'workers': [w.to_dict() for w in self.workers]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Import statistics exported by to_dict. A plain op dict, as exported
+        before usage was included, is accepted too.
+
+        Args:
+            data (dict): to_dict data
+        Returns:
+            stats (Stats): Statistics
+        """
+        stats = cls()
+        ops = data
+        if isinstance(data.get('ops'), dict):
+            ops = data['ops']
+            if data.get('usage') is not None:
+                stats.usage = dict((str(k), v)
+                                   for k, v in data['usage'].iteritems())
+            stats.workers = [cls.from_dict(w) for w in data.get('workers', [])]
+        for op, (count, nbytes, lat_sum, lat_max, hist) in ops.iteritems():
+            if len(hist) != BUCKETS:
+                raise ValueError('%s histogram has %d buckets, expected %d' %
+                                 (op, len(hist), BUCKETS))
+            stats.ops[str(op)] = [count, nbytes, lat_sum, lat_max, list(hist)]
+        return stats
+
+    def totals(self, prefix=''):
+        """
+        Totals over the operations whose name starts with prefix, e.g.
+        'read' for reads of every block size class.
+
+        Args:
+            prefix (str): Operation name prefix
+        Returns:
+            count (int): Operation count
+            nbytes (int): Bytes transferred
+            lat_sum (float): Latency sum in seconds
+        """
+        count = nbytes = 0
+        lat_sum = 0.0
+        for op, rec in self.ops.iteritems():
+            if op.startswith(prefix):
+                count += rec[0]
+                nbytes += rec[1]
+                lat_sum += rec[2]
+        return count, nbytes, lat_sum
+
+    def count(self, op):
+        """
+        Operation count.
+
+        Args:
+            op (str): Operation name
+        Returns:
+            count (int): Operation count
+        """
+        return self.ops[op][0] if op in self.ops else 0
+
+    def nbytes(self, op):
+        """
+        Bytes transferred.
+
+        Args:
+            op (str): Operation name
+        Returns:
+            nbytes (int): Bytes transferred
+        """
+        return self.ops[op][1] if op in self.ops else 0
+
+    def percentile(self, op, pct):
+        """
+        Latency percentile, resolved to the upper bound of its bucket.
+
+        Args:
+            op (str): Operation name
+            pct (float): Percentile (0-100)
+        Returns:
+            lat (float): Latency in seconds
+        """
+        count, _, _, lat_max, hist = self.ops[op]
+        target = count * pct / 100.0
+        seen = 0
+        for bucket, n in enumerate(hist):
+            seen += n
+            if n and seen >= target:
+                return min((1 << bucket) / 1000000.0, lat_max)
+        return lat_max
+
+    def report(self):
+        """
+        Format the statistics.
+
+        Returns:
+            lines (list): Report lines
+        """
+        lines = ['%-16s %10s %14s %10s %10s %10s %10s' %
+                 ('op', 'count', 'bytes', 'avg_us', 'p50_us', 'p99_us',
+                  'max_us')]
+        for op in sorted(self.ops):
+            count, nbytes, lat_sum, lat_max, _ = self.ops[op]
+            lines.append('%-16s %10d %14d %10.1f %10.1f %10.1f %10.1f' %
+                         (op, count, nbytes, lat_sum / count * 1000000,
+                          self.percentile(op, 50) * 1000000,
+                          self.percentile(op, 99) * 1000000,
+                          lat_max * 1000000))
+        return lines
+
+    def cost(self):
+        """
+        Format the resource usage of every worker and of the run, normalised
+        to CPU seconds per GB moved and per million operations, followed by
+        the operation counts, i.e. the syscalls made, per GB.
+
+        The run total is the usage accounted to this Stats, e.g. of the
+        whole process, or else the sum of the workers.
+
+        Returns:
+            lines (list): Report lines
+        """
+        lines = ['%-8s %9s %9s %9s %9s %9s %10s %10s %10s %10s' %
+                 ('worker', 'user_s', 'sys_s', 'vcsw', 'ivcsw', 'io_MB',
+                  'disk_MB', 'cpu_s/GB', 'cpu_s/Mop', 'MB')]
+        rows = [(str(i), w) for i, w in enumerate(self.workers)]
+        if self.usage is not None or self.workers:
+            rows.append(('total', self))
+        for name, stats in rows:
+            used = stats.usage
+            if used is None:
+                used = dict.fromkeys(USAGE, 0)
+                for worker in stats.workers:
+                    for counter in USAGE:
+                        used[counter] += worker.usage[counter]
+            count, nbytes, _ = stats.totals()
+            cpu = used['utime'] + used['stime']
+            lines.append('%-8s %9.2f %9.2f %9d %9d %9.1f %10.1f %10s %10s '
+                         '%10.1f' % (
+                             name, used['utime'], used['stime'],
+                             used['nvcsw'], used['nivcsw'],
+                             (used['rchar'] + used['wchar']) / 1048576.0,
+                             (used['read_bytes'] + used['write_bytes']) /
+                             1048576.0,
+                             '%.3f' % (cpu / nbytes * 1073741824)
+                             if nbytes else '-',
+                             '%.2f' % (cpu / count * 1000000)
+                             if count else '-',
+                             nbytes / 1048576.0))
+        nbytes = self.totals()[1]
+        lines.append('%-16s %10s %12s' % ('op', 'count', 'count/GB'))
+        for op in sorted(self.ops):
+            count = self.ops[op][0]
+            lines.append('%-16s %10d %12s' % (
+                op, count, '%.1f' % (count / float(nbytes) * 1073741824)
+                if nbytes else '-'))
+        return lines
+
+
+class Intervals(object):
+    """
+    Split the statistics of worker threads into fixed length intervals.
+
+    Each worker owns a Stats object per interval and hands it over at the
+    first tick past an interval boundary, so no Stats object is ever
+    shared. Work is accounted to the interval of the previous tick, i.e.
+    the one in which it started. A consumer thread receives the merged
+    intervals in order.
+
+    Args:
+        thr_ct (int): Worker thread count
+        interval (float): Interval length in seconds
+        start (float): Start time, default is now
+        last (int): Index of the last interval, later work is accounted
+                    to it
+    """
+
+    def __init__(self, thr_ct, interval, start=None, last=None):
+        self.interval = interval
+        self.start = time.time() if start is None else start
+        self.last = last
+        self._queue = Queue()
+        # Worker state, each element is only touched by its own thread
+        self._cur = [0] * thr_ct
+        self._count = [0] * thr_ct
+        self._stats = [Stats() for i in range(thr_ct)]
+        # Consumer state
+        self._passed = [-1] * thr_ct
+        self._pending = {}
+        self._next = 0
+
+    def stats(self, idx):
+        """
+        The statistics of a worker for the current interval.
+
+        Args:
+            idx (int): Worker index
+        Returns:
+            stats (Stats): Statistics
+        """
+        return self._stats[idx]
+
+    def tick(self, idx, count=1):
+        """
+        Account completed work of a worker, called by the worker.
+
+        Args:
+            idx (int): Worker index
+            count (int): Units of work completed, e.g. files
+        Returns:
+            stats (Stats): Statistics to use from now on
+        """
+        self._count[idx] += count
+        nxt = int((time.time() - self.start) / self.interval)
+        if self.last is not None and nxt > self.last:
+            nxt = self.last
+        if nxt > self._cur[idx]:
+            self._queue.put((idx, self._cur[idx], nxt, self._count[idx],
+                             self._stats[idx]))
+            self._cur[idx] = nxt
+            self._count[idx] = 0
+            self._stats[idx] = Stats()
+        return self._stats[idx]
+
+    def finish(self, idx):
+        """
+        Hand over the last interval of a worker, called by the worker once
+        it is done.
+
+        Args:
+            idx (int): Worker index
+        """
+        self._queue.put((idx, self._cur[idx], None, self._count[idx],
+                         self._stats[idx]))
+
+    def get(self, timeout=None):
+        """
+        Wait for the next interval that every worker has moved past.
+        Intervals without any work are returned empty.
+
+        Args:
+            timeout (float): Seconds to wait, default is forever
+        Returns:
+            interval (tuple): (index, count, Stats) or None once every
+                              worker has finished and every interval has
+                              been returned
+        Raises:
+            Queue.Empty: On timeout
+        """
+        while True:
+            active = [p for p in self._passed if p is not None]
+            if active:
+                upto = min(active)
+            elif self._pending:
+                upto = max(self._pending)
+            else:
+                return None
+            if self._next <= upto:
+                count, stats = self._pending.pop(self._next, (0, Stats()))
+                self._next += 1
+                return self._next - 1, count, stats
+            idx, cur, nxt, count, stats = self._queue.get(timeout=timeout)
+            rec = self._pending.setdefault(cur, [0, Stats()])
+            rec[0] += count
+            rec[1].merge(stats)
+            self._passed[idx] = None if nxt is None else nxt - 1
+
+
+class SteadyState(object):
+    """
+    Detect steady state from interval throughput and latency.
+
+    A run is steady once the throughput and the mean latency of the last
+    window intervals all lie within tolerance percent of their window
+    means.
+
+    Args:
+        window (int): Interval count
+        tolerance (float): Tolerance in percent
+    """
+
+    def __init__(self, window=5, tolerance=5.0):
+        self.window = window
+        self.tolerance = tolerance
+        self.samples = deque(maxlen=window)
+
+    def add(self, rate, lat):
+        """
+        Add an interval.
+
+        Args:
+            rate (float): Throughput
+            lat (float): Mean latency
+        Returns:
+            steady (bool): Steady state boolean
+        """
+        self.samples.append((rate, lat))
+        return self.steady()
+
+    def steady(self):
+        """
+        Determine if the last window intervals are steady.
+
+        Returns:
+            steady (bool): Steady state boolean
+        """
+        if len(self.samples) < self.window:
+            return False
+        for values in zip(*self.samples):
+            mean = sum(values) / len(values)
+            if not mean:
+                return False
+            if max(abs(v - mean) for v in values) > \
+                    mean * self.tolerance / 100.0:
+                return False
+        return True
+
+
+# Shared statistics file layout: a header, the operation names and one
+# slot per worker, each a sequence counter followed by a record per
+# operation of count, bytes, latency sum, latency max and histogram
+_SHM_MAGIC = 'PYIOSHM1'
+_SHM_HEADER = struct.Struct('<8sIII')
+_SHM_NAME = struct.Struct('<32s')
+_SHM_SEQ = struct.Struct('<Q')
+_SHM_REC = struct.Struct('<QQdd')
+_SHM_OPREC = struct.Struct('<QQdd%dQ' % BUCKETS)
+_SHM_ALIGN = 64
+# Reads of a slot that is being updated before it is skipped as stale
+_SHM_RETRIES = 1000
+
+# Operations of a new shared statistics file, others are accounted under
+# the name before a colon, e.g. read for read:4k, or else under other
+SHM_OPS = ('open', 'close', 'read', 'write', 'seek', 'fstat', 'stat', 'lstat',
+           'fsync', 'fdatasync', 'sync_file_range', 'copy', 'listdir',
+           'readdir', 'other')
+
+
+class _Slot(object):
+    """
+    The slot of a single worker in a SharedStats file. It can be passed
+    wherever a Stats object is accepted for accounting, e.g. to the pyio
+    engines, but must only be written by its own worker.
+    """
+
+    def __init__(self, shm, idx):
+        self._map = shm._map
+        self._base = shm._slot_offset(idx)
+        self._ops = dict((op, self._base + _SHM_SEQ.size + i *
+                          _SHM_OPREC.size) for i, op in enumerate(shm.ops))
+        self._seq = _SHM_SEQ.unpack_from(self._map, self._base)[0]
+
+    def _offset(self, op):
+        off = self._ops.get(op.partition(':')[0])
+        if off is None:
+            off = self._ops['other']
+        self._ops[op] = off
+        return off
+
+    def add(self, op, nbytes, lat, count=1):
+        """
+        Account an operation, see Stats.add.
+
+        Args:
+            op (str): Operation name
+            nbytes (int): Bytes transferred
+            lat (float): Latency in seconds
+            count (int): Operation count
+        """
+        off = self._ops.get(op)
+        if off is None:
+            off = self._offset(op)
+        m = self._map
+        # An odd sequence tells readers that the slot is being updated
+        self._seq += 1
+        _SHM_SEQ.pack_into(m, self._base, self._seq)
+        n, total, lat_sum, lat_max = _SHM_REC.unpack_from(m, off)
+        per = lat / count if count != 1 else lat
+        _SHM_REC.pack_into(m, off, n + count, total + nbytes, lat_sum + lat,
+                           per if per > lat_max else lat_max)
+        bucket = off + _SHM_REC.size + _bucket(per) * _SHM_SEQ.size
+        _SHM_SEQ.pack_into(m, bucket,
+                           _SHM_SEQ.unpack_from(m, bucket)[0] + count)
+        self._seq += 1
+        _SHM_SEQ.pack_into(m, self._base, self._seq)
+
+
+class SharedStats(object):
+    """
+    Statistics of several worker processes in a memory mapped file.
+
+    Each worker owns a fixed slot of counters and histograms that only it
+    writes, so workers never take a lock or share a cache line. Readers in
+    any process sum the slots while the workers run. A slot carries a
+    sequence counter that its worker makes odd while it updates the slot,
+    a reader copies the slot until it sees the same even count before and
+    after, so it never returns a half updated operation. A worker that
+    dies during an update leaves its sequence odd, such stale slots are
+    skipped after a bounded number of reads and listed in stale.
+
+    Args:
+        fname (str): File name, e.g. on /dev/shm
+        slots (int): Create the file with this many slots, default is to
+                     open an existing file
+        ops (list): Operation names of a new file, see SHM_OPS
+    """
+
+    def __init__(self, fname, slots=None, ops=SHM_OPS):
+        if slots is not None:
+            if 'other' not in ops:
+                ops = list(ops) + ['other']
+            self.slots = slots
+            self.ops = list(ops)
+            size = self._slot_offset(slots)
+            with open(fname, 'wb') as f:
+                f.write(_SHM_HEADER.pack(_SHM_MAGIC, slots, len(self.ops),
+                                         BUCKETS))
+                for op in self.ops:
+                    f.write(_SHM_NAME.pack(op))
+                f.truncate(size)
+        fd = os.open(fname, os.O_RDWR)
+        try:
+            size = os.fstat(fd).st_size
+            if size < _SHM_HEADER.size:
+                raise ValueError('%s is not a shared statistics file' % fname)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, self.slots, op_ct, buckets = \
+            _SHM_HEADER.unpack_from(self._map, 0)
+        if magic != _SHM_MAGIC or buckets != BUCKETS:
+            self._map.close()
+            raise ValueError('%s is not a shared statistics file' % fname)
+        self.ops = [_SHM_NAME.unpack_from(self._map, _SHM_HEADER.size +
+                                          i * _SHM_NAME.size)[0]
+                    .rstrip('\0') for i in range(op_ct)]
+        if size < self._slot_offset(self.slots):
+            self._map.close()
+            raise ValueError('%s is truncated' % fname)
+        # Slots skipped by the last read
+        self.stale = []
+
+    def _slot_offset(self, idx):
+        """
+        Offset of a slot, slots are aligned to cache lines.
+        """
+        header = _SHM_HEADER.size + len(self.ops) * _SHM_NAME.size
+        slot = _SHM_SEQ.size + len(self.ops) * _SHM_OPREC.size
+        align = lambda n: (n + _SHM_ALIGN - 1) // _SHM_ALIGN * _SHM_ALIGN
+        return align(header) + idx * align(slot)
+
+    def slot(self, idx):
+        """
+        The slot of a worker, for the worker to account its operations.
+
+        Args:
+            idx (int): Slot index
+        Returns:
+            slot (_Slot): Slot, accepted in place of a Stats object
+        """
+        if not 0 <= idx < self.slots:
+            raise ValueError('slot %d out of range' % idx)
+        return _Slot(self, idx)
+
+    def reset(self, slots):
+        """
+        Zero slots, including their sequence, e.g. when a new worker takes
+        over the slots of an earlier one. The slots must not be in use.
+
+        Args:
+            slots (list): Slot indexes
+        """
+        size = _SHM_SEQ.size + len(self.ops) * _SHM_OPREC.size
+        for idx in slots:
+            if not 0 <= idx < self.slots:
+                raise ValueError('slot %d out of range' % idx)
+            base = self._slot_offset(idx)
+            self._map[base:base + size] = '\0' * size
+
+    def read(self, slots=None):
+        """
+        Sum the slots. Slots that stay in an update are skipped and listed
+        in stale.
+
+        Args:
+            slots (list): Slot indexes, default is all
+        Returns:
+            stats (Stats): Statistics
+        """
+        stats = Stats()
+        for slot in self.read_slots(slots).itervalues():
+            stats.merge(slot)
+        return stats
+
+    def since(self, prev, slots=None):
+        """
+        Sum what the slots accounted since an earlier read. Slots that are
+        stale now are left out and their earlier counters carried over, so
+        a later call accounts them. Slots whose counters went backwards
+        because they were reset are left out too.
+
+        Args:
+            prev (dict): Earlier read_slots or since result
+            slots (list): Slot indexes, default is all
+        Returns:
+            stats (Stats): Statistics
+            cur (dict): Slot counters to pass as prev next time
+        """
+        stats = Stats()
+        cur = self.read_slots(slots)
+        for idx, slot in cur.iteritems():
+            if idx in prev:
+                diff = slot.delta(prev[idx])
+                if diff is not None:
+                    stats.merge(diff)
+        for idx in self.stale:
+            if idx in prev:
+                cur[idx] = prev[idx]
+        return stats, cur
+
+    def read_slots(self, slots=None):
+        """
+        Read the slots one by one. Slots that stay in an update are
+        skipped and listed in stale.
+
+        Args:
+            slots (list): Slot indexes, default is all
+        Returns:
+            stats (dict): Slot index -> Stats
+        """
+        stats = {}
+        self.stale = []
+        size = len(self.ops) * _SHM_OPREC.size
+        for idx in range(self.slots) if slots is None else slots:
+            base = self._slot_offset(idx)
+            raw = None
+            for i in xrange(_SHM_RETRIES):
+                seq = _SHM_SEQ.unpack_from(self._map, base)[0]
+                if seq % 2:
+                    # Yield, then back off so that a writer in this process
+                    # gets the interpreter lock to finish its update
+                    time.sleep(0 if i < 10 else 0.0001)
+                    continue
+                data = self._map[base + _SHM_SEQ.size:
+                                 base + _SHM_SEQ.size + size]
+                if _SHM_SEQ.unpack_from(self._map, base)[0] == seq:
+                    raw = data
+                    break
+            if raw is None:
+                self.stale.append(idx)
+                continue
+            slot = Stats()
+            for i, op in enumerate(self.ops):
+                rec = _SHM_OPREC.unpack_from(raw, i * _SHM_OPREC.size)
+                if rec[0]:
+                    slot.ops[op] = [rec[0], rec[1], rec[2], rec[3],
+                                    list(rec[4:])]
+            stats[idx] = slot
+        return stats
+
+    def close(self):
+        """
+        Unmap the file.
+        """
+        self._map.close()
@@ -29,19 +29,22 @@ def tree(width, depth, dst):
     Created a nested directory structure.
 
     Inputs:
-        width (int): Directory width
+        width (int|list): Directory width, or one width per level to shape
+                          the fan-out, e.g. [4, 64] for few top level
+                          directories with many children each
         depth (int): Directory depth
         dst   (str): Destination
     Outputs:
-        None
+        leaves (list): Directories of the deepest level
     """
     prev_dirs = [dst]
     for d in range(depth):
         cur_dirs = []
         for prev_dir in prev_dirs:
-            for w in range(width):
+            for w in range(width[d] if isinstance(width, list) else width):
                 cur_dir = os.path.join(prev_dir, str(w))
                 mkdirs(cur_dir)
                 cur_dirs.append(cur_dir)
 
         prev_dirs = cur_dirs
+    return prev_dirs
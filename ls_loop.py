@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+ls_loop.py
+
+Directory listing loop.
+
+Lists random directories of a tree with several threads and reports the
+entries listed per second for each listing mode:
+
+    readdir  names only, like ls
+    dtype    names and the entry types returned by getdents, via scandir,
+             like find
+    stat     names and a stat per entry, like ls -l or os.walk plus os.stat
+
+Copyright (c) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import argparse
+import threading
+import scandir
+from random import randint
+from pyio import instrument, load_hook, flush, Stats, usage
+
+MODES = ('readdir', 'dtype', 'stat')
+
+alive = True
+
+
+def walk(root):
+    """
+    Walk directory and return absolute path for all directories.
+
+    Inputs:
+        root (str): Root directory
+    Outputs:
+        d (list): List of directories
+    """
+    if not os.path.isdir(root):
+        raise ValueError('%s is not a directory' % root)
+
+    d = []
+    for root, dirs, files in os.walk(root):
+        d.append(root)
+    return d
+
+
+def _dtype(path, entry):
+    """
+    Tell the type of a directory entry.
+
+    Inputs:
+        path   (str): Entry path, for instrument
+        entry (DirEntry): Directory entry
+    Outputs:
+        isdir (bool): Directory boolean
+    """
+    return entry.is_dir(follow_symlinks=False)
+
+
+def ls(dirs, mode, done=None, stats=None):
+    """
+    List a random directory.
+
+    Inputs:
+        dirs   (list): Directory list
+        mode    (str): Listing mode, see MODES
+        done   (list): Two element list counting the directories and
+                       entries listed
+        stats (Stats): Statistics
+    Outputs:
+        None
+    """
+    count = len(dirs) - 1
+    done = done or [0, 0]
+    before = usage() if stats is not None else None
+    listdir = instrument(os.listdir, 'listdir', stats)
+    scandir_ = instrument(lambda d: list(scandir.scandir(d)), 'readdir',
+                          stats)
+    # DirEntry returns the getdents type but lstats behind the scenes where
+    # the file system does not return one, so each type test is accounted
+    dtype = instrument(_dtype, 'dtype', stats)
+    lstat = instrument(os.lstat, 'lstat', stats)
+
+    while alive:
+        d = dirs[randint(0, count)]
+        if mode == 'readdir':
+            n = len(listdir(d))
+        elif mode == 'dtype':
+            entries = scandir_(d)
+            for entry in entries:
+                dtype(entry.path, entry)
+            n = len(entries)
+        else:
+            names = listdir(d)
+            for name in names:
+                lstat(os.path.join(d, name))
+            n = len(names)
+        done[0] += 1
+        done[1] += n
+    if before is not None:
+        stats.account(before)
+
+
+def run(dirs, mode, thr_ct, duration, stats=None):
+    """
+    Run one listing mode.
+
+    Inputs:
+        dirs     (list): Directory list
+        mode      (str): Listing mode, see MODES
+        thr_ct    (int): Thread count
+        duration (float): Run time in seconds
+        stats   (Stats): Statistics
+    Outputs:
+        dirs   (int): Directories listed
+        entries (int): Entries listed
+        elapsed (float): Run time in seconds
+    """
+    global alive
+    alive = True
+    thrs = []
+    counts = []
+    thr_stats = []
+    start = time.time()
+    for i in range(thr_ct):
+        counts.append([0, 0])
+        thr_stats.append(Stats() if stats is not None else None)
+        t = threading.Thread(target=ls, args=(dirs, mode, counts[-1],
+                                              thr_stats[-1]))
+        t.start()
+        thrs.append(t)
+
+    try:
+        time.sleep(duration)
+    finally:
+        alive = False
+        # Wait for threads to finish
+        for t in thrs:
+            t.join()
+    elapsed = time.time() - start
+
+    if stats is not None:
+        for thr_stat in thr_stats:
+            stats.merge(thr_stat)
+    return (sum(c[0] for c in counts), sum(c[1] for c in counts), elapsed)
+
+
+def main(root, thr_ct, modes=MODES, duration=10, stats=False):
+    """
+    Directory listing loop, one timed run per mode.
+
+    Inputs:
+        root      (str): Root directory
+        thr_ct    (int): Thread count
+        modes    (list): Listing modes, see MODES
+        duration (float): Run time per mode in seconds
+        stats    (bool): Report per operation statistics and CPU cost
+    Outputs:
+        NA
+    """
+
+    # Walk directory
+    dirs = walk(root)
+
+    print "Listing %d directories with %d threads, %d s per mode." % (
+        len(dirs), thr_ct, duration)
+    print "Use CTRL-C to skip the remaining modes."
+
+    results = []
+    try:
+        for mode in modes:
+            mode_stats = Stats() if stats else None
+            before = usage(thread=False)
+            results.append((mode,) + run(dirs, mode, thr_ct, duration,
+                                         mode_stats))
+            if stats:
+                mode_stats.account(before, usage(thread=False))
+                print "\n".join(mode_stats.report())
+                print "\n".join(mode_stats.cost())
+    except KeyboardInterrupt:
+        pass
+    flush()
+
+    print "%-8s %12s %12s %14s" % ('mode', 'dirs/s', 'entries/s',
+                                   'vs readdir')
+    base = None
+    for mode, dir_ct, entry_ct, elapsed in results:
+        rate = entry_ct / elapsed
+        if mode == 'readdir':
+            base = rate
+        print "%-8s %12.1f %12.1f %13s" % (
+            mode, dir_ct / elapsed, rate,
+            '%.2fx' % (rate / base) if base else '-')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Directory listing loop.')
+    parser.add_argument('--dir', '-d', dest='dir', type=str, required=True,
+                        help='Root directory')
+    parser.add_argument('--threads', '-t', dest='thr_ct', type=int,
+                        required=False, default=1, help='Thread count')
+    parser.add_argument('--mode', '-m', dest='modes', type=str,
+                        action='append', choices=MODES, help='Listing '
+                        'mode, repeat for several, default is all')
+    parser.add_argument('--duration', dest='duration', type=float,
+                        required=False, default=10, help='Run time per '
+                        'mode in seconds')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='Report per operation statistics')
+    parser.add_argument('--hook', dest='hook', type=str, required=False,
+                        default=None, help='Instrumentation hook as '
+                        'module:function')
+    args = parser.parse_args()
+    if args.hook:
+        load_hook(args.hook)
+    main(args.dir, args.thr_ct, args.modes or MODES, args.duration,
+         args.stats)
@@ -23,9 +23,19 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
 import os
+import time
 import threading
 import argparse
 import scandir
+from itertools import islice
+from lib.pyio import evict_files, r_small, dir_pool
+
+try:
+    import trollius as asyncio
+    from trollius import From
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
 
 
 def walk(directory):
@@ -66,26 +76,142 @@ def r_seq(fname, blksz):
         os.close(fd)
 
 
-def read_thr(queue, blocksz, lock):
+def read_file(fname, blocksz, lock, cold=None, dirs=None):
     """
-    Simple thread that retrieves a file off the queue and reads the first
-    byte.
+    Read a file, optionally evicting it from the page cache first.
+
+    Args:
+        fname (str): File name
+        blocksz (int): Block size in KB
+        lock (threading.Lock): A lock used to control access to cold, None
+                               if cold is private to the calling thread
+        cold (list): Evict the file from the page cache before reading and
+                     add the resident pages before and after eviction and
+                     the file pages to this list
+        dirs (FdPool): Read the file with a single read of its size,
+                       opened relative to a directory kept open in this
+                       pool
+    """
+    if cold is not None:
+        counts = evict_files([fname])
+        if lock is None:
+            for i, count in enumerate(counts):
+                cold[i] += count
+        else:
+            with lock:
+                for i, count in enumerate(counts):
+                    cold[i] += count
+    if dirs is not None:
+        r_small(fname, blocksz, dirs=dirs)
+    else:
+        r_seq(fname, blocksz)
+
+
+def read_thr(queue, blocksz, lock, cold=None, dirs=None, target=0.01,
+             max_batch=256):
+    """
+    Simple thread that retrieves batches of files off the queue and reads
+    them.
+
+    The lock is taken once per batch rather than once per file. The batch
+    size adapts to the time a file takes so that a batch lasts about
+    target seconds: fast small files are handed out in large batches,
+    slow ones in small batches, and no thread is left with more than about
+    target seconds of work once the queue runs dry. Batches start at a
+    single file and at most double each time. Evictions are counted per
+    thread and added to cold once the thread exits, so reading never
+    contends for the lock.
 
     Args:
         queue (iterator): An iterator containing file paths
         blocksz (int): Block size
         lock (threading.Lock): A lock used to control access to the queue
+                               and cold
+        cold (list): Evict each file from the page cache before reading and
+                     add the resident pages before and after eviction and
+                     the file pages to this list
+        dirs (FdPool): See read_file
+        target (float): Batch duration in seconds
+        max_batch (int): Maximum batch size
     """
     print threading.currentThread().getName(), 'Starting\n',
+    evicted = [0, 0, 0] if cold is not None else None
+    batch = 1
     while True:
         with lock:
-            try:
-                fname = queue.next()
-            except StopIteration:
-                print threading.currentThread().getName(), 'Exiting\n',
-                return
-        #print threading.currentThread().getName(), fname
-        r_seq(fname, blocksz)
+            fnames = list(islice(queue, batch))
+            if not fnames and evicted is not None:
+                for i, count in enumerate(evicted):
+                    cold[i] += count
+        if not fnames:
+            print threading.currentThread().getName(), 'Exiting\n',
+            return
+        start = time.time()
+        for fname in fnames:
+            #print threading.currentThread().getName(), fname
+            read_file(fname, blocksz, None, evicted, dirs)
+        per_file = (time.time() - start) / len(fnames)
+        fit = int(target / per_file) if per_file else max_batch
+        batch = max(1, min(fit, 2 * len(fnames), max_batch))
+
+
+def read_async(queue, blocksz, workers, inflight, cold=None, dirs=None):
+    """
+    Read every file from an event loop that hands the reads to a bounded
+    thread pool. Paths are taken from the iterator only once a semaphore
+    slot is free, so the walk streams and at most inflight reads are
+    queued or running at any time.
+
+    Args:
+        queue (iterator): An iterator containing file paths
+        blocksz (int): Block size in KB
+        workers (int): Thread pool size
+        inflight (int): Maximum outstanding reads
+        cold (list): See read_file
+        dirs (FdPool): See read_file
+    Returns:
+        count (int): Files read
+    """
+    if asyncio is None:
+        raise ImportError('the async engine requires trollius')
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(workers)
+    sem = asyncio.Semaphore(inflight, loop=loop)
+    # Only guards cold, the pool threads never touch the iterator
+    cold_lock = threading.Lock()
+    pending = set()
+    errors = []
+    done = [0]
+
+    def finished(fut):
+        sem.release()
+        pending.discard(fut)
+        if fut.exception() is not None:
+            errors.append(fut.exception())
+        else:
+            done[0] += 1
+
+    @asyncio.coroutine
+    def dispatch():
+        for fname in queue:
+            yield From(sem.acquire())
+            if errors:
+                break
+            fut = loop.run_in_executor(executor, read_file, fname, blocksz,
+                                       cold_lock, cold, dirs)
+            pending.add(fut)
+            fut.add_done_callback(finished)
+        if pending:
+            yield From(asyncio.wait(list(pending), loop=loop))
+
+    try:
+        loop.run_until_complete(dispatch())
+    finally:
+        executor.shutdown()
+        loop.close()
+    if errors:
+        raise errors[0]
+    return done[0]
 
 
 def main():
@@ -100,23 +226,58 @@ def main():
                         dest='threadct', help='thread count')
     parser.add_argument('--bs', '--blocksz', type=int, required=True,
                         dest='blocksz', help='block size in KB')
+    parser.add_argument('--cold', action='store_true', dest='cold',
+                        help='evict each file from the page cache before '
+                        'reading it')
+    parser.add_argument('--engine', type=str, dest='engine',
+                        choices=['thread', 'async'], default='thread',
+                        help='thread reads one file per thread, async keeps '
+                        'up to --inflight reads outstanding on a pool of '
+                        'threadct threads, default is thread')
+    parser.add_argument('--inflight', type=int, dest='inflight',
+                        default=1024, help='outstanding reads of the async '
+                        'engine, default is 1024')
+    parser.add_argument('--batch-time', type=float, dest='batch_time',
+                        default=10, help='target duration of a batch of '
+                        'files handed to a thread in ms, default is 10')
+    parser.add_argument('--max-batch', type=int, dest='max_batch',
+                        default=256, help='maximum files per batch, default '
+                        'is 256')
+    parser.add_argument('--small', action='store_true', dest='small',
+                        help='read each file with a single read of its size '
+                        'after fstat, opened relative to a cached directory')
     args = parser.parse_args()
 
     # Init the queue and lock
     queue = walk(args.directory)
     lock = threading.Lock()
+    cold = [0, 0, 0] if args.cold else None
+    # The walk moves through the tree a directory at a time
+    dirs = dir_pool(64) if args.small else None
+
+    if args.engine == 'async':
+        count = read_async(queue, args.blocksz, args.threadct, args.inflight,
+                           cold, dirs)
+        print 'Read %d files' % count
+    else:
+        # Start the threads
+        threads = []
+        for i in range(args.threadct+1):
+            t = threading.Thread(target=read_thr, args=(
+                queue, args.blocksz, lock, cold, dirs,
+                args.batch_time / 1000.0, args.max_batch))
+            threads.append(t)
+            t.start()
+
+        # Wait until all threads return
+        for t in threads:
+            t.join()
+    if dirs is not None:
+        dirs.close()
 
-    # Start the threads
-    threads = []
-    for i in range(args.threadct+1):
-        t = threading.Thread(target=read_thr, args=(queue, args.blocksz,
-                                                    lock,))
-        threads.append(t)
-        t.start()
-
-    # Wait until all threads return
-    for t in threads:
-        t.join()
+    if cold is not None:
+        print 'Resident pages before eviction %d/%d after %d/%d' % \
+            (cold[0], cold[2], cold[1], cold[2])
 
 if __name__ == "__main__":
     main()
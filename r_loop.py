@@ -25,8 +25,12 @@ import os
 import argparse
 import time
 import threading
+from Queue import Empty
 from random import randint
-from pyio import r_seq
+from pyio import r_seq, evict_files, load_hook, flush, FdPool, Stats, \
+    parse_bssplit, Intervals, SteadyState, hook, usage, r_small, dir_pool, \
+    SharedStats
+from iotrace import Recorder
 
 
 alive = True
@@ -51,33 +55,175 @@ def walk(root):
     return f
 
 
-def read(files, bs):
+def read(files, bs, cold=False, pool=None, done=None, stats=None,
+         intervals=None, idx=0, dirs=None):
     """
     Read a random file.
 
     Inputs:
-        files (list): File list
-        bs     (int): Block size
+        files  (list): File list
+        bs (int|list): Block size or block size mix
+        cold   (bool): Evict each file from the page cache before reading
+        pool (FdPool): Keep files open in this pool
+        done   (list): Single element list counting the files read
+        stats (Stats): Statistics or a SharedStats slot
+        intervals (Intervals): Account statistics per interval instead
+        idx     (int): Thread index within intervals
+        dirs (FdPool): Read with r_small, opening relative to directories
+                       kept open in this pool
     Outputs:
         None
     """
     # thr_id = threading.current_thread()
     count = len(files) - 1
+    done = done or [0]
+    before = usage() if isinstance(stats, Stats) else None
+    if intervals is not None:
+        stats = intervals.stats(idx)
 
-    while alive:
-        f = files[randint(0, count)]
-        # print "%s %s" % (thr_id, f)
-        r_seq(f, bs)
+    try:
+        while alive:
+            f = files[randint(0, count)]
+            # print "%s %s" % (thr_id, f)
+            if dirs is not None:
+                r_small(f, bs, cold, dirs, stats)
+            else:
+                r_seq(f, bs, cold, pool=pool, stats=stats)
+            done[0] += 1
+            if intervals is not None:
+                stats = intervals.tick(idx)
+    finally:
+        if intervals is not None:
+            intervals.finish(idx)
+        elif before is not None:
+            stats.account(before)
+
+
+class ShmIntervals(object):
+    """
+    Intervals read from the slots of a shared statistics file rather than
+    handed over by the threads, a drop-in for Intervals in measure.
+
+    Inputs:
+        shared (SharedStats): Shared statistics
+        slots       (list): Slots of the threads
+        counts      (list): Single element file counters of the threads
+        thrs        (list): Threads, get returns None once all stopped
+        interval   (float): Interval length in seconds
+    """
 
+    def __init__(self, shared, slots, counts, thrs, interval):
+        self.shared = shared
+        self.slots = slots
+        self.counts = counts
+        self.thrs = thrs
+        self.interval = interval
+        self.start = time.time()
+        self._next = 0
+        self._files = 0
+        self._prev = shared.read_slots(slots)
 
-def main(root, bs, thr_ct):
+    def get(self, timeout=None):
+        """
+        Wait for the next interval.
+
+        Inputs:
+            timeout (float): Seconds to wait, default is until it ends
+        Outputs:
+            item (tuple): (index, files, Stats) tuple, None once every
+                          thread has stopped
+        """
+        if not any(t.is_alive() for t in self.thrs):
+            return None
+        wait = self.start + (self._next + 1) * self.interval - time.time()
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            raise Empty
+        if wait > 0:
+            time.sleep(wait)
+        stats, self._prev = self.shared.since(self._prev, self.slots)
+        files = sum(c[0] for c in self.counts)
+        item = (self._next, files - self._files, stats)
+        self._files = files
+        self._next += 1
+        return item
+
+
+def measure(intervals, ramp=0, steady=None):
+    """
+    Consume intervals until CTRL-C or steady state, printing each.
+
+    Inputs:
+        intervals (Intervals): Intervals
+        ramp         (float): Warm up seconds excluded from the results
+        steady (SteadyState): Stop once steady, None to run until CTRL-C
+    Outputs:
+        measured (list): List of (index, files, Stats) tuples of the
+                         intervals that count, the steady window only if
+                         steady state was reached
+    """
+    measured = []
+    try:
+        while True:
+            try:
+                item = intervals.get(timeout=0.5)
+            except Empty:
+                continue
+            if item is None:
+                # Every thread has stopped
+                break
+            k, files, stats = item
+            count, nbytes, lat_sum = stats.totals('read')
+            rate = nbytes / intervals.interval
+            lat = lat_sum / count if count else 0.0
+            # Only intervals that start after the ramp are free of it
+            warm = k * intervals.interval >= ramp
+            print "%4d %10.1f files/s %10.1f MB/s %10.1f us%s" % (
+                k, files / intervals.interval, rate / 1048576, lat * 1000000,
+                '' if warm else ' (ramp)')
+            if not warm:
+                continue
+            measured.append((k, files, stats))
+            if steady is not None and steady.add(rate, lat):
+                print "Steady state reached after %.1f s." % (
+                    (k + 1) * intervals.interval)
+                return measured[-steady.window:]
+    except KeyboardInterrupt:
+        if steady is not None:
+            print "Steady state not reached."
+    return measured
+
+
+def main(root, bs, thr_ct, cold=False, cold_each=False, keep_open=None,
+         stats=False, interval=None, ramp=0, steady=None, small=False,
+         shm=None, shm_slot=0):
     """
     Infinite read loop.
 
     Inputs:
-        root   (str): Root directory
-        bs     (int): Block size in KB
-        thr_ct (int): Thread count
+        root       (str): Root directory
+        bs    (int|list): Block size in KB or a block size mix, see
+                          pyio.parse_bssplit
+        thr_ct     (int): Thread count
+        cold      (bool): Evict all files from the page cache before starting
+        cold_each (bool): Evict each file from the page cache before reading
+        keep_open  (int): Keep up to this many files open, 0 for the
+                          RLIMIT_NOFILE limit, None to open per read
+        stats     (bool): Report per operation statistics, per block size
+                          class with a block size mix, and the CPU cost of
+                          every thread unless reporting intervals
+        interval (float): Report every interval seconds
+        ramp     (float): Warm up seconds excluded from the results,
+                          requires interval
+        steady (SteadyState): Stop once steady and report the steady
+                          window only, requires interval
+        small     (bool): Read each file with a single read of its size,
+                          opened relative to a cached directory
+        shm        (str): Account each thread in a slot of this shared
+                          statistics file, created with a slot per thread
+                          if it does not exist, see shmstat.py, the
+                          intervals are then read back from the slots
+        shm_slot   (int): Slot of the first thread
     Outputs:
         NA
     """
@@ -85,26 +231,114 @@ def main(root, bs, thr_ct):
     # Walk directory
     files = walk(root)
 
+    # Evict files from the page cache
+    if cold:
+        before, after, pages = evict_files(files)
+        print "Evicted %d files, resident pages before %d/%d after %d/%d." % \
+            (len(files), before, pages, after, pages)
+
+    pool = None
+    if keep_open is not None:
+        pool = FdPool(keep_open or None)
+        print "Keeping up to %d files open." % pool.size
+    dirs = None
+    if small:
+        dirs = dir_pool()
+        print "Small file reads, keeping up to %d directories open." % \
+            dirs.size
+
+    shared = None
+    if shm:
+        if os.path.exists(shm):
+            shared = SharedStats(shm)
+        else:
+            shared = SharedStats(shm, shm_slot + thr_ct)
+        if shm_slot + thr_ct > shared.slots:
+            raise ValueError('%s has %d slots, %d needed' %
+                             (shm, shared.slots, shm_slot + thr_ct))
+        # Drop the counts, or the stale sequence, of an earlier run
+        shared.reset(range(shm_slot, shm_slot + thr_ct))
+        print "Accounting threads in slots %d-%d of %s." % (
+            shm_slot, shm_slot + thr_ct - 1, shm)
+
     print "Starting %d read threads." % thr_ct
     print "Use CTRL-C to exit."
 
     # Start threads
     thrs = []
+    counts = []
+    thr_stats = []
+    intervals = None
+    if interval and shared is None:
+        intervals = Intervals(thr_ct, interval)
+    elif interval:
+        # The threads account to their slots, the intervals are read back
+        intervals = ShmIntervals(shared, range(shm_slot, shm_slot + thr_ct),
+                                 counts, thrs, interval)
+    start = time.time()
+    run_usage = usage(thread=False)
     for i in range(thr_ct):
-        t = threading.Thread(target=read, args=(files, bs))
+        counts.append([0])
+        if shared is not None:
+            thr_stats.append(shared.slot(shm_slot + i))
+        else:
+            thr_stats.append(Stats() if stats and not interval else None)
+        t = threading.Thread(target=read, args=(
+            files, bs, cold_each, pool, counts[-1], thr_stats[-1],
+            intervals if shared is None else None, i, dirs))
         t.start()
         thrs.append(t)
 
-    try:
-        while True:
-            raw_input()
-    except KeyboardInterrupt:
-        global alive
+    global alive
+    if intervals is not None:
+        measured = measure(intervals, ramp, steady)
         alive = False
+    else:
+        try:
+            while True:
+                raw_input()
+        except KeyboardInterrupt:
+            alive = False
 
     # Wait for threads to finish
     for t in thrs:
         t.join()
+    elapsed = time.time() - start
+    flush()
+
+    if intervals is not None:
+        # Only the measured intervals count
+        total = sum(files for k, files, st in measured)
+        elapsed = len(measured) * interval
+        thr_stats = [st for k, files, st in measured]
+    else:
+        total = sum(c[0] for c in counts)
+    print "Read %d files in %.1f s, %.1f files/s." % (
+        total, elapsed, total / elapsed if elapsed else 0.0)
+    if shared is not None and intervals is None:
+        merged = shared.read(range(shm_slot, shm_slot + thr_ct))
+        if shared.stale:
+            print "Skipped stale slots %s." % ','.join(
+                str(i) for i in shared.stale)
+        if stats:
+            print "\n".join(merged.report())
+    elif stats:
+        merged = Stats()
+        for thr_stat in thr_stats:
+            merged.merge(thr_stat)
+        print "\n".join(merged.report())
+        if intervals is None:
+            merged.account(run_usage, usage(thread=False))
+            print "\n".join(merged.cost())
+    if shared is not None:
+        shared.close()
+    if pool is not None:
+        print "Pool hits %d misses %d evictions %d." % (pool.hits,
+                                                        pool.misses,
+                                                        pool.evictions)
+        pool.close()
+    if dirs is not None:
+        dirs.close()
 
 
 if __name__ == "__main__":
@@ -113,7 +347,68 @@ if __name__ == "__main__":
                         help='Root directory')
     parser.add_argument('--bs', dest='bs', type=int, required=False,
                         default=32, help='IO block size in KB')
+    parser.add_argument('--bssplit', dest='bssplit', type=parse_bssplit,
+                        required=False, default=None, help='IO block size '
+                        'mix in KB, e.g. 4:70,64:20,1024:10')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='Report per operation statistics')
     parser.add_argument('--threads', '-t', dest='thr_ct', type=int,
                         required=False, default=1, help='Thread count')
+    parser.add_argument('--cold', dest='cold', action='store_true',
+                        help='Evict all files from the page cache first')
+    parser.add_argument('--cold-each', dest='cold_each', action='store_true',
+                        help='Evict each file from the page cache before '
+                        'every read')
+    parser.add_argument('--hook', dest='hook', type=str, required=False,
+                        default=None, help='Instrumentation hook as '
+                        'module:function')
+    parser.add_argument('--keep-open', dest='keep_open', type=int, nargs='?',
+                        const=0, default=None, help='Keep up to N files '
+                        'open rather than opening one per read, default N '
+                        'is derived from RLIMIT_NOFILE')
+    parser.add_argument('--record', dest='record', type=str, required=False,
+                        default=None, help='Record an IO trace to this '
+                        'file, see replay.py')
+    parser.add_argument('--interval', dest='interval', type=float,
+                        required=False, default=None, help='Report every '
+                        'N seconds')
+    parser.add_argument('--ramp', dest='ramp', type=float, required=False,
+                        default=0, help='Warm up seconds excluded from the '
+                        'results')
+    parser.add_argument('--steady', dest='steady', type=int, nargs='?',
+                        const=5, default=None, help='Stop once N intervals '
+                        'are steady and report only those, default N is 5')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        required=False, default=5.0, help='Steady state '
+                        'tolerance in percent of the throughput and latency')
+    parser.add_argument('--small', dest='small', action='store_true',
+                        help='Read each file with a single read of its size '
+                        'after fstat, opened relative to a cached directory')
+    parser.add_argument('--shm', dest='shm', type=str, required=False,
+                        default=None, help='Account each thread in a slot '
+                        'of this shared statistics file for shmstat.py')
+    parser.add_argument('--shm-slot', dest='shm_slot', type=int,
+                        required=False, default=0, help='Slot of the first '
+                        'thread, to share the file between processes')
     args = parser.parse_args()
-    main(args.dir, args.bs, args.thr_ct)
+    if args.small and (args.bssplit or args.keep_open is not None):
+        parser.error('--small excludes --bssplit and --keep-open')
+    if args.hook:
+        load_hook(args.hook)
+    recorder = None
+    if args.record:
+        recorder = Recorder()
+        hook(recorder)
+    steady = None
+    if args.steady:
+        steady = SteadyState(args.steady, args.tolerance)
+    interval = args.interval
+    if (args.ramp or steady) and not interval:
+        interval = 1.0
+    main(args.dir, args.bssplit or args.bs, args.thr_ct, args.cold,
+         args.cold_each, args.keep_open, args.stats or bool(args.bssplit),
+         interval, args.ramp, steady, args.small, args.shm, args.shm_slot)
+    if recorder is not None:
+        trace = recorder.trace()
+        trace.save(args.record)
+        print "Recorded %d operations to %s." % (len(trace), args.record)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+replay.py
+
+Convert, inspect and replay IO traces.
+
+    strace -f -tt -e trace=file,desc -o app.strace app
+    replay.py convert app.strace app.trc --root /mnt/prod
+    replay.py show app.trc
+    replay.py run app.trc --root /mnt/test --speed 2 --threads 8
+
+Traces of the pyio engines are recorded with r_loop.py --record.
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from argparse import ArgumentParser
+from lib import pyio, iotrace
+
+
+def show(trace):
+    """
+    Summarise a trace.
+
+    Args:
+        trace (Trace): Trace
+    """
+    ops = {}
+    end = 0.0
+    for op, fid, offset, nbytes, ts in trace:
+        rec = ops.setdefault(op, [0, 0])
+        rec[0] += 1
+        rec[1] += nbytes
+        end = max(end, ts)
+    print "%d records, %d files, %.3f s." % (len(trace), len(trace.paths),
+                                            end)
+    print "%-10s %10s %14s" % ('op', 'count', 'bytes')
+    for op in sorted(ops):
+        print "%-10s %10d %14d" % (op, ops[op][0], ops[op][1])
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Convert, inspect and replay IO '
+                            'traces.')
+    sub = parser.add_subparsers(dest='cmd')
+    p = sub.add_parser('convert', help='convert strace output to a trace')
+    p.add_argument('strace', type=str, help='strace output file')
+    p.add_argument('trace', type=str, help='trace file to write')
+    p.add_argument('--root', dest='root', type=str, default=None,
+                   help='record paths relative to this directory')
+    p = sub.add_parser('show', help='summarise a trace')
+    p.add_argument('trace', type=str, help='trace file')
+    p = sub.add_parser('run', help='replay a trace')
+    p.add_argument('trace', type=str, help='trace file')
+    p.add_argument('--root', dest='root', type=str, default=None,
+                   help='resolve the trace paths relative to this directory')
+    p.add_argument('--speed', dest='speed', type=float, default=1.0,
+                   help='replay speed relative to the original timing, 0 '
+                   'for as fast as possible, default is 1')
+    p.add_argument('--threads', '-t', dest='thr_ct', type=int, default=1,
+                   help='thread count')
+    p.add_argument('--stats', dest='stats', action='store_true',
+                   help='report per operation statistics')
+    args = parser.parse_args()
+
+    if args.cmd == 'convert':
+        with open(args.strace) as f:
+            trace = iotrace.from_strace(f, args.root)
+        trace.save(args.trace)
+        show(trace)
+        return
+
+    trace = iotrace.Trace.load(args.trace)
+    if args.cmd == 'show':
+        show(trace)
+        return
+
+    stats = pyio.Stats() if args.stats else None
+    ops, elapsed, lag = iotrace.replay(trace, args.root, args.speed,
+                                       args.thr_ct, stats)
+    print "Replayed %d operations in %.3f s, %.1f ops/s, max lag %.3f s." % (
+        ops, elapsed, ops / elapsed if elapsed else 0.0, lag)
+    if stats is not None:
+        print "\n".join(stats.report())
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,7 @@ import os
 import argparse
 import threading
 from random import randint
+from pyio import instrument, load_hook, flush
 
 
 alive = True
@@ -59,11 +60,12 @@ def stat(files):
     """
     # thr_id = threading.current_thread()
     count = len(files) - 1
+    stat_ = instrument(os.stat, 'stat')
 
     while alive:
         f = files[randint(0, count)]
         # print "%s %s" % (thr_id, f)
-        os.stat(f)
+        stat_(f)
 
 
 def main(root, thr_ct):
@@ -100,6 +102,7 @@ def main(root, thr_ct):
     # Wait for threads to finish
     for t in thrs:
         t.join()
+    flush()
 
 
 if __name__ == "__main__":
@@ -108,5 +111,10 @@ if __name__ == "__main__":
                         help='Root directory')
     parser.add_argument('--threads', '-t', dest='thr_ct', type=int,
                         required=False, default=1, help='Thread count')
+    parser.add_argument('--hook', dest='hook', type=str, required=False,
+                        default=None, help='Instrumentation hook as '
+                        'module:function')
     args = parser.parse_args()
+    if args.hook:
+        load_hook(args.hook)
     main(args.dir, args.thr_ct)
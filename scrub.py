@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+scrub.py
+
+Incrementally scrub a directory tree.
+
+Reads and digests every file in parallel and records its size, mtime, inode
+and digest in an index. Later runs only read the files that changed since
+plus a rolling fraction of the unchanged ones, whose digests must still
+match the index.
+
+    scrub.py -d /mnt/test -i /var/tmp/test.index --fraction 0.05
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+from argparse import ArgumentParser
+from lib import pyio
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Incrementally scrub a directory '
+                            'tree.')
+    parser.add_argument('--dir', '-d', dest='dir', type=str, required=True,
+                        help='tree root')
+    parser.add_argument('--index', '-i', dest='index', type=str,
+                        required=True, help='index file, created on the '
+                        'first run')
+    parser.add_argument('--bs', dest='bs', type=int, default=1024,
+                        help='read block size in KB, default is 1024')
+    parser.add_argument('--threads', '-t', dest='thr_ct', type=int,
+                        default=4, help='thread count, default is 4')
+    parser.add_argument('--fraction', '-f', dest='fraction', type=float,
+                        default=0.05, help='fraction of the unchanged files '
+                        'reread per run, default is 0.05')
+    parser.add_argument('--digest', dest='digest', type=str, default='crc32',
+                        choices=['crc32', 'crc32c', 'xxhash', 'sha256'],
+                        help='digest algorithm of a new index, default is '
+                        'crc32')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='report per operation statistics')
+    args = parser.parse_args()
+    if not 0 <= args.fraction <= 1:
+        parser.error('--fraction must lie between 0 and 1')
+
+    stats = pyio.Stats() if args.stats else None
+    try:
+        files, changed, rolled, nbytes, elapsed, bad = pyio.scrub(
+            args.dir, args.index, args.bs, args.thr_ct, args.fraction,
+            args.digest, stats)
+    except (OSError, IOError, ValueError) as e:
+        sys.exit('Scrub failed: %s' % e)
+
+    print "%d files, read %d new or changed and %d unchanged." % (
+        files, changed, rolled)
+    print "Read %.1f MB in %.1f s, %.1f MB/s." % (
+        nbytes / 1048576.0, elapsed,
+        nbytes / elapsed / 1048576 if elapsed else 0.0)
+    if stats is not None:
+        print "\n".join(stats.report())
+    if bad:
+        sys.exit('%d mismatches:\n%s' % (
+            len(bad), '\n'.join('%s %s' % (reason, path)
+                                for path, reason in bad)))
+    print "0 mismatches."
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+shmstat.py
+
+Watch a shared statistics file while its workers run.
+
+Workers in any number of processes account their operations in their own
+slots of the file, e.g. r_loop.py --shm, and this tool sums the slots every
+interval without slowing the workers down.
+
+    shmstat.py --create 8 /dev/shm/pyio.stats
+    r_loop.py -d /mnt/test -t 4 --shm /dev/shm/pyio.stats --shm-slot 0 &
+    r_loop.py -d /mnt/test -t 4 --shm /dev/shm/pyio.stats --shm-slot 4 &
+    shmstat.py /dev/shm/pyio.stats
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+from lib import pyio
+
+
+def _stale(shm):
+    """
+    Describe the slots skipped by the last read.
+
+    Args:
+        shm (SharedStats): Shared statistics
+    Returns:
+        note (str): Note, empty if no slot was skipped
+    """
+    if not shm.stale:
+        return ''
+    return ' (stale slots %s)' % ','.join(str(i) for i in shm.stale)
+
+
+def watch(shm, interval, count=None):
+    """
+    Print the operations per second, bandwidth and mean latency of every
+    interval.
+
+    Args:
+        shm (SharedStats): Shared statistics
+        interval (float): Interval in seconds
+        count (int): Intervals to print, default is until CTRL-C
+    """
+    print "%8s %12s %10s %10s" % ('time', 'ops/s', 'MB/s', 'avg_us')
+    prev = shm.read_slots()
+    last = time.time()
+    k = 0
+    while count is None or k < count:
+        time.sleep(interval - (time.time() - last) % interval)
+        now = time.time()
+        # Per slot, so that stale or reset slots do not skew the sum
+        stats, prev = shm.since(prev)
+        ops, nbytes, lat_sum = stats.totals()
+        elapsed = now - last
+        print "%8s %12.1f %10.1f %10.1f%s" % (
+            time.strftime('%H:%M:%S', time.localtime(now)), ops / elapsed,
+            nbytes / elapsed / 1048576, lat_sum / ops * 1000000 if ops else 0,
+            _stale(shm))
+        sys.stdout.flush()
+        last = now
+        k += 1
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Watch a shared statistics file.')
+    parser.add_argument('file', type=str, help='shared statistics file, '
+                        'e.g. on /dev/shm')
+    parser.add_argument('--create', dest='slots', type=int, default=None,
+                        help='create the file with this many slots and exit')
+    parser.add_argument('--interval', '-i', dest='interval', type=float,
+                        default=1, help='interval in seconds, default is 1')
+    parser.add_argument('--count', '-c', dest='count', type=int,
+                        default=None, help='intervals to print, default is '
+                        'until CTRL-C')
+    parser.add_argument('--report', dest='report', action='store_true',
+                        help='print the per operation totals and exit')
+    args = parser.parse_args()
+
+    try:
+        shm = pyio.SharedStats(args.file, args.slots)
+    except (OSError, IOError, ValueError) as e:
+        sys.exit('Cannot open %s: %s' % (args.file, e))
+    if args.slots is not None:
+        print "Created %s with %d slots." % (args.file, shm.slots)
+    elif args.report:
+        print "\n".join(shm.read().report())
+        if shm.stale:
+            print "Skipped%s." % _stale(shm)
+    else:
+        try:
+            watch(shm, args.interval, args.count)
+        except KeyboardInterrupt:
+            pass
+    shm.close()
+
+if __name__ == '__main__':
+    main()
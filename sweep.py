@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+"""
+sweep.py
+
+Find the saturation point of a read workload.
+
+The sweep tunes one dimension at a time: block size at one thread, then
+thread count at the best block size, then queue depth, i.e. the blocks read
+per preadv call, at the best thread count. Each dimension is stepped
+geometrically until throughput stops scaling while latency rises, the knee,
+and the interval between the last step that scaled and the knee is then
+bisected. Past the knee more concurrency only queues, throughput stays flat
+while the latency of every IO rises. A step with flat throughput and flat
+latency is noise rather than a knee and the dimension keeps stepping. The
+last point that still scales is recommended.
+
+    sweep.py -d /mnt/test --duration 5
+
+Copyright (C) 2014  William Kettler <william.p.kettler@gmail.com>
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+from math import log
+from random import randint
+from argparse import ArgumentParser
+from lib import pyio
+
+# Workload name -> (function(fname, bs, depth, stats), takes a depth)
+WORKLOADS = {
+    'r_seq': (lambda f, b, d, s: pyio.r_seq(f, b, batch=d, stats=s), True),
+    'r_rand': (lambda f, b, d, s: pyio.r_rand(f, b, stats=s), False),
+    'r_rand_blk': (lambda f, b, d, s: pyio.r_rand_blk(f, b, stats=s), False),
+}
+
+
+def _walk(root):
+    """
+    Walk a directory and return the path of every file.
+
+    Args:
+        root (str): Root directory
+    Returns:
+        files (list): File list
+    """
+    files = []
+    for dname, dirs, fnames in os.walk(root):
+        for fname in fnames:
+            files.append(os.path.join(dname, fname))
+    if not files:
+        raise ValueError('%s holds no files' % root)
+    return files
+
+
+class Sweep(object):
+    """
+    Run and remember sweep points.
+
+    Args:
+        files (list): File list
+        workload (str): Workload name, see WORKLOADS
+        duration (float): Run time per point in seconds
+        gain (float): Minimum throughput gain in percent per doubling for
+                      a step to scale
+        latency (float): Minimum growth in percent of the mean or p99
+                         latency for a step that does not scale to be a
+                         knee
+    """
+
+    def __init__(self, files, workload, duration, gain, latency=10):
+        self.files = files
+        self.func = WORKLOADS[workload][0]
+        self.duration = duration
+        self.gain = gain
+        self.latency = latency
+        # (threads, depth, bs) -> (MB/s, avg latency, p99 latency)
+        self.points = {}
+        self.order = []
+        # Dimension -> (knee value, throughput, avg and p99 latency growth)
+        self.knees = {}
+        self._growth = None
+
+    def run(self, thr_ct, depth, bs):
+        """
+        Run a point, or return its result if it already ran.
+
+        Args:
+            thr_ct (int): Thread count
+            depth (int): Queue depth
+            bs (int): Block size in KB
+        Returns:
+            rate (float): Throughput in MB/s
+            lat (float): Mean read latency in seconds
+            p99 (float): 99th percentile read latency in seconds
+        """
+        key = (thr_ct, depth, bs)
+        if key in self.points:
+            return self.points[key]
+        files = self.files
+        last = len(files) - 1
+        end = time.time() + self.duration
+
+        def worker(idx, stats):
+            while time.time() < end:
+                self.func(files[randint(0, last)], bs, depth, stats)
+
+        stats = pyio.Stats()
+        elapsed = pyio._run_thrs(worker, thr_ct, stats)
+        count, nbytes, lat_sum = stats.totals('read')
+        if not count:
+            raise ValueError('no reads completed, are the files empty?')
+        result = (nbytes / elapsed / 1048576, lat_sum / count,
+                  stats.percentile('read', 99) if 'read' in stats.ops
+                  else 0.0)
+        self.points[key] = result
+        self.order.append(key)
+        print "threads %4d depth %4d bs %6d KB: %10.1f MB/s %10.1f us" % (
+            key + (result[0], result[1] * 1000000))
+        sys.stdout.flush()
+        return result
+
+    def scales(self, lo, hi, point):
+        """
+        Determine whether throughput scales from one value of a dimension
+        to a larger one. The required gain grows with the log of the
+        ratio, so bisected steps are judged like whole doublings. A step
+        short of the gain only fails to scale if throughput dropped by
+        about the gain or the mean or p99 latency grew by more than the
+        latency tolerance, flat throughput at flat latency is noise.
+
+        Args:
+            lo (int): Smaller value
+            hi (int): Larger value
+            point (function): Maps a value to a (threads, depth, bs) tuple
+        Returns:
+            scales (bool): Scaling boolean
+        """
+        r_lo, lat_lo, p99_lo = self.run(*point(lo))
+        r_hi, lat_hi, p99_hi = self.run(*point(hi))
+        growth = lambda a, b: (b - a) / a * 100 if a else 0.0
+        self._growth = (growth(r_lo, r_hi), growth(lat_lo, lat_hi),
+                        growth(p99_lo, p99_hi))
+        need = self.gain / 100.0 * log(float(hi) / lo, 2)
+        if r_hi > r_lo * (1 + need):
+            return True
+        # A real drop in throughput is a knee whatever the latency does
+        if self._growth[0] < -need * 100:
+            return False
+        return max(self._growth[1:]) <= self.latency
+
+    def tune(self, name, start, limit, factor, point, pow2=False):
+        """
+        Step a dimension geometrically until throughput stops scaling, then
+        bisect between the last step that scaled and the knee. The knee is
+        recorded in knees.
+
+        Args:
+            name (str): Dimension name
+            start (int): First value
+            limit (int): Largest value
+            factor (int): Step factor
+            point (function): Maps a value to a (threads, depth, bs) tuple
+            pow2 (bool): Only try powers of two
+        Returns:
+            best (int): Largest value that still scales
+        """
+        lo = start
+        hi = None
+        while lo < limit:
+            nxt = min(lo * factor, limit)
+            if not self.scales(lo, nxt, point):
+                hi = nxt
+                self.knees[name] = (hi,) + self._growth
+                break
+            lo = nxt
+        if hi is None:
+            return lo
+
+        # Bisect on a log scale
+        while True:
+            mid = (lo * hi) ** 0.5
+            if pow2:
+                mid = 1 << int(round(log(mid, 2)))
+            else:
+                mid = int(round(mid))
+            if mid <= lo or mid >= hi:
+                return lo
+            if self.scales(lo, mid, point):
+                lo = mid
+            else:
+                hi = mid
+                self.knees[name] = (hi,) + self._growth
+
+    def report(self, best):
+        """
+        Format the sweep results.
+
+        Args:
+            best (tuple): Recommended (threads, depth, bs) tuple
+        Returns:
+            lines (list): Report lines
+        """
+        lines = ['%8s %6s %8s %10s %10s %10s' % ('threads', 'depth', 'bs_kb',
+                                                'MB/s', 'avg_us', 'p99_us')]
+        for key in sorted(self.points):
+            rate, lat, p99 = self.points[key]
+            lines.append('%8d %6d %8d %10.1f %10.1f %10.1f%s' % (
+                key + (rate, lat * 1000000, p99 * 1000000,
+                       ' *' if key == best else '')))
+        return lines
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Find the saturation point of a '
+                            'read workload.')
+    parser.add_argument('--dir', '-d', dest='dir', type=str, required=True,
+                        help='directory holding the files to read')
+    parser.add_argument('--workload', '-w', dest='workload', type=str,
+                        default='r_seq', choices=sorted(WORKLOADS),
+                        help='workload, default is r_seq')
+    parser.add_argument('--duration', dest='duration', type=float, default=5,
+                        help='run time per point in seconds, default is 5')
+    parser.add_argument('--gain', dest='gain', type=float, default=10,
+                        help='minimum throughput gain in percent per '
+                        'doubling, default is 10')
+    parser.add_argument('--latency', dest='latency', type=float, default=10,
+                        help='minimum mean or p99 latency growth in percent '
+                        'for a step short of the gain to be the knee, '
+                        'default is 10')
+    parser.add_argument('--bs', dest='bs', type=int, default=None,
+                        help='fix the block size in KB rather than tune it')
+    parser.add_argument('--min-bs', dest='min_bs', type=int, default=4,
+                        help='smallest block size in KB, default is 4')
+    parser.add_argument('--max-bs', dest='max_bs', type=int, default=4096,
+                        help='largest block size in KB, default is 4096')
+    parser.add_argument('--max-threads', dest='max_thr', type=int,
+                        default=64, help='largest thread count, default is '
+                        '64')
+    parser.add_argument('--max-depth', dest='max_depth', type=int,
+                        default=32, help='largest queue depth, default is '
+                        '32')
+    args = parser.parse_args()
+
+    try:
+        sweep = Sweep(_walk(args.dir), args.workload, args.duration,
+                      args.gain, args.latency)
+        bs = args.bs or sweep.tune('bs', args.min_bs, args.max_bs, 4,
+                                   lambda v: (1, 1, v), pow2=True)
+        thr_ct = sweep.tune('threads', 1, args.max_thr, 2,
+                            lambda v: (v, 1, bs))
+        depth = 1
+        if WORKLOADS[args.workload][1]:
+            depth = sweep.tune('depth', 1, args.max_depth, 2,
+                               lambda v: (thr_ct, v, bs))
+        best = (thr_ct, depth, bs)
+        rate, lat, p99 = sweep.run(*best)
+    except KeyboardInterrupt:
+        sys.exit('Sweep interrupted.')
+    except (OSError, IOError, ValueError) as e:
+        sys.exit('Sweep failed: %s' % e)
+
+    print ''
+    print "\n".join(sweep.report(best))
+    print ''
+    print "%d points run." % len(sweep.order)
+    for name in ('bs', 'threads', 'depth'):
+        if name in sweep.knees:
+            print "Knee of %s at %d: throughput %+.1f%%, latency %+.1f%% " \
+                  "avg %+.1f%% p99." % ((name,) + sweep.knees[name])
+    print "Recommended: threads %d depth %d bs %d KB, %.1f MB/s at " \
+          "%.1f us avg %.1f us p99." % (thr_ct, depth, bs, rate,
+                                        lat * 1000000, p99 * 1000000)
+
+if __name__ == '__main__':
+    main()
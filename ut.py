@@ -21,8 +21,27 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import sys
+import json
+import errno
+import time
+import struct
+import random
+import shutil
+import socket
+import threading
+from StringIO import StringIO
 import pyio
+import iotrace
+import tree
 import filecmp
+import coord
+import r_all
+import filegen
+import ls_loop
+import r_loop
+import sweep
 
 # Test directory
 d = 'ut/test'
@@ -50,6 +69,37 @@ except ValueError:
     pass
 pyio.w_zero('%s/rand_blk_2.out' % d, 32, 32, fsync=False)
 pyio.w_rand_blk('%s/rand_blk_2.out' % d, 8, fsync=True)
+if os.stat('%s/rand_blk_2.out' % d).st_size != 32 * 1024:
+    print 'pyio.w_rand_blk file size changed'
+
+# w_rand_ovw
+pyio.w_rand('%s/ovw_1.out' % d, 64, 64, fsync=False)
+pyio.cp('%s/ovw_1.out' % d, '%s/ovw_2.out' % d, 64, fsync=False)
+if pyio.w_rand_ovw('%s/ovw_1.out' % d, 4, count=8) != 8:
+    print 'pyio.w_rand_ovw write count differs'
+if os.stat('%s/ovw_1.out' % d).st_size != 64 * 1024:
+    print 'pyio.w_rand_ovw file size changed'
+if filecmp.cmp('%s/ovw_1.out' % d, '%s/ovw_2.out' % d, shallow=False):
+    print 'pyio.w_rand_ovw file not modified'
+pyio.w_rand_ovw('%s/ovw_1.out' % d, 1, runtime=0.1, aligned=False,
+                fsync=True)
+
+# durability
+stats = pyio.Stats()
+pyio.w_zero('%s/dur_1.out' % d, 64, 4,
+            fsync=pyio.Durability('fdatasync', blocks=4), stats=stats)
+pyio.w_srand('%s/dur_2.out' % d, 64, 4,
+             fsync=pyio.Durability(size=16, oflag='dsync'), stats=stats)
+pyio.w_rand('%s/dur_3.out' % d, 64, 4,
+            fsync=pyio.Durability(behind=8, final=False), stats=stats)
+pyio.cp_rand('%s/dur_3.out' % d, '%s/cp_dur_3.out' % d, 4,
+             fsync=pyio.Durability(oflag='sync'), stats=stats)
+if not filecmp.cmp('%s/dur_3.out' % d, '%s/cp_dur_3.out' % d):
+    print 'pyio.cp_rand durability files differ'
+if stats.count('fdatasync') != 5 or stats.count('fsync') != 6:
+    print 'pyio durability sync counts differ'
+if not stats.count('sync_file_range'):
+    print 'pyio durability write-behind not issued'
 
 # cp
 pyio.cp('%s/srand_1.out' % d, '%s/cp_srand_1.out' % d, 1, fsync=False)
@@ -94,4 +144,584 @@ pyio.r_rand_blk('%s/zero_1.out' % d, 8)
 try:
     pyio.r_rand_blk('%s/zero_1.out' % d, 128)
 except ValueError:
-    pass
\ No newline at end of file
+    pass
+
+# r_stripe
+pyio.w_stripe('%s/stripe_1.out' % d, 100, 4, 3)
+if os.stat('%s/stripe_1.out' % d).st_size != 100 * 1024:
+    print 'pyio.w_stripe file size differs'
+pyio.w_stripe('%s/stripe_2.out' % d, 100, 4, 4, stripe=8, fsync=True)
+stats = pyio.Stats()
+pyio.r_stripe('%s/stripe_1.out' % d, 4, 3, stats=stats)
+if stats.nbytes('read') != 100 * 1024:
+    print 'pyio.r_stripe round 1 byte count differs'
+stats = pyio.Stats()
+pyio.r_stripe('%s/stripe_2.out' % d, 4, 4, stripe=8, sequential=True,
+              prefetch=True, stats=stats)
+if stats.nbytes('read') != 100 * 1024:
+    print 'pyio.r_stripe round 2 byte count differs'
+
+# evict
+pyio.r_seq('%s/zero_1.out' % d, 8)
+pyio.evict('%s/zero_1.out' % d)
+if pyio.resident('%s/zero_1.out' % d)[1] != 3:
+    print 'pyio.resident page count differs'
+pyio.r_seq('%s/zero_1.out' % d, 8, cold=True)
+pyio.r_rand('%s/zero_1.out' % d, 8, cold=True)
+pyio.r_conv('%s/zero_1.out' % d, 8, cold=True)
+pyio.r_rand_blk('%s/zero_1.out' % d, 8, cold=True)
+pyio.r_stripe('%s/zero_1.out' % d, 4, 2, cold=True)
+
+# batch
+stats = pyio.Stats()
+pyio.r_seq('%s/zero_1.out' % d, 1, batch=4, stats=stats)
+if stats.count('read') != 11 or stats.nbytes('read') != 10 * 1024:
+    print 'pyio.r_seq batch read accounting differs'
+pyio.w_zero('%s/batch_zero.out' % d, 10, 1, batch=4)
+if not filecmp.cmp('%s/zero_1.out' % d, '%s/batch_zero.out' % d, False):
+    print 'pyio.w_zero batch files differ'
+pyio.w_srand('%s/batch_srand.out' % d, 10, 4, batch=2, fsync=True)
+if os.stat('%s/batch_srand.out' % d).st_size != 10 * 1024:
+    print 'pyio.w_srand batch file size differs'
+pyio.w_rand('%s/batch_rand.out' % d, 10, 1, batch=3,
+            fsync=pyio.Durability(blocks=4))
+pyio.cp('%s/batch_rand.out' % d, '%s/cp_batch_rand.out' % d, 1, batch=4,
+        fsync=True)
+if not filecmp.cmp('%s/batch_rand.out' % d, '%s/cp_batch_rand.out' % d):
+    print 'pyio.cp batch files differ'
+
+# hook
+events = []
+if pyio._io(None) is not pyio._RAW_IO:
+    print 'pyio._io fast path not selected'
+pyio.hook(events.extend, size=4)
+pyio.r_seq('%s/zero_1.out' % d, 4)
+pyio.cp('%s/zero_1.out' % d, '%s/cp_hook.out' % d, 4, fsync=True)
+pyio.unhook(events.extend)
+ops = [e[0] for e in events]
+if ops[:6] != ['open', 'read', 'read', 'read', 'read', 'close']:
+    print 'pyio.hook r_seq events differ'
+if events[0][7] != '%s/zero_1.out' % d or events[1][3] != 4096:
+    print 'pyio.hook event fields differ'
+if ops.count('fsync') != 1 or ops.count('write') != 3:
+    print 'pyio.hook cp events differ'
+try:
+    pyio.r_seq('%s/missing.out' % d, 4)
+except OSError:
+    pass
+if pyio._io(None) is not pyio._RAW_IO:
+    print 'pyio._io fast path not restored'
+
+# pool
+pool = pyio.FdPool(2)
+stats = pyio.Stats()
+for i in range(3):
+    pyio.r_seq('%s/zero_1.out' % d, 4, pool=pool, stats=stats)
+    pyio.r_seq('%s/zero_2.out' % d, 4, pool=pool, batch=2, stats=stats)
+    pyio.r_seq('%s/rand_1.out' % d, 4, pool=pool, stats=stats)
+if len(pool.fds) != 2 or pool.evictions != 7 or pool.hits != 0:
+    print 'pyio.FdPool eviction differs'
+if stats.nbytes('read') != 3 * 30 * 1024 or stats.count('open'):
+    print 'pyio.FdPool read accounting differs'
+fd = pool.acquire('%s/zero_1.out' % d)
+if pool.acquire('%s/zero_1.out' % d) != fd or pool.hits != 1:
+    print 'pyio.FdPool hit differs'
+pool.acquire('%s/zero_2.out' % d)
+loose = pool.acquire('%s/rand_1.out' % d)
+pool.release('%s/rand_1.out' % d, loose)
+if '%s/rand_1.out' % d in pool.fds:
+    print 'pyio.FdPool evicted a descriptor in use'
+pool.close()
+
+# bssplit
+mix = pyio.parse_bssplit('4:70,16:20,64:10')
+if mix != [(4, 70), (16, 20), (64, 10)]:
+    print 'pyio.parse_bssplit differs'
+pyio.seed(1)
+stats = pyio.Stats()
+pyio.w_rand('%s/mix_1.out' % d, 1000, mix, stats=stats)
+if os.stat('%s/mix_1.out' % d).st_size != 1000 * 1024:
+    print 'pyio.w_rand mix file size differs'
+if sum(stats.nbytes('write:%s' % c) for c in ('4K', '16K', '64K')) != \
+        1000 * 1024 or stats.count('write'):
+    print 'pyio.w_rand mix accounting differs'
+pyio.w_zero('%s/mix_2.out' % d, 100, mix, fsync=pyio.Durability(blocks=8))
+pyio.w_srand('%s/mix_3.out' % d, 100, mix)
+stats = pyio.Stats()
+pyio.r_seq('%s/mix_1.out' % d, mix, stats=stats)
+pyio.r_rand('%s/mix_1.out' % d, mix, stats=stats)
+if sum(stats.nbytes('read:%s' % c) for c in ('4K', '16K', '64K')) != \
+        2 * 1000 * 1024:
+    print 'pyio.r_seq/r_rand mix accounting differs'
+pyio.r_rand_blk('%s/mix_1.out' % d, mix)
+pyio.w_rand_ovw('%s/mix_1.out' % d, mix, count=16, aligned=False)
+try:
+    pyio.r_seq('%s/mix_1.out' % d, mix, batch=2)
+except ValueError:
+    pass
+
+# Stats serialisation
+stats = pyio.Stats()
+pyio.r_seq('%s/mix_1.out' % d, 64, stats=stats)
+copy = pyio.Stats.from_dict(json.loads(json.dumps(stats.to_dict())))
+copy.merge(stats)
+if copy.count('read') != 2 * stats.count('read') or \
+        copy.percentile('read', 99) != stats.percentile('read', 99):
+    print 'pyio.Stats.from_dict differs'
+
+# cp_tree
+pyio.mkdirs('%s/tree/a/b' % d)
+pyio.w_rand('%s/tree/small.out' % d, 4, 4)
+pyio.w_rand('%s/tree/a/large.out' % d, 1000, 64)
+pyio.w_zero('%s/tree/a/b/empty.out' % d, 0, 4)
+if os.path.lexists('%s/tree/link' % d):
+    os.unlink('%s/tree/link' % d)
+os.symlink('small.out', '%s/tree/link' % d)
+stats = pyio.Stats()
+files, bw = pyio.cp_tree('%s/tree' % d, '%s/tree_cp' % d, 256, 4,
+                         stats=stats)
+for f in ('small.out', 'a/large.out', 'a/b/empty.out'):
+    if not filecmp.cmp('%s/tree/%s' % (d, f), '%s/tree_cp/%s' % (d, f),
+                       shallow=False):
+        print 'pyio.cp_tree files differ'
+if os.readlink('%s/tree_cp/link' % d) != 'small.out':
+    print 'pyio.cp_tree link differs'
+if stats.count('open') != 6 or not files or not bw:
+    print 'pyio.cp_tree accounting differs'
+pyio.cp_tree('%s/tree' % d, '%s/tree_cp' % d, 256, 4)
+if os.readlink('%s/tree_cp/link' % d) != 'small.out':
+    print 'pyio.cp_tree recopy differs'
+try:
+    pyio.cp_tree('%s/tree' % d, '%s/tree/a/copy' % d, 256, 4)
+    print 'pyio.cp_tree into its source did not fail'
+except ValueError:
+    pass
+
+# cp_pipe
+stats = pyio.Stats()
+pyio.cp_pipe('%s/mix_1.out' % d, '%s/cp_pipe_1.out' % d, 16, depth=3,
+             batch=2, fsync=pyio.Durability(blocks=8), stats=stats)
+if not filecmp.cmp('%s/mix_1.out' % d, '%s/cp_pipe_1.out' % d,
+                   shallow=False):
+    print 'pyio.cp_pipe files differ'
+if stats.nbytes('read') != 1000 * 1024 or \
+        stats.nbytes('write') != 1000 * 1024:
+    print 'pyio.cp_pipe accounting differs'
+pyio.cp_pipe('%s/tree/a/b/empty.out' % d, '%s/cp_pipe_2.out' % d, 16)
+
+# sparse copy
+fd = os.open('%s/sparse.out' % d, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+os.ftruncate(fd, 4096 * 1024)
+for offset in (0, 1024 * 1024, 2050 * 1024):
+    pyio.pwrite(fd, os.urandom(64 * 1024), offset)
+os.close(fd)
+fd = os.open('%s/sparse.out' % d, os.O_RDONLY)
+data = sum(length for offset, length in pyio.extents(fd, 4096 * 1024))
+os.close(fd)
+for i, func in enumerate((pyio.cp, pyio.cp_conv, pyio.cp_rand)):
+    cp_out = '%s/cp_sparse_%d.out' % (d, i)
+    stats = pyio.Stats()
+    func('%s/sparse.out' % d, cp_out, 32, sparse=True, stats=stats)
+    if not filecmp.cmp('%s/sparse.out' % d, cp_out, shallow=False):
+        print 'pyio.%s sparse files differ' % func.__name__
+    if stats.nbytes('write') != data:
+        print 'pyio.%s sparse copied holes' % func.__name__
+pyio.cp('%s/sparse.out' % d, '%s/cp_sparse_3.out' % d, 32, batch=4,
+        sparse=True)
+if not filecmp.cmp('%s/sparse.out' % d, '%s/cp_sparse_3.out' % d,
+                   shallow=False):
+    print 'pyio.cp batch sparse files differ'
+
+# digests
+sparse_crc = pyio.checksum('%s/sparse.out' % d, 64)
+if pyio.cp('%s/sparse.out' % d, '%s/cp_digest_1.out' % d, 32, sparse=True,
+           digest='crc32') != sparse_crc or \
+        pyio.cp('%s/sparse.out' % d, '%s/cp_digest_2.out' % d, 32, batch=4,
+                sparse=True, digest='crc32') != sparse_crc:
+    print 'pyio.cp sparse digest differs'
+if pyio.cp('%s/mix_1.out' % d, '%s/cp_digest_3.out' % d, 32,
+           digest='sha256') != pyio.checksum('%s/mix_1.out' % d, 4,
+                                             'sha256'):
+    print 'pyio.cp digest differs'
+pyio.cp_tree('%s/tree' % d, '%s/tree_digest' % d, 64, 2,
+             manifest='%s/tree.manifest' % d)
+if pyio.verify('%s/tree_digest' % d, '%s/tree.manifest' % d, 64, 2):
+    print 'pyio.verify failed a good tree'
+pyio.w_rand_ovw('%s/tree_digest/a/large.out' % d, 4, count=1)
+os.unlink('%s/tree_digest/small.out' % d)
+if pyio.verify('%s/tree_digest' % d, '%s/tree.manifest' % d, 64) != \
+        [('a/large.out', 'digest'), ('small.out', 'missing')]:
+    print 'pyio.verify missed damage'
+
+# directory listing modes
+stats = pyio.Stats()
+dirs = ls_loop.walk('%s/tree' % d)
+listed, entries, elapsed = ls_loop.run(dirs, 'dtype', 2, 0.1, stats)
+if not listed or not entries or not stats.count('readdir') or \
+        stats.count('dtype') != entries or stats.count('lstat'):
+    print 'ls_loop dtype mode differs'
+
+# intervals and steady state
+intervals = pyio.Intervals(2, 0.05)
+for i in range(2):
+    stats = intervals.stats(i)
+    stats.add('read', 4096, 0.001)
+    stats = intervals.tick(i)
+time.sleep(0.12)
+for i in range(2):
+    intervals.stats(i).add('read', 4096, 0.001)
+    intervals.tick(i)
+    intervals.finish(i)
+got = []
+while True:
+    item = intervals.get(1)
+    if item is None:
+        break
+    got.append((item[0], item[1], item[2].count('read')))
+if got != [(0, 4, 4), (1, 0, 0), (2, 0, 0)]:
+    print 'pyio.Intervals differ %r' % got
+steady = pyio.SteadyState(3, 10)
+if [steady.add(r, 1.0) for r in (50, 100, 104, 98, 101)] != \
+        [False, False, False, True, True]:
+    print 'pyio.SteadyState differs'
+# only intervals starting after the ramp are measured
+class Fixed(object):
+    interval = 1.0
+    items = [(k, 1, pyio.Stats()) for k in range(5)] + [None]
+
+    def get(self, timeout=None):
+        return self.items.pop(0)
+stdout, sys.stdout = sys.stdout, StringIO()
+try:
+    measured = r_loop.measure(Fixed(), ramp=2.5)
+finally:
+    sys.stdout = stdout
+if [m[0] for m in measured] != [3, 4]:
+    print 'r_loop.measure ramp differs'
+
+# sweep knee: flat throughput at flat latency is noise, a drop is a knee
+def point(threads):
+    rate = {1: 100, 2: 200, 4: 205, 8: 120, 16: 120}.get(threads, 0)
+    lat = {1: 1.0, 2: 1.0, 4: 1.05, 8: 1.0, 16: 4.0}.get(threads, 1.0)
+    return (rate or 150.0, lat, lat * 2)
+tuner = sweep.Sweep(['x'], 'r_seq', 1, 10, 10)
+tuner.run = lambda thr_ct, depth, bs: point(thr_ct)
+if tuner.tune('threads', 1, 16, 2, lambda v: (v, 1, 4)) != 4 or \
+        tuner.knees['threads'][0] not in (5, 6, 8):
+    print 'sweep.Sweep.tune drop differs %r' % tuner.knees
+rates = {1: 100, 2: 200, 4: 205, 8: 206, 16: 207}
+tuner = sweep.Sweep(['x'], 'r_seq', 1, 10, 10)
+tuner.run = lambda thr_ct, depth, bs: (
+    rates.get(thr_ct, 206), 1.0 if thr_ct <= 8 else 2.0, 2.0)
+if tuner.tune('threads', 1, 16, 2, lambda v: (v, 1, 4)) != 8:
+    print 'sweep.Sweep.tune noise differs %r' % tuner.knees
+
+# trace record and replay
+recorder = iotrace.Recorder(d)
+pyio.hook(recorder)
+pyio.r_seq('%s/mix_1.out' % d, 64)
+pyio.cp_rand('%s/mix_1.out' % d, '%s/trace_cp.out' % d, 64)
+pyio.unhook(recorder)
+trace = recorder.trace()
+trace.save('%s/r_seq.trc' % d)
+trace = iotrace.Trace.load('%s/r_seq.trc' % d)
+reads = [r for r in trace if r[0] == 'read' and r[3]]
+if sum(r[3] for r in reads) != 2 * 1000 * 1024 or \
+        max(r[2] for r in reads) != 15 * 64 * 1024 or \
+        trace.paths != ['mix_1.out', 'trace_cp.out']:
+    print 'iotrace.Recorder trace differs'
+# batches of different threads arrive out of order, a reused fd resolves
+# to the open in effect at the time
+recorder = iotrace.Recorder()
+recorder([('open', 5, -1, 0, 0, 1.0, 1.1, 'a')])
+recorder([('open', 5, -1, 0, 0, 5.0, 5.1, 'b'),
+          ('read', 5, -1, 10, 0, 6.0, 6.1, None)])
+recorder([('read', 5, -1, 20, 0, 2.0, 2.1, None),
+          ('read', 5, -1, 30, 0, 2.5, 2.6, None),
+          ('close', 5, -1, 0, 0, 3.0, 3.1, None)])
+if [(op, recorder.trace().paths[fid], offset, nbytes, ts)
+        for op, fid, offset, nbytes, ts in recorder.trace()] != [
+        ('open', 'a', 0, 0, 0.0), ('read', 'a', 0, 20, 1.0),
+        ('read', 'a', 20, 30, 1.5), ('close', 'a', 0, 0, 2.0),
+        ('open', 'b', 0, 0, 4.0), ('read', 'b', 0, 10, 5.0)]:
+    print 'iotrace.Recorder reused fd differs'
+stats = pyio.Stats()
+ops, elapsed, lag = iotrace.replay(trace, d, 0, 2, stats)
+if ops != len(trace) or stats.nbytes('read') != 2 * 1000 * 1024 or \
+        stats.nbytes('write') != 1000 * 1024:
+    print 'iotrace.replay differs'
+strace = '''\
+100 12:00:00.000000 openat(AT_FDCWD, "/data/a b", O_RDONLY) = 3
+101 12:00:00.100000 openat(AT_FDCWD, "/data/c", O_WRONLY|O_CREAT, 0644) = 4
+100 12:00:00.200000 read(3, "x\\"y,z"..., 4096 <unfinished ...>
+101 12:00:00.250000 pwrite64(4, "\\0\\0"..., 512, 8192) = 512
+100 12:00:00.300000 <... read resumed>) = 4096
+100 12:00:00.400000 lseek(3, 65536, SEEK_SET) = 65536
+100 12:00:00.500000 read(3, "", 4096) = 100
+100 12:00:00.550000 newfstatat(3, "", {st_mode=S_IFREG|0644, st_size=65636, ...}, AT_EMPTY_PATH) = 0
+100 12:00:00.600000 close(3) = 0
+101 12:00:00.700000 newfstatat(AT_FDCWD, "/data/d", 0x7ffd, 0) = 0
+101 12:00:00.800000 open("/data/e", O_RDONLY) = -1 ENOENT (No such file)
+'''
+trace = iotrace.from_strace(strace.splitlines(True), '/data')
+if [(op, trace.paths[fid], offset, nbytes, round(ts, 3))
+        for op, fid, offset, nbytes, ts in trace] != [
+        ('open', 'a b', 0, 0, 0.0), ('open', 'c', 0, 0, 0.1),
+        ('write', 'c', 8192, 512, 0.25), ('read', 'a b', 0, 4096, 0.2),
+        ('read', 'a b', 65536, 100, 0.5), ('fstat', 'a b', 0, 0, 0.55),
+        ('close', 'a b', 0, 0, 0.6),
+        ('stat', 'd', 0, 0, 0.7)]:
+    print 'iotrace.from_strace differs'
+
+# resource usage accounting
+stats = pyio.Stats()
+pyio.r_stripe('%s/mix_1.out' % d, 64, 2, stats=stats)
+if len(stats.workers) != 2 or stats.usage is not None or \
+        any(w.usage['utime'] < 0 or w.usage['nvcsw'] < 0
+            for w in stats.workers) or \
+        len(stats.cost()) != len(stats.ops) + 5:
+    print 'pyio.Stats.cost differs'
+
+# cost normalisation per GB and per million operations
+workers = []
+for op, cpu, ops in (('read', 3.0, 500000), ('write', 1.0, 1500000)):
+    worker = pyio.Stats()
+    worker.add(op, 1 << 30, 1.0, ops)
+    worker.usage = dict.fromkeys(pyio.usage(), 0)
+    worker.usage.update(utime=cpu - 0.5, stime=0.5)
+    workers.append(worker)
+stats = pyio.Stats()
+for worker in workers:
+    stats.merge(worker)
+rows = dict((line.split()[0], line.split()[7:9]) for line in stats.cost()[1:4])
+if rows != {'0': ['3.000', '6.00'], '1': ['1.000', '0.67'],
+            'total': ['2.000', '2.00']}:
+    print 'pyio.Stats.cost normalisation differs %r' % rows
+# A process level sample takes precedence over the sum of the workers
+stats.usage = dict(workers[0].usage, utime=4.5)
+if stats.cost()[3].split()[7:9] != ['2.500', '2.50']:
+    print 'pyio.Stats.cost total differs'
+copy = pyio.Stats.from_dict(json.loads(json.dumps(stats.to_dict())))
+if copy.cost() != stats.cost():
+    print 'pyio.Stats.from_dict usage differs'
+
+# small file reads
+for bs, reads in ((64, 16), (1024, 1)):
+    for dirs in (None, pyio.dir_pool(4)):
+        stats = pyio.Stats()
+        if pyio.r_small('%s/mix_1.out' % d, bs, dirs=dirs, stats=stats) != \
+                1000 * 1024 or stats.count('read') != reads or \
+                stats.count('fstat') != 1 or stats.count('open') != 1:
+            print 'pyio.r_small differs'
+        if dirs is not None:
+            dirs.close()
+
+# incremental scrub
+pyio.mkdirs('%s/scrub/sub' % d)
+for i in range(8):
+    pyio.w_rand('%s/scrub/sub/%d.out' % (d, i), 64, 64)
+# A whole second mtime survives utime
+os.utime('%s/scrub/sub/1.out' % d, (1400000000, 1400000000))
+index = '%s/scrub.idx' % d
+if os.path.exists(index):
+    os.unlink(index)
+if pyio.scrub('%s/scrub' % d, index, 64, 2)[:4] != (8, 8, 0, 8 * 65536):
+    print 'pyio.scrub first run differs'
+pyio.w_rand('%s/scrub/sub/0.out' % d, 64, 64)
+if pyio.scrub('%s/scrub' % d, index, 64, 2)[:3] != (8, 1, 0):
+    print 'pyio.scrub changed file differs'
+# Corrupt a file behind the index's back
+with open('%s/scrub/sub/1.out' % d, 'r+') as f:
+    f.write('corrupt')
+os.utime('%s/scrub/sub/1.out' % d, (1400000000, 1400000000))
+files, changed, rolled, nbytes, elapsed, bad = \
+    pyio.scrub('%s/scrub' % d, index, 64, 2, fraction=1)
+if (changed, rolled, bad) != (0, 8, [('sub/1.out', 'digest')]):
+    print 'pyio.scrub mismatch differs'
+# A read error is reported and the pass still writes the index
+checksum = pyio.checksum
+
+
+def failing(fname, *args):
+    if fname.endswith('2.out'):
+        raise IOError(errno.EIO, os.strerror(errno.EIO), fname)
+    return checksum(fname, *args)
+pyio.checksum = failing
+try:
+    files, changed, rolled, nbytes, elapsed, bad = \
+        pyio.scrub('%s/scrub' % d, index, 64, 2, fraction=1)
+finally:
+    pyio.checksum = checksum
+if (files, bad) != (8, [('sub/1.out', 'digest'), ('sub/2.out', 'error')]) \
+        or pyio.read_index(index)[1] != 4:
+    print 'pyio.scrub read error differs'
+
+# async reads keep at most inflight reads outstanding
+read_file = r_all.read_file
+active = [0, 0]
+active_lock = threading.Lock()
+
+
+def tracked(*args):
+    with active_lock:
+        active[0] += 1
+        active[1] = max(active)
+    try:
+        time.sleep(0.01)
+        return read_file(*args)
+    finally:
+        with active_lock:
+            active[0] -= 1
+r_all.read_file = tracked
+try:
+    cold = [0, 0, 0]
+    count = r_all.read_async(r_all.walk('%s/scrub' % d), 64, 4, 3, cold)
+finally:
+    r_all.read_file = read_file
+if count != 8 or not 1 < active[1] <= 3 or cold[2] != 8 * 16:
+    print 'r_all.read_async differs %d %r' % (count, active)
+try:
+    r_all.read_async(iter(['%s/scrub/missing' % d] +
+                          list(r_all.walk('%s/scrub' % d))), 64, 2, 2)
+    print 'r_all.read_async error not raised'
+except OSError as e:
+    if e.errno != errno.ENOENT:
+        raise
+
+# directory fan-out
+leaves = tree.tree([2, 3], 2, '%s/fanout' % d)
+if len(leaves) != 6 or not all(os.path.isdir(l) for l in leaves):
+    print 'tree.tree fan-out differs'
+
+# file size distributions, histograms and seeded file sets
+for dist in ('uniform', 'lognormal:16,1.5', 'pareto:1.2'):
+    draw = filegen.size_dist(dist, 4, 64, random.Random(7))
+    sizes = [draw() for i in range(500)]
+    again = filegen.size_dist(dist, 4, 64, random.Random(7))
+    if sizes != [again() for i in range(500)] or \
+            min(sizes) < 4 or max(sizes) > 64 or len(set(sizes)) < 5:
+        print 'filegen.size_dist %s differs' % dist
+hist = '%s/sizes.hist' % d
+with open(hist, 'w') as f:
+    f.write('# size histogram\n\n4 8 1\n100 3\n')
+if filegen.read_hist(hist) != [(4, 8, 1.0), (100, 100, 3.0)]:
+    print 'filegen.read_hist differs'
+draw = filegen.size_dist('hist:%s' % hist, None, 64, random.Random(7))
+sizes = [draw() for i in range(200)]
+if not set(sizes) <= set(range(4, 9) + [64]) or sizes.count(64) < 100:
+    print 'filegen.size_dist hist clamping differs'
+for line in ('1 2 3 4', '8 4 1', 'x 1', '4 -1', '4 0'):
+    with open(hist, 'w') as f:
+        f.write(line + '\n')
+    try:
+        filegen.read_hist(hist)
+        print 'filegen.read_hist accepted %r' % line
+    except ValueError:
+        pass
+stdout, sys.stdout = sys.stdout, StringIO()
+try:
+    sets = []
+    for i in range(2):
+        root = '%s/filegen_%d' % (d, i)
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.mkdir(root)
+        filegen.filegen(1, 16, 20, 0, 4, root, dist='lognormal:4',
+                        shape=[2, 2], rand_seed=3)
+        sets.append(sorted((os.path.relpath(os.path.join(p, n), root),
+                            os.path.getsize(os.path.join(p, n)))
+                           for p, dirs, names in os.walk(root)
+                           for n in names))
+finally:
+    sys.stdout = stdout
+if sets[0] != sets[1] or len(sets[0]) != 20:
+    print 'filegen seeded file set differs'
+
+# shared memory statistics
+shm = pyio.SharedStats('%s/stats.shm' % d, 3)
+for i in range(2):
+    pyio.r_seq('%s/mix_1.out' % d, mix, stats=shm.slot(i))
+pyio.r_rand('%s/mix_1.out' % d, 64, stats=shm.slot(2))
+live = pyio.SharedStats('%s/stats.shm' % d).read()
+if live.nbytes('read') != 3 * 1000 * 1024 or live.count('open') != 3 or \
+        shm.read([2]).count('seek') != 16:
+    print 'pyio.SharedStats differs'
+# A worker that died mid update leaves an odd sequence
+struct.pack_into('<Q', shm._map, shm.slot(1)._base, 7)
+live = shm.read()
+if shm.stale != [1] or live.count('open') != 2:
+    print 'pyio.SharedStats stale slot differs'
+shm.reset([1])
+if shm.read().count('open') != 2 or shm.stale or \
+        shm.read([1]).count('open'):
+    print 'pyio.SharedStats.reset differs'
+# interval deltas skip stale and reset slots rather than going negative
+prev = shm.read_slots()
+pyio.r_seq('%s/mix_1.out' % d, mix, stats=shm.slot(0))
+struct.pack_into('<Q', shm._map, shm.slot(1)._base, 9)
+live, prev = shm.since(prev)
+if live.count('open') != 1 or shm.stale != [1] or prev[1].count('open'):
+    print 'pyio.SharedStats.since stale differs'
+shm.reset([0, 1])
+pyio.r_seq('%s/mix_1.out' % d, mix, stats=shm.slot(1))
+live, prev = shm.since(prev)
+if live.count('open') != 1 or live.nbytes('read') != 1000 * 1024:
+    print 'pyio.SharedStats.since reset differs'
+shm.close()
+
+# hooked worker threads release their event rings
+events = []
+pyio.hook(events.extend)
+for i in range(20):
+    pyio.r_stripe('%s/mix_1.out' % d, 64, 4)
+pyio.unhook(events.extend)
+if len(pyio._rings) > 2 or \
+        sum(1 for e in events if e[0] == 'open') != 20 * 4:
+    print 'pyio event rings leak %d' % len(pyio._rings)
+
+# hooks may instrument and flush without deadlocking the engines
+def reentrant(batch):
+    pyio.instrument(os.stat, 'stat')
+    pyio.flush()
+pyio.hook(reentrant, size=4)
+t = threading.Thread(target=pyio.r_stripe, args=('%s/mix_1.out' % d, 64, 4))
+t.daemon = True
+t.start()
+t.join(10)
+pyio.unhook(reentrant)
+if t.is_alive():
+    print 'pyio hook deadlocks'
+
+# multi-agent run on localhost, agents survive probes and bad specs
+ports = []
+agents = []
+stdout, sys.stdout = sys.stdout, StringIO()
+try:
+    for i in range(2):
+        # Listening before the agent starts, so connects cannot race it
+        srv = socket.socket()
+        srv.bind(('localhost', 0))
+        srv.listen(1)
+        ports.append(srv.getsockname()[1])
+        t = threading.Thread(target=coord.agent, args=(0, '', True, srv))
+        t.daemon = True
+        t.start()
+        agents.append(t)
+    socket.create_connection(('localhost', ports[0])).close()
+    s = socket.create_connection(('localhost', ports[1]))
+    s.sendall('not json\n')
+    reply = coord._recv(s.makefile('r'))
+    s.close()
+    merged = coord.controller([('localhost', p) for p in ports],
+                              {'workload': 'r_seq', 'dir': '%s/scrub' % d,
+                               'bs': 64, 'threads': 1,
+                               'duration': 0.5, 'interval': 0.25}, 0.2)
+    for t in agents:
+        t.join(5)
+finally:
+    sys.stdout = stdout
+if reply.get('type') != 'error' or any(t.is_alive() for t in agents) or \
+        not merged.count('open') or merged.nbytes('read') % 65536 or \
+        len(merged.workers) != 2 or \
+        any(w.usage is None or w.count('open') < 1 for w in merged.workers):
+    print 'coord multi-agent run differs'